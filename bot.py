@@ -1,14 +1,27 @@
 import logging
 import os
+from typing import Optional
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, filters, ContextTypes
+from telegram.ext import (
+    Application, CommandHandler, MessageHandler, CallbackQueryHandler, TypeHandler, filters, ContextTypes
+)
 from telegram.constants import ParseMode
+from telegram.request import BaseRequest
 import asyncio
 
-from config import BOT_TOKEN, ADMIN_ID
+from config import (
+    BOT_TOKEN, ADMIN_ID, BOT_MODE, CONCURRENT_UPDATES, WORKERS, WEBHOOK_URL, WEBHOOK_LISTEN, WEBHOOK_PORT,
+    WEBHOOK_PATH, WEBHOOK_SECRET, WEBHOOK_DRAIN_TIMEOUT, OUTBOUND_GLOBAL_RATE, OUTBOUND_CHAT_RATE,
+    OUTBOUND_CHAT_BURST, OUTBOUND_MAX_RETRIES, METRICS_LISTEN, METRICS_PORT, COMPACTION_INTERVAL,
+    LIKE_DIGEST_INTERVAL
+)
 from handlers import registration, matching, premium, chat, admin
+from utils import webhook, sharding, metrics, warm_state, compaction, flood, transcripts, digests, backup
+from utils import storage as storage_module
 from utils.storage import Storage
-from utils.helpers import is_banned, get_user_name
+from utils.helpers import get_user_name
+from utils.context import BotContext, with_user_context
+from utils.outbound import OutboundScheduler
 
 # Enable logging
 logging.basicConfig(
@@ -20,26 +33,40 @@ logger = logging.getLogger(__name__)
 # Initialize storage
 storage = Storage()
 
-async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
+# Outbound calls are paced by priority; each worker process gets an equal share of the global limit
+outbound = OutboundScheduler(
+    global_rate=OUTBOUND_GLOBAL_RATE / WORKERS,
+    chat_rate=OUTBOUND_CHAT_RATE,
+    chat_burst=OUTBOUND_CHAT_BURST,
+    max_retries=OUTBOUND_MAX_RETRIES
+)
+
+metrics.collected('lumi_outbound_queued', "Bot API calls waiting for a rate limit slot", 'gauge',
+                  ('priority',), lambda: {(name,): depth for name, depth in outbound.queue_depths().items()})
+
+# Only the update types our handlers consume
+ALLOWED_UPDATES = [Update.MESSAGE, Update.CALLBACK_QUERY]
+
+async def start(update: Update, context: BotContext):
     """Start command handler"""
     user = update.effective_user
     user_id = user.id
+    user_ctx = context.user_ctx
     
     # Check if user is banned
-    if is_banned(user_id):
+    if user_ctx.is_banned:
         await update.message.reply_text("⛔ You are banned from using this bot.")
         return
     
     name = get_user_name(user)
     
     # Check if user is registered
-    user_data = storage.get_user_data(user_id)
-    if user_data and user_data.get('is_registered'):
+    if user_ctx.is_registered:
         # Update premium status
         await update_premium_status(user_id)
         
         # Get notifications count
-        notifications = storage.get_user_property(user_id, 'notifications') or []
+        notifications = user_ctx.get('notifications', [])
         notif_badge = f" ({len(notifications)})" if notifications else ""
         
         # Show main menu
@@ -82,16 +109,15 @@ async def update_premium_status(user_id: int):
         storage.set_bot_property(f"user_{user_id}_premium_expiry", None)
         storage.set_bot_property(f"user_{user_id}_premium_plan", None)
 
-async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def button_handler(update: Update, context: BotContext):
     """Handle inline keyboard buttons"""
     query = update.callback_query
     await query.answer()
     
-    user_id = query.from_user.id
     data = query.data
     
     # Check if user is banned
-    if is_banned(user_id):
+    if context.user_ctx.is_banned:
         await query.edit_message_text("⛔ You are banned from using this bot.")
         return
     
@@ -102,18 +128,59 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await registration.show_profile(update, context)
     elif data == "upgrade":
         await premium.show_upgrade_options(update, context)
-    elif data == "my_chats":
+    elif data == "my_chats" or data.startswith("my_chats_"):
         await chat.show_chats(update, context)
+    elif data == "view_matches" or data.startswith("view_matches_"):
+        await matching.view_matches(update, context)
+    elif data == "view_likes" or data.startswith("view_likes_"):
+        await matching.view_likes(update, context)
     elif data == "boost_profile":
         await premium.boost_profile(update, context)
     elif data == "notifications":
         await show_notifications(update, context)
+    elif data.startswith("gender_"):
+        await registration.handle_gender_selection(update, context)
+    elif data.startswith("interest_"):
+        await registration.handle_interest_selection(update, context)
     elif data.startswith("like_"):
         await matching.like_user(update, context)
     elif data.startswith("pass_"):
         await matching.find_match(update, context)
     elif data.startswith("select_"):
         await premium.select_plan(update, context)
+    elif data.startswith("payments_"):
+        await premium.list_payments(update, context)
+    elif data.startswith("payment_proof_"):
+        await premium.show_payment_proof(update, context)
+    elif data.startswith("approve_payment_"):
+        await premium.approve_payment(update, context)
+    elif data.startswith("reject_payment_"):
+        await premium.reject_payment(update, context)
+    elif data.startswith("approve_payments_") or data.startswith("reject_payments_"):
+        await premium.settle_payments_page(update, context)
+    elif data.startswith("start_chat_"):
+        await chat.start_chat(update, context)
+    elif data == "end_chat":
+        await chat.end_chat(update, context)
+    elif data.startswith("report_"):
+        await chat.report_user(update, context)
+    # Admin panel and report review (the handlers check the admin)
+    elif data == "admin_stats":
+        await admin.show_stats(update, context)
+    elif data == "admin_users":
+        await admin.view_users(update, context)
+    elif data == "admin_ban" or data.startswith("ban_user_"):
+        await admin.ban_user(update, context)
+    elif data == "admin_unban":
+        await admin.unban_user(update, context)
+    elif data == "admin_broadcast":
+        await admin.broadcast_message(update, context)
+    elif data == "admin_reports":
+        await admin.view_reports(update, context)
+    elif data.startswith("warn_user_"):
+        await admin.warn_user(update, context)
+    elif data == "dismiss_report":
+        await admin.dismiss_report(update, context)
     # Add more handlers as needed
 
 async def show_notifications(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -165,77 +232,148 @@ async def show_notifications(update: Update, context: ContextTypes.DEFAULT_TYPE)
         reply_markup=reply_markup
     )
 
-async def message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def message_handler(update: Update, context: BotContext):
     """Handle text messages"""
-    user_id = update.effective_user.id
+    user_ctx = context.user_ctx
     
     # Check if user is banned
-    if is_banned(user_id):
+    if user_ctx.is_banned:
         await update.message.reply_text("⛔ You are banned from using this bot.")
         return
     
     # Check if user is in chat mode
-    partner_id = storage.get_bot_property(f"chat_{user_id}")
-    if partner_id:
+    if user_ctx.chat_partner:
         await chat.handle_chat_message(update, context)
         return
     
     # Check if user is in registration process
-    user_state = storage.get_user_property(user_id, 'registration_state')
-    if user_state:
+    if user_ctx.registration_state:
         await registration.handle_registration_input(update, context)
         return
     
     # Default response
     await update.message.reply_text("Please use the menu buttons or type /start")
 
-async def photo_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def photo_handler(update: Update, context: BotContext):
     """Handle photo messages"""
-    user_id = update.effective_user.id
+    user_ctx = context.user_ctx
     
     # Check if user is banned
-    if is_banned(user_id):
+    if user_ctx.is_banned:
         await update.message.reply_text("⛔ You are banned from using this bot.")
         return
     
     # Check if user is in chat mode
-    partner_id = storage.get_bot_property(f"chat_{user_id}")
-    if partner_id:
+    if user_ctx.chat_partner:
         await chat.handle_chat_photo(update, context)
         return
     
     # Check if user is uploading profile photo
-    user_state = storage.get_user_property(user_id, 'registration_state')
-    if user_state == 'awaiting_photo':
+    if user_ctx.registration_state == 'awaiting_photo':
         await registration.handle_profile_photo(update, context)
         return
     
     # Check if user is uploading payment proof
-    awaiting_payment = storage.get_user_property(user_id, 'awaiting_payment_proof')
-    if awaiting_payment:
+    if user_ctx.get('awaiting_payment_proof'):
         await premium.handle_payment_proof(update, context)
         return
 
-def main():
-    """Start the bot"""
+async def on_startup(application: Application):
+    """Restore warm state, schedule compaction, transcript retention and like digests and serve
+    /metrics while the application runs (post_init hook)"""
+    # Keeps tools/backup.py from restoring over the data while this process runs
+    backup.mark_running(storage.data_dir)
+    warm_state.restore()
+    if COMPACTION_INTERVAL > 0:
+        application.bot_data['compaction'] = asyncio.create_task(compaction.run_periodically(COMPACTION_INTERVAL))
+    application.bot_data['transcript_retention'] = asyncio.create_task(transcripts.run_retention())
+    if LIKE_DIGEST_INTERVAL > 0:
+        application.bot_data['like_digests'] = asyncio.create_task(digests.run_periodically(application.bot))
+    if METRICS_PORT:
+        router = storage_module.get_router()
+        port = METRICS_PORT + (router.index if router is not None else 0)
+        application.bot_data['metrics_server'] = await metrics.start_server(METRICS_LISTEN, port)
+
+async def on_stop(application: Application):
+    """Stop background jobs, write pending like digests and snapshot warm state once updates have
+    drained (post_stop hook)"""
+    for name in ('compaction', 'transcript_retention', 'like_digests'):
+        task = application.bot_data.pop(name, None)
+        if task is not None:
+            task.cancel()
+    # Likes still buffered would be lost with the process; write their digests now (if that
+    # fails they stay buffered and go into the warm-state snapshot)
+    try:
+        digests.like_digests.flush()
+    except OSError as e:
+        logger.warning("Writing like digests failed: %s", e)
+    server = application.bot_data.pop('metrics_server', None)
+    if server is not None:
+        await server.stop()
+    warm_state.save()
+
+def build_application(token: str = BOT_TOKEN, request: Optional[BaseRequest] = None) -> Application:
+    """Create the application with all handlers registered"""
     # Create application
-    application = Application.builder().token(BOT_TOKEN).build()
+    builder = (
+        Application.builder()
+        .token(token)
+        .context_types(ContextTypes(context=BotContext))
+        .concurrent_updates(CONCURRENT_UPDATES)
+        .rate_limiter(outbound)
+        .post_init(on_startup)
+        .post_stop(on_stop)
+    )
+    if request is not None:
+        # Offline runs (tools/replay.py) replace the HTTP layer with a stub
+        builder = builder.request(request).get_updates_request(request)
+    application = builder.build()
+    
+    # Drop updates from users over their flood limit before any other group runs
+    application.add_handler(TypeHandler(Update, flood.flood_guard), group=-1)
     
-    # Add handlers
-    application.add_handler(CommandHandler("start", start))
-    application.add_handler(CallbackQueryHandler(button_handler))
-    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, message_handler))
-    application.add_handler(MessageHandler(filters.PHOTO, photo_handler))
+    # Add handlers (each update loads the user once and flushes changes once)
+    application.add_handler(CommandHandler("start", with_user_context(start)))
+    application.add_handler(CallbackQueryHandler(with_user_context(button_handler)))
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, with_user_context(message_handler)))
+    application.add_handler(MessageHandler(filters.PHOTO, with_user_context(photo_handler)))
+    application.add_handler(CommandHandler("agerange", with_user_context(matching.set_age_range)))
     
     # Add admin handlers
-    application.add_handler(CommandHandler("admin", admin.admin_panel))
-    application.add_handler(CommandHandler("ban", admin.ban_user))
-    application.add_handler(CommandHandler("unban", admin.unban_user))
-    application.add_handler(CommandHandler("broadcast", admin.broadcast_message))
-    application.add_handler(CommandHandler("stats", admin.show_stats))
+    application.add_handler(CommandHandler("admin", with_user_context(admin.admin_panel)))
+    application.add_handler(CommandHandler("ban", with_user_context(admin.ban_user)))
+    application.add_handler(CommandHandler("unban", with_user_context(admin.unban_user)))
+    application.add_handler(CommandHandler("broadcast", with_user_context(admin.broadcast_message)))
+    application.add_handler(CommandHandler("stats", with_user_context(admin.show_stats)))
+    application.add_handler(CommandHandler("backup", with_user_context(admin.backup_data)))
+    application.add_handler(CommandHandler("payments", with_user_context(premium.list_payments)))
+    application.add_handler(CommandHandler("approve", with_user_context(premium.approve_payments)))
+    application.add_handler(CommandHandler("reject", with_user_context(premium.reject_payments)))
+    
+    return application
+
+def main():
+    """Start the bot"""
+    if WORKERS > 1:
+        sharding.run_supervisor(WORKERS, ALLOWED_UPDATES)
+        return
+    
+    application = build_application()
     
     # Run the bot
-    application.run_polling(allowed_updates=Update.ALL_TYPES)
+    if BOT_MODE == 'webhook':
+        asyncio.run(webhook.serve(
+            application,
+            allowed_updates=ALLOWED_UPDATES,
+            url=WEBHOOK_URL,
+            host=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            path=WEBHOOK_PATH,
+            secret=WEBHOOK_SECRET,
+            drain_timeout=WEBHOOK_DRAIN_TIMEOUT
+        ))
+    else:
+        application.run_polling(allowed_updates=ALLOWED_UPDATES)
 
 if __name__ == '__main__':
     main()
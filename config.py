@@ -6,6 +6,114 @@ load_dotenv()
 BOT_TOKEN = os.getenv('BOT_TOKEN')
 ADMIN_ID = int(os.getenv('ADMIN_ID', '5727413041'))
 
+# Update delivery: 'polling' or 'webhook'
+BOT_MODE = os.getenv('BOT_MODE', 'polling')
+
+# Webhook settings (WEBHOOK_URL is the public base URL; leave unset to skip setWebhook)
+WEBHOOK_URL = os.getenv('WEBHOOK_URL')
+WEBHOOK_LISTEN = os.getenv('WEBHOOK_LISTEN', '127.0.0.1')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', '8443'))
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/telegram')
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET')
+WEBHOOK_DRAIN_TIMEOUT = float(os.getenv('WEBHOOK_DRAIN_TIMEOUT', '30'))
+
+# Updates processed in parallel; each user's updates still run in order
+CONCURRENT_UPDATES = int(os.getenv('CONCURRENT_UPDATES', '64'))
+LOCK_STRIPES = 1024
+# A call from another worker waits this long for its user's lock before running
+# without it: two updates awaiting calls into each other's shards would deadlock
+REMOTE_LOCK_TIMEOUT = float(os.getenv('REMOTE_LOCK_TIMEOUT', '2'))
+# A call into another worker fails after this many seconds (or at once if that worker
+# died) instead of holding the caller's user lock forever
+REMOTE_CALL_TIMEOUT = float(os.getenv('REMOTE_CALL_TIMEOUT', '10'))
+
+# Outbound Bot API limits (global is split evenly across worker processes)
+OUTBOUND_GLOBAL_RATE = float(os.getenv('OUTBOUND_GLOBAL_RATE', '30'))
+OUTBOUND_CHAT_RATE = float(os.getenv('OUTBOUND_CHAT_RATE', '1'))
+OUTBOUND_CHAT_BURST = float(os.getenv('OUTBOUND_CHAT_BURST', '3'))
+OUTBOUND_MAX_RETRIES = 3
+BROADCAST_BATCH_SIZE = 100
+
+# Inbound flood control: per-user token buckets by update kind as (refill per second, burst);
+# updates over the limit are dropped before any handler runs
+FLOOD_LIMITS = {
+    'callback': (float(os.getenv('FLOOD_CALLBACK_RATE', '2')), float(os.getenv('FLOOD_CALLBACK_BURST', '10'))),
+    'text': (float(os.getenv('FLOOD_TEXT_RATE', '1')), float(os.getenv('FLOOD_TEXT_BURST', '5'))),
+    'photo': (float(os.getenv('FLOOD_PHOTO_RATE', '0.2')), float(os.getenv('FLOOD_PHOTO_BURST', '3')))
+}
+
+# Rendered profile cards kept in memory
+CARD_CACHE_SIZE = int(os.getenv('CARD_CACHE_SIZE', '50000'))
+
+# Allowed ages (registration and age-range preferences)
+MIN_AGE = 18
+MAX_AGE = 100
+
+# Share of browse picks drawn from the same city, same country and anywhere
+LOCATION_TIER_WEIGHTS = (0.7, 0.2, 0.1)
+
+# Candidate ranking: how many candidates are sampled and scored per browse, how many
+# of the best are kept, and the weight of each scorer in utils/ranking.py
+RANKING_SAMPLE_SIZE = 200
+RANKING_TOP_K = 5
+RANKING_WEIGHTS = {
+    'reciprocal_interest': 3.0,
+    'age_proximity': 1.0,
+    'boost': 2.0,
+    'recency': 1.5,
+    'liked_viewer': 4.0
+}
+
+# Last-active stamps are written at most once per interval (seconds) per user;
+# users idle longer than ACTIVE_WITHIN_DAYS are only shown once active ones run out
+ACTIVITY_FLUSH_INTERVAL = 60
+ACTIVE_WITHIN_DAYS = 30
+
+# Prometheus metrics on http://METRICS_LISTEN:METRICS_PORT/metrics (0 disables; worker
+# processes use METRICS_PORT + their index)
+METRICS_LISTEN = os.getenv('METRICS_LISTEN', '127.0.0.1')
+METRICS_PORT = int(os.getenv('METRICS_PORT', '0'))
+
+# Slow update tracing: every update times its operations and a sample also records
+# individual spans; updates slower than TRACE_SLOW_MS are written to a rotating JSON-lines log
+TRACE_SAMPLE_RATE = float(os.getenv('TRACE_SAMPLE_RATE', '0.05'))
+TRACE_SLOW_MS = float(os.getenv('TRACE_SLOW_MS', '1000'))
+TRACE_SLOW_LOG = os.getenv('TRACE_SLOW_LOG', 'logs/slow_updates.log')
+TRACE_LOG_MAX_BYTES = 10 * 1024 * 1024
+TRACE_LOG_BACKUPS = 5
+TRACE_MAX_SPANS = 500
+
+# Warm-state snapshot (profile index, activity) written on clean shutdown is reused at
+# boot if no data changed since and it is younger than this many seconds
+WARM_STATE_MAX_AGE = float(os.getenv('WARM_STATE_MAX_AGE', '86400'))
+
+# Snapshots taken with /backup or tools/backup.py
+BACKUP_DIR = os.getenv('BACKUP_DIR', 'backups')
+BACKUP_COMPRESSLEVEL = 3
+
+# Bot data compaction (dropping tombstones, keys of deleted users and expired boosts)
+# runs every this many seconds; 0 disables
+COMPACTION_INTERVAL = float(os.getenv('COMPACTION_INTERVAL', '3600'))
+
+# Like notifications are coalesced per recipient and written as one digest every this
+# many seconds (0 writes each like at once); LIKE_DIGEST_PUSH also sends the digest
+LIKE_DIGEST_INTERVAL = float(os.getenv('LIKE_DIGEST_INTERVAL', '3600'))
+LIKE_DIGEST_PUSH = os.getenv('LIKE_DIGEST_PUSH', '').lower() in ('1', 'true', 'yes')
+
+# Registrations not finished within this many seconds of the last answer start over
+REGISTRATION_DRAFT_TTL = float(os.getenv('REGISTRATION_DRAFT_TTL', '86400'))
+
+# Relayed chat messages are kept for report review in per-conversation logs of segments
+# up to TRANSCRIPT_SEGMENT_BYTES, at most TRANSCRIPT_SESSION_BYTES per direction
+TRANSCRIPT_DIR = os.getenv('TRANSCRIPT_DIR', 'data/transcripts')
+TRANSCRIPT_SEGMENT_BYTES = 256 * 1024
+TRANSCRIPT_SESSION_BYTES = 2 * 1024 * 1024
+TRANSCRIPT_RETENTION_DAYS = float(os.getenv('TRANSCRIPT_RETENTION_DAYS', '30'))
+TRANSCRIPT_REPORT_MESSAGES = 20
+
+# Worker processes; above 1 a supervisor shards users across processes
+WORKERS = int(os.getenv('WORKERS', '1'))
+
 # Premium plans pricing
 PREMIUM_PLANS = {
     'weekly': {
@@ -30,6 +138,9 @@ PREMIUM_PLANS = {
 
 # Bot settings
 FREE_WEEKLY_BROWSE_LIMIT = 10
+MATCHES_PAGE_SIZE = 10
+LIKES_PAGE_SIZE = 20
+PAYMENTS_PAGE_SIZE = 10
 BOOST_DURATION_HOURS = 12
 BOOST_COOLDOWN_HOURS = 48
 
@@ -1,8 +1,23 @@
+import asyncio
+import logging
+import tarfile
+import time
+from typing import Optional
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import ContextTypes
+from telegram.error import TelegramError
 from telegram.constants import ParseMode
 from utils.storage import Storage
-from config import ADMIN_ID
+from utils import storage as storage_module
+from utils.outbound import Priority
+from utils.activity import activity
+from utils import backup, sharding
+from utils.flood import limiter
+from utils.transcripts import transcripts, PHOTO
+from handlers import matching
+from config import ADMIN_ID, BROADCAST_BATCH_SIZE, BACKUP_DIR, BACKUP_COMPRESSLEVEL, TRANSCRIPT_REPORT_MESSAGES
+
+logger = logging.getLogger(__name__)
 
 storage = Storage()
 
@@ -35,7 +50,7 @@ async def show_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     
     if user_id != ADMIN_ID:
-        await update.message.reply_text("⛔ You are not authorized.")
+        await update.effective_message.reply_text("⛔ You are not authorized.")
         return
     
     # Get statistics
@@ -45,38 +60,49 @@ async def show_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
     premium_users = len([u for u in all_users if u.get('is_premium')])
     male_users = len([u for u in all_users if u.get('gender') == 'Male'])
     female_users = len([u for u in all_users if u.get('gender') == 'Female'])
+    active_day = activity.count_active(all_users, 1)
+    active_week = activity.count_active(all_users, 7)
     
     banned_users = storage.get_bot_property('banned_users') or []
     total_banned = len(banned_users)
     
     reports = storage.get_bot_property('user_reports') or []
     pending_reports = len(reports)
+    pending_payments = len(storage.get_bot_property('pending_payments') or {})
     
     message = f"""📊 *Bot Statistics*
 
 👥 Total Users: *{total_users}*
 🌟 Premium Users: *{premium_users}*
 🚫 Banned Users: *{total_banned}*
+🟢 Active Today: *{active_day}*
+📅 Active This Week: *{active_week}*
 
 👨 Male Users: *{male_users}*
 👩 Female Users: *{female_users}*
 
-🚨 Pending Reports: *{pending_reports}*"""
+🚨 Pending Reports: *{pending_reports}*
+💳 Pending Payments: *{pending_payments}*"""
     
-    await update.message.reply_text(message, parse_mode=ParseMode.MARKDOWN)
+    flooders = limiter.top_dropped(5)
+    if flooders:
+        message += "\n\n🌊 *Most Dropped Updates:*\n"
+        message += "\n".join(f"`{flooder_id}`: {count}" for flooder_id, count in flooders)
+    
+    await update.effective_message.reply_text(message, parse_mode=ParseMode.MARKDOWN)
 
 async def view_users(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """View registered users"""
     user_id = update.effective_user.id
     
     if user_id != ADMIN_ID:
-        await update.message.reply_text("⛔ You are not authorized.")
+        await update.effective_message.reply_text("⛔ You are not authorized.")
         return
     
     users = storage.get_all_users()
     
     if not users:
-        await update.message.reply_text("❌ No users found.")
+        await update.effective_message.reply_text("❌ No users found.")
         return
     
     message = "👤 *Registered Users (First 30):*\n\n"
@@ -90,116 +116,148 @@ async def view_users(update: Update, context: ContextTypes.DEFAULT_TYPE):
         
         message += f"{i+1}. {name} ({gender}, Age {age}) [ID: {user_id_display}] {premium}\n"
     
-    await update.message.reply_text(message, parse_mode=ParseMode.MARKDOWN)
+    await update.effective_message.reply_text(message, parse_mode=ParseMode.MARKDOWN)
 
 async def ban_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Ban a user"""
+    """Ban a user (/ban <user_id>, or the ban button of a report)"""
+    query = update.callback_query
     user_id = update.effective_user.id
     
     if user_id != ADMIN_ID:
-        await update.message.reply_text("⛔ You are not authorized.")
+        await update.effective_message.reply_text("⛔ You are not authorized.")
         return
     
-    if not context.args:
-        await update.message.reply_text("Usage: /ban <user_id>")
-        return
-    
-    try:
-        banned_id = int(context.args[0])
-    except ValueError:
-        await update.message.reply_text("❌ Invalid user ID.")
+    from_report = query is not None and query.data.startswith("ban_user_")
+    if from_report:
+        banned_id = int(query.data.split('_')[2])
+    elif not context.args:
+        await update.effective_message.reply_text("Usage: /ban <user_id>")
         return
+    else:
+        try:
+            banned_id = int(context.args[0])
+        except ValueError:
+            await update.effective_message.reply_text("❌ Invalid user ID.")
+            return
     
     # Add to banned list
-    banned_users = storage.get_bot_property('banned_users') or []
-    if banned_id not in banned_users:
-        banned_users.append(banned_id)
-        storage.set_bot_property('banned_users', banned_users)
+    await sharding.add_to_bot_list('banned_users', banned_id)
+    matching.invalidate_prefetch(banned_id)
     
     # Notify the banned user
     try:
         await context.bot.send_message(
             banned_id,
-            "⛔ You have been banned by the admin. You can no longer use this bot."
+            "⛔ You have been banned by the admin. You can no longer use this bot.",
+            rate_limit_args=Priority.NOTIFICATION
         )
-    except:
+    except TelegramError:
         pass
     
-    await update.message.reply_text(f"✅ User {banned_id} has been banned.")
+    if from_report:
+        await _close_report(update, context, f"✅ User {banned_id} has been banned.")
+    else:
+        await update.effective_message.reply_text(f"✅ User {banned_id} has been banned.")
 
 async def unban_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Unban a user"""
     user_id = update.effective_user.id
     
     if user_id != ADMIN_ID:
-        await update.message.reply_text("⛔ You are not authorized.")
+        await update.effective_message.reply_text("⛔ You are not authorized.")
         return
     
     if not context.args:
-        await update.message.reply_text("Usage: /unban <user_id>")
+        await update.effective_message.reply_text("Usage: /unban <user_id>")
         return
     
     try:
         unbanned_id = int(context.args[0])
     except ValueError:
-        await update.message.reply_text("❌ Invalid user ID.")
+        await update.effective_message.reply_text("❌ Invalid user ID.")
         return
     
     # Remove from banned list
-    banned_users = storage.get_bot_property('banned_users') or []
-    if unbanned_id in banned_users:
-        banned_users.remove(unbanned_id)
-        storage.set_bot_property('banned_users', banned_users)
-        
+    if await sharding.remove_from_bot_list('banned_users', unbanned_id):
         # Notify the unbanned user
         try:
             await context.bot.send_message(
                 unbanned_id,
-                "✅ You have been unbanned! You can now use the bot again."
+                "✅ You have been unbanned! You can now use the bot again.",
+                rate_limit_args=Priority.NOTIFICATION
             )
-        except:
+        except TelegramError:
             pass
         
-        await update.message.reply_text(f"✅ User {unbanned_id} has been unbanned.")
+        await update.effective_message.reply_text(f"✅ User {unbanned_id} has been unbanned.")
     else:
-        await update.message.reply_text(f"❌ User {unbanned_id} is not banned.")
+        await update.effective_message.reply_text(f"❌ User {unbanned_id} is not banned.")
 
 async def broadcast_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Broadcast message to all users"""
     user_id = update.effective_user.id
     
     if user_id != ADMIN_ID:
-        await update.message.reply_text("⛔ You are not authorized.")
+        await update.effective_message.reply_text("⛔ You are not authorized.")
         return
     
     if not context.args:
-        await update.message.reply_text("Usage: /broadcast <message>")
+        await update.effective_message.reply_text("Usage: /broadcast [-days N] <message>")
         return
     
-    message = ' '.join(context.args)
+    # Optionally target only users active within the last N days
+    args = list(context.args)
+    active_days = None
+    if args[0] == '-days' and len(args) > 2:
+        try:
+            active_days = float(args[1])
+        except ValueError:
+            await update.effective_message.reply_text("❌ Invalid number of days.")
+            return
+        args = args[2:]
+    
+    message = ' '.join(args)
+    await update.effective_message.reply_text("📢 Broadcast started. You'll get a summary when it finishes.")
+    # Sending at the outbound rate takes a long time for a large audience; doing it here
+    # would hold the admin's lock and unit of work, queueing their other updates behind it
+    context.application.create_task(_run_broadcast(context.bot, user_id, message, active_days))
+
+async def _run_broadcast(bot, chat_id: int, message: str, active_days: Optional[float]):
+    """Send a broadcast in the background, then report the totals to the admin"""
+    storage.detach_unit_of_work()
     users = storage.get_all_users()
+    if active_days is not None:
+        users = [u for u in users if u.get('user_id') and activity.is_active(u['user_id'], active_days, u)]
     banned_users = storage.get_bot_property('banned_users') or []
     
     sent_count = 0
     failed_count = 0
     
-    await update.message.reply_text(f"📢 Broadcasting to {len(users)} users...")
-    
-    for user_data in users:
-        target_id = user_data.get('user_id')
-        if target_id and target_id not in banned_users:
-            try:
-                await context.bot.send_message(
-                    target_id,
-                    f"📢 *Admin Broadcast:*\n\n{message}",
-                    parse_mode=ParseMode.MARKDOWN
-                )
-                sent_count += 1
-            except:
-                failed_count += 1
+    await bot.send_message(chat_id, f"📢 Broadcasting to {len(users)} users...", rate_limit_args=Priority.NOTIFICATION)
     
-    await update.message.reply_text(
-        f"✅ Broadcast complete!\n\n📤 Sent: {sent_count}\n❌ Failed: {failed_count}"
+    async def send(target_id: int) -> bool:
+        try:
+            await bot.send_message(
+                target_id,
+                f"📢 *Admin Broadcast:*\n\n{message}",
+                parse_mode=ParseMode.MARKDOWN,
+                rate_limit_args=Priority.BROADCAST
+            )
+            return True
+        except TelegramError:
+            return False
+    
+    # Queue a batch at a time; the outbound scheduler paces them behind interactive traffic
+    targets = [u.get('user_id') for u in users if u.get('user_id') and u.get('user_id') not in banned_users]
+    for i in range(0, len(targets), BROADCAST_BATCH_SIZE):
+        results = await asyncio.gather(*(send(t) for t in targets[i:i + BROADCAST_BATCH_SIZE]))
+        sent_count += sum(results)
+        failed_count += len(results) - sum(results)
+    
+    await bot.send_message(
+        chat_id,
+        f"✅ Broadcast complete!\n\n📤 Sent: {sent_count}\n❌ Failed: {failed_count}",
+        rate_limit_args=Priority.NOTIFICATION
     )
 
 async def view_reports(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -207,13 +265,13 @@ async def view_reports(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     
     if user_id != ADMIN_ID:
-        await update.message.reply_text("⛔ You are not authorized.")
+        await update.effective_message.reply_text("⛔ You are not authorized.")
         return
     
     reports = storage.get_bot_property('user_reports') or []
     
     if not reports:
-        await update.message.reply_text("✅ No pending reports.")
+        await update.effective_message.reply_text("✅ No pending reports.")
         return
     
     # Show first report
@@ -223,7 +281,6 @@ async def view_reports(update: Update, context: ContextTypes.DEFAULT_TYPE):
     reason = report.get('reason', 'No reason provided')
     timestamp = report.get('timestamp', 0)
     
-    import time
     report_time = time.strftime('%Y-%m-%d %H:%M', time.localtime(timestamp))
     
     # Get user data
@@ -249,11 +306,32 @@ async def view_reports(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 Remaining reports: {len(reports)}"""
     
-    await update.message.reply_text(
+    await update.effective_message.reply_text(
         message,
         parse_mode=ParseMode.MARKDOWN,
         reply_markup=reply_markup
     )
+    
+    # Last messages of the conversation up to the report, from the transcript log;
+    # sent as plain text since they are user input
+    messages = transcripts.conversation(reporter_id, reported_id, TRANSCRIPT_REPORT_MESSAGES, before=timestamp + 1)
+    await update.effective_message.reply_text(_transcript_text(messages, reporter_id))
+
+def _transcript_text(messages, reporter_id: int) -> str:
+    if not messages:
+        return "💬 No transcript on record for this conversation."
+    lines = [f"💬 Last {len(messages)} messages before the report:", ""]
+    for message in messages:
+        sent = time.strftime('%m-%d %H:%M', time.localtime(message['ts']))
+        sender = "Reporter" if message['sender'] == reporter_id else "Reported"
+        if message['kind'] == PHOTO:
+            text = f"📸 {message['text']}" + (f" {message['caption']}" if message['caption'] else "")
+        else:
+            text = message['text']
+        if len(text) > 300:
+            text = text[:300] + "…"
+        lines.append(f"[{sent}] {sender}: {text}")
+    return "\n".join(lines)[:4000]
 
 async def warn_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Warn a reported user"""
@@ -267,31 +345,19 @@ async def warn_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
     warned_id = int(query.data.split('_')[2])
     
     # Add to warned users
-    warned_users = storage.get_bot_property('warned_users') or []
-    if warned_id not in warned_users:
-        warned_users.append(warned_id)
-        storage.set_bot_property('warned_users', warned_users)
+    await sharding.add_to_bot_list('warned_users', warned_id)
     
     # Notify user
     try:
         await context.bot.send_message(
             warned_id,
-            "⚠️ You have been warned by the admin. Repeated violations will lead to a ban. Please follow the rules."
+            "⚠️ You have been warned by the admin. Repeated violations will lead to a ban. Please follow the rules.",
+            rate_limit_args=Priority.NOTIFICATION
         )
-    except:
+    except TelegramError:
         pass
     
-    # Remove report
-    reports = storage.get_bot_property('user_reports') or []
-    if reports:
-        reports.pop(0)
-        storage.set_bot_property('user_reports', reports)
-    
-    await query.edit_message_text(f"✅ User {warned_id} has been warned.")
-    
-    # Show next report if available
-    if reports:
-        await view_reports(update, context)
+    await _close_report(update, context, f"✅ User {warned_id} has been warned.")
 
 async def dismiss_report(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Dismiss a report"""
@@ -302,14 +368,59 @@ async def dismiss_report(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await query.answer("❌ Unauthorized", show_alert=True)
         return
     
-    # Remove report
+    await _close_report(update, context, "✅ Report dismissed.")
+
+async def _close_report(update: Update, context: ContextTypes.DEFAULT_TYPE, text: str):
+    """Remove the report shown (the first) and show the next one"""
+    # Reports filed meanwhile stay behind it
     reports = storage.get_bot_property('user_reports') or []
     if reports:
-        reports.pop(0)
-        storage.set_bot_property('user_reports', reports)
+        await sharding.remove_from_bot_list('user_reports', reports[0])
+        reports = reports[1:]
     
-    await query.edit_message_text("✅ Report dismissed.")
+    await update.callback_query.edit_message_text(text)
     
     # Show next report if available
     if reports:
         await view_reports(update, context)
+
+async def backup_data(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Take a consistent snapshot of the store in the background (/backup [inc])"""
+    user_id = update.effective_user.id
+    
+    if user_id != ADMIN_ID:
+        await update.message.reply_text("⛔ You are not authorized.")
+        return
+    
+    if storage_module.get_router() is not None:
+        # This process can only hold back its own writes; the other workers keep writing
+        # while the archiver runs, so the archive wouldn't be one point in time
+        await update.message.reply_text(
+            "❌ /backup can't take a consistent snapshot while several workers run. "
+            "Stop the bot and run: python -m tools.backup snapshot"
+        )
+        return
+    
+    incremental = bool(context.args) and context.args[0].lower() in ('inc', 'incremental')
+    await update.message.reply_text(f"💾 Taking {'an incremental' if incremental else 'a full'} snapshot...")
+    context.application.create_task(_run_backup(context.bot, user_id, incremental))
+
+async def _run_backup(bot, chat_id: int, incremental: bool):
+    """Write the snapshot while updates keep being processed, then report to the admin"""
+    storage.detach_unit_of_work()
+    try:
+        manifest = await backup.create_online(storage.data_dir, BACKUP_DIR, incremental, BACKUP_COMPRESSLEVEL)
+    except (OSError, tarfile.TarError, RuntimeError) as e:
+        logger.exception("Snapshot failed")
+        await bot.send_message(chat_id, f"❌ Snapshot failed: {e}", rate_limit_args=Priority.NOTIFICATION)
+        return
+    
+    size_mb = manifest['archive_bytes'] / (1024 * 1024)
+    await bot.send_message(
+        chat_id,
+        f"✅ Snapshot *{manifest['id']}*\n\n"
+        f"📁 Files: {manifest['files_included']} of {manifest['files_total']} ({manifest['type']})\n"
+        f"📦 Archive: {size_mb:.1f} MB",
+        parse_mode=ParseMode.MARKDOWN,
+        rate_limit_args=Priority.NOTIFICATION
+    )
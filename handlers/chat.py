@@ -1,9 +1,15 @@
+import time
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import ContextTypes
+from telegram.error import TelegramError
 from telegram.constants import ParseMode
 from utils.storage import Storage
-from utils.helpers import contains_banned_words, add_notification
-from config import ADMIN_ID
+from utils.outbound import Priority
+from utils.transcripts import transcripts, TEXT, PHOTO
+from utils import sharding
+from handlers import matching
+from utils.helpers import contains_banned_words, add_notification, callback_page, paginate, page_buttons
+from config import ADMIN_ID, MATCHES_PAGE_SIZE, TRANSCRIPT_REPORT_MESSAGES
 
 storage = Storage()
 
@@ -20,15 +26,23 @@ async def show_chats(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     
     # Build chat list
+    shown, page, pages = paginate(matches, callback_page(query.data), MATCHES_PAGE_SIZE)
     message = "💬 *Your Chats:*\n\nSelect someone to start chatting:\n\n"
+    if pages > 1:
+        message += f"📄 Page {page + 1} of {pages}"
     buttons = []
     
-    for match_id in matches[:10]:  # Show first 10
-        match_data = storage.get_user_data(match_id)
+    profiles = storage.get_users_many(shown, fields=('name',))
+    for match_id in shown:
+        match_data = profiles.get(match_id)
         if match_data:
-            name = match_data.get('name', 'Anonymous')
+            name = match_data.get('name') or 'Anonymous'
             buttons.append([InlineKeyboardButton(f"💬 {name}", callback_data=f"start_chat_{match_id}")])
     
+    nav = page_buttons("my_chats", page, pages)
+    if nav:
+        buttons.append(nav)
+    
     reply_markup = InlineKeyboardMarkup(buttons)
     
     await query.edit_message_text(
@@ -71,15 +85,20 @@ async def start_chat(update: Update, context: ContextTypes.DEFAULT_TYPE):
         reply_markup=reply_markup
     )
     
-    # Notify partner
+    # Notify partner; their report button reports us
+    partner_keyboard = [
+        [InlineKeyboardButton("🚫 Report User", callback_data=f"report_{user_id}")],
+        [InlineKeyboardButton("❌ End Chat", callback_data="end_chat")]
+    ]
     try:
         await context.bot.send_message(
             partner_id,
             f"💬 *{user_name} started a chat with you!*\n\nYou can now send messages. Be respectful!\n\n🔒 This is an anonymous chat.",
             parse_mode=ParseMode.MARKDOWN,
-            reply_markup=reply_markup
+            reply_markup=InlineKeyboardMarkup(partner_keyboard),
+            rate_limit_args=Priority.NOTIFICATION
         )
-    except:
+    except TelegramError:
         pass  # Partner might have blocked the bot
 
 async def handle_chat_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -91,14 +110,14 @@ async def handle_chat_message(update: Update, context: ContextTypes.DEFAULT_TYPE
         return
     
     message_text = update.message.text
+    # Kept for report review, including a message that gets its sender banned
+    transcripts.append(user_id, partner_id, TEXT, message_text)
     
     # Check for banned words
     if contains_banned_words(message_text):
         # Ban user and end chat
-        banned_users = storage.get_bot_property('banned_users') or []
-        if user_id not in banned_users:
-            banned_users.append(user_id)
-            storage.set_bot_property('banned_users', banned_users)
+        await sharding.add_to_bot_list('banned_users', user_id)
+        matching.invalidate_prefetch(user_id)
         
         # End chat for both users
         storage.set_bot_property(f"chat_{user_id}", None)
@@ -109,18 +128,20 @@ async def handle_chat_message(update: Update, context: ContextTypes.DEFAULT_TYPE
         try:
             await context.bot.send_message(
                 partner_id,
-                "⚠️ Chat ended due to offensive content from the other user."
+                "⚠️ Chat ended due to offensive content from the other user.",
+                rate_limit_args=Priority.NOTIFICATION
             )
-        except:
+        except TelegramError:
             pass
         
         # Notify admin
         try:
             await context.bot.send_message(
                 ADMIN_ID,
-                f"🚨 User {user_id} auto-banned for offensive message: \"{message_text}\""
+                f"🚨 User {user_id} auto-banned for offensive message: \"{message_text}\"",
+                rate_limit_args=Priority.NOTIFICATION
             )
-        except:
+        except TelegramError:
             pass
         
         return
@@ -134,9 +155,10 @@ async def handle_chat_message(update: Update, context: ContextTypes.DEFAULT_TYPE
             partner_id,
             f"💌 *Anonymous message:*\n\n{message_text}",
             parse_mode=ParseMode.MARKDOWN,
-            reply_markup=reply_markup
+            reply_markup=reply_markup,
+            rate_limit_args=Priority.CHAT_RELAY
         )
-    except:
+    except TelegramError:
         await update.message.reply_text("❌ Failed to send message. The user might have blocked the bot.")
 
 async def handle_chat_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -149,6 +171,7 @@ async def handle_chat_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     photo = update.message.photo[-1]
     caption = update.message.caption or ""
+    transcripts.append(user_id, partner_id, PHOTO, photo.file_id, caption)
     
     # Forward photo with reply button
     keyboard = [[InlineKeyboardButton("💬 Reply", callback_data=f"reply_{user_id}")]]
@@ -160,9 +183,10 @@ async def handle_chat_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
             photo=photo.file_id,
             caption=f"📸 *Anonymous photo:*\n\n{caption}" if caption else "📸 *Anonymous photo*",
             parse_mode=ParseMode.MARKDOWN,
-            reply_markup=reply_markup
+            reply_markup=reply_markup,
+            rate_limit_args=Priority.CHAT_RELAY
         )
-    except:
+    except TelegramError:
         await update.message.reply_text("❌ Failed to send photo. The user might have blocked the bot.")
 
 async def end_chat(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -183,8 +207,8 @@ async def end_chat(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     # Notify partner
     try:
-        await context.bot.send_message(partner_id, "💔 The other user ended the chat.")
-    except:
+        await context.bot.send_message(partner_id, "💔 The other user ended the chat.", rate_limit_args=Priority.NOTIFICATION)
+    except TelegramError:
         pass
 
 async def report_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -194,15 +218,16 @@ async def report_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
     reported_id = int(query.data.split('_')[1])
     
     # Save report
-    reports = storage.get_bot_property('user_reports') or []
     report = {
         'reporter_id': user_id,
         'reported_id': reported_id,
         'timestamp': int(time.time()),
         'reason': 'General misconduct'
     }
-    reports.append(report)
-    storage.set_bot_property('user_reports', reports)
+    # The conversation itself stays in the transcript log; the admin reads the messages up
+    # to the report's timestamp from there
+    report['transcript_messages'] = len(transcripts.conversation(user_id, reported_id, TRANSCRIPT_REPORT_MESSAGES))
+    await sharding.add_to_bot_list('user_reports', report)
     
     # End chat
     storage.set_bot_property(f"chat_{user_id}", None)
@@ -214,7 +239,9 @@ async def report_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
         await context.bot.send_message(
             ADMIN_ID,
-            f"🚨 New report:\nReporter: {user_id}\nReported: {reported_id}\nReason: General misconduct"
+            f"🚨 New report:\nReporter: {user_id}\nReported: {reported_id}\nReason: General misconduct\n"
+            f"Messages on record: {report['transcript_messages']}",
+            rate_limit_args=Priority.NOTIFICATION
         )
-    except:
+    except TelegramError:
         pass
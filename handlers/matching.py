@@ -1,9 +1,21 @@
 import random
+from typing import Dict, Optional, Set, Tuple
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import ContextTypes
 from telegram.constants import ParseMode
 from utils.storage import Storage
-from utils.helpers import get_current_week, filter_profiles_by_interest, shuffle_list, add_notification
+from utils.helpers import get_current_week, add_notification, callback_page, paginate, page_buttons
+from utils.location import normalize_location
+from utils.profile_index import profile_index, profile_age, add_change_listener, ANYWHERE
+from utils import ranking, tracing
+from utils.activity import activity
+from utils.digests import like_digests
+from config import (
+    LOCATION_TIER_WEIGHTS, MIN_AGE, MAX_AGE, RANKING_SAMPLE_SIZE, RANKING_TOP_K, ACTIVE_WITHIN_DAYS,
+    MATCHES_PAGE_SIZE, LIKES_PAGE_SIZE
+)
+from utils.locks import pair_locks
+from utils import sharding, cards
 
 storage = Storage()
 
@@ -53,150 +65,271 @@ async def find_match(update: Update, context: ContextTypes.DEFAULT_TYPE):
         storage.set_user_property(user_id, 'weekly_browse_count', browse_count)
         storage.set_user_property(user_id, 'last_browse_week', current_week)
     
-    # Get all profiles
-    all_profiles = storage.get_profiles()
-    
-    if not all_profiles:
-        await context.bot.send_message(chat_id, "⚠️ No profiles found. Please try again later.")
-        return
-    
-    # Filter profiles based on interest
-    candidates = filter_profiles_by_interest(all_profiles, my_gender, my_interest, user_id)
-    
-    if not candidates:
-        await context.bot.send_message(chat_id, "😔 No available profiles right now. Try again later!")
-        return
-    
-    # Get last shown profile to avoid repeats
-    last_shown_id = user_data.get('last_shown_match', 0)
-    
-    # Shuffle and find next profile
-    shuffled = shuffle_list(candidates)
-    next_profile = None
-    
-    for profile in shuffled:
-        if profile['id'] != last_shown_id:
-            next_profile = profile
-            break
-    
-    if not next_profile:
-        next_profile = shuffled[0]  # Fallback to first profile
+    # Serve the candidate reserved in the background after the previous card, if still valid
+    prefetched = take_prefetched(user_id, user_data)
+    if prefetched:
+        next_profile, card = prefetched['profile'], prefetched['card']
+    else:
+        next_profile, error = select_candidate(user_id, user_data, user_data.get('last_shown_match', 0))
+        if not next_profile:
+            await context.bot.send_message(chat_id, error)
+            return
+        
+        # Rendered once per profile version; only the keyboard depends on the viewer
+        card = cards.match_card(next_profile)
     
     # Update last shown
     storage.set_user_property(user_id, 'last_shown_match', next_profile['id'])
     
-    # Build profile message
-    name = next_profile['name']
-    age = next_profile['age']
-    gender = next_profile['gender']
-    bio = next_profile['bio']
-    location = next_profile['location']
-    username = next_profile.get('username', '')
-    
-    caption = f"""💘 *Match Found!*
-🧑 Name: *{name}*
-🚻 Gender: *{gender}*
-🎂 Age: *{age}*
-📍 Location: *{location}*
-📝 Bio: {bio}
-
-🎉😍"""
-    
-    # Build buttons
-    buttons = [
-        [
-            InlineKeyboardButton("❤️ Like", callback_data=f"like_{next_profile['id']}"),
-            InlineKeyboardButton("❌ Pass", callback_data="find_match")
-        ]
-    ]
-    
-    if is_premium and username:
-        buttons.append([InlineKeyboardButton("💬 Chat", url=f"https://t.me/{username}")])
-    elif not is_premium:
-        buttons.append([InlineKeyboardButton("🔒 Upgrade to Premium to Chat", callback_data="upgrade")])
-    
-    reply_markup = InlineKeyboardMarkup(buttons)
+    reply_markup = card.markup(is_premium)
     
     # Send profile
-    photo_id = next_profile.get('photo')
-    if photo_id:
+    if card.photo:
         await context.bot.send_photo(
             chat_id=chat_id,
-            photo=photo_id,
-            caption=caption,
-            parse_mode=ParseMode.MARKDOWN,
+            photo=card.photo,
+            caption=card.caption,
+            parse_mode=card.parse_mode,
             reply_markup=reply_markup
         )
     else:
         await context.bot.send_message(
             chat_id,
-            caption,
-            parse_mode=ParseMode.MARKDOWN,
+            card.caption,
+            parse_mode=card.parse_mode,
             reply_markup=reply_markup
         )
 
-async def like_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Handle user like action"""
-    query = update.callback_query
-    user_id = query.from_user.id
-    liked_user_id = int(query.data.split('_')[1])
+    # Line up the next candidate while the user looks at this one
+    context.application.create_task(prefetch_next(user_id, next_profile['id']))
+
+def select_candidate(user_id: int, user_data: Dict, last_shown_id: int) -> Tuple[Optional[Dict], str]:
+    """Pick the next profile to show; returns (profile, None) or (None, message for the user)"""
+    if not profile_index.all_ids():
+        return None, "⚠️ No profiles found. Please try again later."
+    
+    # Filter profiles based on interest and age range, skipping the viewer, repeats, banned users
+    # and people the viewer already liked or matched with
+    banned_users = set(storage.get_bot_property('banned_users') or [])
+    decided = set(user_data.get('liked_users') or []) | set(storage.get_bot_property(f"matches_{user_id}") or [])
+    excluded = banned_users | decided | {user_id, last_shown_id}
+    genders = profile_index.genders(user_data.get('interest'))
+    min_age, max_age = get_age_range(user_data)
+    
+    # Locality tiers: same city, same country, anywhere
+    city, country = normalize_location(user_data.get('location'))
+    tiers = [(f"city:{city}" if city else None, LOCATION_TIER_WEIGHTS[0]),
+             (f"country:{country}" if country else None, LOCATION_TIER_WEIGHTS[1]),
+             (ANYWHERE, LOCATION_TIER_WEIGHTS[2])]
+    tiers = [(token, weight) for token, weight in tiers if token]
+    
+    # Recently active people are sampled; dormant accounts are only used if none are left
+    sample, dormant = [], []
+    def consider(profile: Dict):
+        seen.add(profile['id'])
+        if activity.is_active(profile['id'], ACTIVE_WITHIN_DAYS, profile):
+            sample.append(profile)
+        else:
+            dormant.append(profile)
+    
+    # People who already liked the viewer are always considered (most recent first)
+    liked_by = storage.get_bot_property(f"likes_{user_id}") or []
+    seen = set(excluded)
+    for liker_id in reversed(liked_by[-RANKING_SAMPLE_SIZE:]):
+        profile = profile_index.get(liker_id)
+        if (profile and liker_id not in seen and profile['gender'] in genders
+                and min_age <= profile_age(profile) <= max_age):
+            consider(profile)
+    
+    # Then a bounded sample, mostly local with a share of wider results so small cities
+    # don't run dry; ranking cost stays fixed however large the pool is
+    while len(sample) < RANKING_SAMPLE_SIZE and len(dormant) < RANKING_SAMPLE_SIZE and tiers:
+        index = random.choices(range(len(tiers)), weights=[weight for _, weight in tiers])[0]
+        candidate_id = profile_index.sample(genders, tiers[index][0], min_age, max_age, seen)
+        if candidate_id is None:
+            del tiers[index]
+            continue
+        consider(profile_index.get(candidate_id))
+    
+    if sample or dormant:
+        signals = ranking.RankingSignals(user_id, user_data, set(liked_by))
+        return random.choice(ranking.top_k(sample or dormant, signals, RANKING_TOP_K)), None
+    
+    # Only the last shown profile is left
+    if last_shown_id not in banned_users and last_shown_id not in decided and last_shown_id != user_id:
+        if last_shown_id in profile_index.candidate_ids(genders, ANYWHERE, min_age, max_age):
+            return profile_index.get(last_shown_id), None
+    return None, "😔 No available profiles right now. Try again later!"
+
+def get_age_range(user_data: Dict) -> Tuple[int, int]:
+    """Viewer's preferred partner age range"""
+    return user_data.get('age_min') or MIN_AGE, user_data.get('age_max') or MAX_AGE
+
+async def set_age_range(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Set preferred partner age range: /agerange <min> <max>"""
+    user_id = update.effective_user.id
+    
+    # Commands skip button_handler's checks, so do them here
+    if user_id in (storage.get_bot_property('banned_users') or []):
+        await update.message.reply_text("⛔ You are banned from using this bot.")
+        return
     
-    # Get user data
     user_data = storage.get_user_data(user_id)
-    user_name = user_data.get('name', 'Someone')
+    if not user_data.get('is_registered'):
+        await update.message.reply_text("❗ Please complete your profile first.")
+        return
     
-    # Add to liked users list
-    liked_users = user_data.get('liked_users', [])
-    if liked_user_id not in liked_users:
-        liked_users.append(liked_user_id)
-        storage.set_user_property(user_id, 'liked_users', liked_users)
+    try:
+        min_age, max_age = (int(arg) for arg in context.args)
+        if not MIN_AGE <= min_age <= max_age <= MAX_AGE:
+            raise ValueError
+    except ValueError:
+        min_age, max_age = get_age_range(user_data)
+        await update.message.reply_text(
+            f"Usage: /agerange <min> <max> (between {MIN_AGE} and {MAX_AGE})\n\n"
+            f"🎯 Current range: {min_age}–{max_age}"
+        )
+        return
     
-    # Add to the other user's likes list
-    other_user_likes = storage.get_bot_property(f"likes_{liked_user_id}") or []
-    if user_id not in other_user_likes:
-        other_user_likes.append(user_id)
-        storage.set_bot_property(f"likes_{liked_user_id}", other_user_likes)
+    storage.set_user_property(user_id, 'age_min', min_age)
+    storage.set_user_property(user_id, 'age_max', max_age)
     
-    # Check if it's a match (both users liked each other)
-    other_user_data = storage.get_user_data(liked_user_id)
-    other_user_liked = other_user_data.get('liked_users', [])
+    await update.message.reply_text(f"✅ You'll now see people aged {min_age}–{max_age}.")
+
+# Next candidate reserved for each viewer: viewer id -> {'profile', 'card', 'prefs'}
+_prefetched: Dict[int, Dict] = {}
+# Candidate id -> viewers holding it, so a candidate change drops every reservation
+_prefetched_by_candidate: Dict[int, Set[int]] = {}
+
+def _match_prefs(user_data: Dict) -> Tuple:
+    """Viewer settings a reservation was computed for"""
+    return user_data.get('gender'), user_data.get('interest'), user_data.get('location'), get_age_range(user_data)
+
+def _drop_prefetched(user_id: int) -> Optional[Dict]:
+    entry = _prefetched.pop(user_id, None)
+    if entry:
+        viewers = _prefetched_by_candidate.get(entry['profile']['id'])
+        if viewers:
+            viewers.discard(user_id)
+            if not viewers:
+                del _prefetched_by_candidate[entry['profile']['id']]
+    return entry
+
+async def prefetch_next(user_id: int, shown_id: int):
+    """Compute and reserve the viewer's next candidate and its card"""
+    # Runs after the update finished; read outside its (already flushed) unit of work and trace
+    storage.detach_unit_of_work()
+    tracing.detach()
+    
+    user_data = storage.get_user_data(user_id)
+    profile, _ = select_candidate(user_id, user_data, shown_id)
+    _drop_prefetched(user_id)
+    if not profile:
+        return
+    
+    _prefetched[user_id] = {
+        'profile': profile,
+        'card': cards.match_card(profile),
+        'prefs': _match_prefs(user_data)
+    }
+    _prefetched_by_candidate.setdefault(profile['id'], set()).add(user_id)
+
+def take_prefetched(user_id: int, user_data: Dict) -> Optional[Dict]:
+    """Claim the viewer's reserved candidate if it is still valid"""
+    entry = _drop_prefetched(user_id)
+    if not entry or entry['prefs'] != _match_prefs(user_data):
+        return None
+    if entry['profile']['id'] in (storage.get_bot_property('banned_users') or []):
+        return None
+    if entry['profile']['id'] in (user_data.get('liked_users') or []):
+        return None
+    return entry
+
+def invalidate_prefetch(user_id: int):
+    """Drop reservations held by or pointing at a user (ban, profile or preference change)"""
+    _drop_prefetched(user_id)
+    for viewer_id in _prefetched_by_candidate.pop(user_id, set()):
+        _prefetched.pop(viewer_id, None)
+
+# Any write of a profile or matching field, announced to every worker by the profile index
+add_change_listener(lambda user_id, profile: invalidate_prefetch(user_id))
+
+async def like_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handle user like action"""
+    query = update.callback_query
+    user_id = query.from_user.id
+    liked_user_id = int(query.data.split('_')[1])
     
-    if user_id in other_user_liked:
-        # It's a match!
-        await handle_match(user_id, liked_user_id, user_name, other_user_data.get('name', 'Someone'))
+    # Likes and matches are shared by both users; concurrent likes of the same pair must not
+    # interleave or a mutual like could go unnoticed
+    async with pair_locks.hold(user_id, liked_user_id):
+        # Get user data
+        user_data = storage.get_user_data(user_id)
+        user_name = user_data.get('name', 'Someone')
+        
+        # Add to liked users list
+        liked_users = user_data.get('liked_users', [])
+        if liked_user_id not in liked_users:
+            liked_users.append(liked_user_id)
+            storage.set_user_property(user_id, 'liked_users', liked_users)
+        
+        # Record the like on the other user's side (their worker in multi-process mode)
+        result = await sharding.call(liked_user_id, 'record_like', user_id=user_id,
+                                     liked_user_id=liked_user_id, user_name=user_name)
+        is_match = bool(result and result['match'])
         
+        if is_match:
+            # It's a match!
+            await handle_match(user_id, liked_user_id, user_name, result['name'])
+    
+    if is_match:
         await query.edit_message_text(
             "🎉 *IT'S A MATCH!* 💕\n\nYou both liked each other! Check your matches to start chatting.",
             parse_mode=ParseMode.MARKDOWN
         )
     else:
-        # Just a like
-        add_notification(liked_user_id, f"❤️ {user_name} liked your profile!")
-        
         await query.edit_message_text("❤️ Like sent! Looking for more matches...")
         
         # Show next match
         await find_match(update, context)
 
-async def handle_match(user1_id: int, user2_id: int, user1_name: str, user2_name: str):
-    """Handle when two users match"""
-    import time
-    
-    # Add to matches for both users
-    user1_matches = storage.get_bot_property(f"matches_{user1_id}") or []
-    user2_matches = storage.get_bot_property(f"matches_{user2_id}") or []
+@sharding.remote
+def record_like(user_id: int, liked_user_id: int, user_name: str) -> Dict:
+    """Record a like on the liked user's side and report whether it completes a match"""
+    # Add to the other user's likes list
+    other_user_likes = storage.get_bot_property(f"likes_{liked_user_id}") or []
+    if user_id not in other_user_likes:
+        other_user_likes.append(user_id)
+        storage.set_bot_property(f"likes_{liked_user_id}", other_user_likes)
     
-    if user2_id not in user1_matches:
-        user1_matches.append(user2_id)
-        storage.set_bot_property(f"matches_{user1_id}", user1_matches)
+    # Check if it's a match (both users liked each other)
+    other_user_data = storage.get_user_data(liked_user_id)
+    other_user_liked = other_user_data.get('liked_users', [])
+    is_match = user_id in other_user_liked
     
-    if user1_id not in user2_matches:
-        user2_matches.append(user1_id)
-        storage.set_bot_property(f"matches_{user2_id}", user2_matches)
+    if is_match:
+        record_match(liked_user_id, user_id, user_name)
+    else:
+        # Just a like; coalesced into the next digest rather than written now
+        like_digests.add(liked_user_id, user_id, user_name)
     
-    # Add notifications
-    add_notification(user1_id, f"🎉 You matched with {user2_name}!")
-    add_notification(user2_id, f"🎉 You matched with {user1_name}!")
+    return {'match': is_match, 'name': other_user_data.get('name', 'Someone')}
+
+@sharding.remote
+def record_match(user_id: int, match_id: int, match_name: str):
+    """Add a match to one user's side (idempotent, so a match is only announced once)"""
+    matches = storage.get_bot_property(f"matches_{user_id}") or []
+    if match_id not in matches:
+        matches.append(match_id)
+        storage.set_bot_property(f"matches_{user_id}", matches)
+        like_digests.discard(user_id, match_id)
+        add_notification(user_id, f"🎉 You matched with {match_name}!")
+
+async def handle_match(user1_id: int, user2_id: int, user1_name: str, user2_name: str):
+    """Handle when two users match (callers hold the pair lock)"""
+    # Add to matches for both users, each on the worker that owns them
+    sharding.cast(user1_id, 'record_match', user_id=user1_id, match_id=user2_id, match_name=user2_name)
+    sharding.cast(user2_id, 'record_match', user_id=user2_id, match_id=user1_id, match_name=user1_name)
 
 async def view_matches(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """View user's matches"""
@@ -224,18 +357,27 @@ async def view_matches(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     
     # Build matches message
+    shown, page, pages = paginate(matches, callback_page(query.data), MATCHES_PAGE_SIZE)
     message = "💕 *Your Matches:*\n\n"
     buttons = []
     
-    for i, match_id in enumerate(matches[:10]):  # Show first 10 matches
-        match_data = storage.get_user_data(match_id)
+    profiles = storage.get_users_many(shown, fields=('name', 'age'))
+    for i, match_id in enumerate(shown, start=page * MATCHES_PAGE_SIZE):
+        match_data = profiles.get(match_id)
         if match_data:
-            name = match_data.get('name', 'Anonymous')
-            age = match_data.get('age', '?')
+            name = match_data.get('name') or 'Anonymous'
+            age = match_data.get('age') or '?'
             message += f"{i+1}. {name}, {age}\n"
             
             buttons.append([InlineKeyboardButton(f"💬 Chat with {name}", callback_data=f"start_chat_{match_id}")])
     
+    if pages > 1:
+        message += f"\n📄 Page {page + 1} of {pages}"
+    
+    nav = page_buttons("view_matches", page, pages)
+    if nav:
+        buttons.append(nav)
+    
     # Mark matches as seen
     storage.set_bot_property(f"seen_matches_{user_id}", len(matches))
     
@@ -273,17 +415,24 @@ async def view_likes(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     
     # Build likes message
+    shown, page, pages = paginate(likes, callback_page(query.data), LIKES_PAGE_SIZE)
     message = "👀 *People who liked your profile:*\n\n"
     
-    for i, liker_id in enumerate(likes[:20]):  # Show first 20 likes
-        liker_data = storage.get_user_data(liker_id)
+    profiles = storage.get_users_many(shown, fields=('name', 'gender', 'age'))
+    for i, liker_id in enumerate(shown, start=page * LIKES_PAGE_SIZE):
+        liker_data = profiles.get(liker_id)
         if liker_data:
-            name = liker_data.get('name', 'Anonymous')
-            gender = liker_data.get('gender', '?')
-            age = liker_data.get('age', '?')
+            name = liker_data.get('name') or 'Anonymous'
+            gender = liker_data.get('gender') or '?'
+            age = liker_data.get('age') or '?'
             message += f"{i+1}. {name} — 🧍 {gender}, 🎂 {age}\n"
+    if pages > 1:
+        message += f"\n📄 Page {page + 1} of {pages}"
     
     # Mark likes as seen
     storage.set_bot_property(f"seen_likes_{user_id}", len(likes))
     
-    await query.edit_message_text(message, parse_mode=ParseMode.MARKDOWN)
+    nav = page_buttons("view_likes", page, pages)
+    reply_markup = InlineKeyboardMarkup([nav]) if nav else None
+    
+    await query.edit_message_text(message, parse_mode=ParseMode.MARKDOWN, reply_markup=reply_markup)
@@ -1,10 +1,16 @@
+import asyncio
+import hashlib
 import time
+from typing import Dict, List, Optional, Tuple
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import ContextTypes
+from telegram.error import TelegramError
 from telegram.constants import ParseMode
 from utils.storage import Storage
-from utils.helpers import format_time_remaining
-from config import PREMIUM_PLANS, ADMIN_ID
+from utils.outbound import Priority
+from utils.helpers import format_time_remaining, callback_page, paginate, page_buttons
+from utils import sharding
+from config import PREMIUM_PLANS, ADMIN_ID, PAYMENTS_PAGE_SIZE, BROADCAST_BATCH_SIZE
 
 storage = Storage()
 
@@ -98,34 +104,145 @@ async def handle_payment_proof(update: Update, context: ContextTypes.DEFAULT_TYP
     
     # Save payment proof
     storage.set_user_property(user_id, 'payment_proof', photo.file_id)
+    entry = payment_entry(user_id, storage.get_user_data(user_id))
+    if entry is None:
+        await update.message.reply_text("❌ No plan selected. Please select a plan first.")
+        return
     storage.set_user_property(user_id, 'awaiting_payment_proof', False)
     
-    # Notify admin for verification
-    plan_info = PREMIUM_PLANS[selected_plan]
-    user_data = storage.get_user_data(user_id)
-    user_name = user_data.get('name', 'Unknown')
+    # Queue it for the admin on the queue's owner, its only writer
+    pending = await sharding.call_key('pending_payments', 'queue_payment', user_id=user_id, entry=entry)
     
-    keyboard = [
-        [InlineKeyboardButton("✅ Approve", callback_data=f"approve_payment_{user_id}")],
-        [InlineKeyboardButton("❌ Reject", callback_data=f"reject_payment_{user_id}")]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    
-    try:
-        await context.bot.send_photo(
-            ADMIN_ID,
-            photo=photo.file_id,
-            caption=f"💳 *Payment Verification Needed*\n\nUser: {user_name} (ID: {user_id})\nPlan: {plan_info['name']}\nAmount: {plan_info['price']} ({plan_info['price_usd']})",
-            parse_mode=ParseMode.MARKDOWN,
-            reply_markup=reply_markup
-        )
-    except:
-        pass
+    # One heads-up when the queue fills up again instead of a photo per proof
+    if pending == 1:
+        try:
+            await context.bot.send_message(
+                ADMIN_ID,
+                "💳 New payment proof waiting for verification. Use /payments to review.",
+                rate_limit_args=Priority.NOTIFICATION
+            )
+        except TelegramError:
+            pass
     
     await update.message.reply_text(
         "✅ Payment proof received! Your payment is being verified by our admin. You'll be notified once approved."
     )
 
+def payment_entry(user_id: int, user_data: Dict) -> Optional[Dict]:
+    """Queue entry for a user's submitted proof, None if the record holds no complete payment"""
+    plan = user_data.get('selected_plan')
+    expiry_pending = user_data.get('premium_expiry_pending')
+    if plan not in PREMIUM_PLANS or not expiry_pending or not user_data.get('payment_proof'):
+        return None
+    import datetime
+    return {
+        'user_id': user_id,
+        'name': user_data.get('name', 'Unknown'),
+        'plan': plan,
+        'expiry': int(datetime.datetime.fromisoformat(expiry_pending).timestamp() * 1000),
+        'proof': user_data['payment_proof'],
+        'submitted': int(time.time())
+    }
+
+def pending_payments() -> Dict[str, Dict]:
+    """Pending payments by user id (as a string), oldest submission first"""
+    return storage.get_bot_property('pending_payments') or {}
+
+@sharding.remote
+def queue_payment(user_id: int, entry: Dict) -> int:
+    """Add or replace a user's pending payment; returns the queue length.
+    
+    Runs on the owner of the global keys, the only writer of the queue in worker mode.
+    """
+    queue = dict(pending_payments())
+    # A new proof from the same user replaces the old one at the back of the queue
+    queue.pop(str(user_id), None)
+    queue[str(user_id)] = entry
+    storage.set_bot_property('pending_payments', queue)
+    return len(queue)
+
+@sharding.remote
+def activate_premium(user_id: int, plan: str, expiry: int):
+    """Grant an approved plan with one write of the user's record"""
+    user_data = storage.get_user_data(user_id)
+    user_data.update(is_premium=True, premium_plan=plan, selected_plan=None, premium_expiry_pending=None,
+                     payment_proof=None)
+    storage.save_user_data(user_id, user_data)
+    storage.set_bot_property(f"user_{user_id}_premium_expiry", expiry)
+    storage.set_bot_property(f"user_{user_id}_premium_plan", plan)
+
+@sharding.remote
+def clear_payment(user_id: int):
+    """Drop a rejected payment from the user's record"""
+    user_data = storage.get_user_data(user_id)
+    user_data.update(selected_plan=None, premium_expiry_pending=None, payment_proof=None,
+                     awaiting_payment_proof=False)
+    storage.save_user_data(user_id, user_data)
+
+@sharding.remote
+def take_payments(user_ids: List[int]) -> List[Dict]:
+    """Remove the users' payments from the queue in one write; returns the entries found.
+    
+    Runs on the queue's owner, so a proof queued meanwhile is never written over.
+    """
+    queue = dict(pending_payments())
+    taken = [queue.pop(str(user_id)) for user_id in dict.fromkeys(user_ids) if str(user_id) in queue]
+    if taken:
+        storage.set_bot_property('pending_payments', queue)
+    return taken
+
+async def settle_payments(user_ids: List[int], approve: bool) -> List[Dict]:
+    """Approve or reject queued payments; returns the settled entries.
+    
+    The queue is rewritten once for the whole batch and, in a single process, every user
+    record is written once when the admin's unit of work flushes. Records on other
+    shards are updated by their owners.
+    """
+    settled = await sharding.call_key('pending_payments', 'take_payments', user_ids=user_ids)
+    for entry in settled:
+        user_id = entry['user_id']
+        if approve:
+            sharding.cast(user_id, 'activate_premium', user_id=user_id, plan=entry['plan'], expiry=entry['expiry'])
+        else:
+            sharding.cast(user_id, 'clear_payment', user_id=user_id)
+    return settled
+
+async def _notify_settled(bot, settled: List[Dict], approve: bool):
+    """Tell users the outcome in the background, a batch at a time behind interactive traffic"""
+    storage.detach_unit_of_work()
+    
+    async def send(entry: Dict):
+        if approve:
+            plan_info = PREMIUM_PLANS[entry['plan']]
+            text = (f"🎉 *Premium Activated!*\n\nYour {plan_info['name']} is now active!\n\n"
+                    "Enjoy unlimited access to all premium features! 🌟")
+        else:
+            text = "❌ Your payment could not be verified. Please try again or contact support."
+        try:
+            await bot.send_message(entry['user_id'], text, parse_mode=ParseMode.MARKDOWN,
+                                   rate_limit_args=Priority.NOTIFICATION)
+        except TelegramError:
+            pass
+    
+    for i in range(0, len(settled), BROADCAST_BATCH_SIZE):
+        await asyncio.gather(*(send(entry) for entry in settled[i:i + BROADCAST_BATCH_SIZE]))
+
+async def _settle(context: ContextTypes.DEFAULT_TYPE, user_ids: List[int], approve: bool) -> List[Dict]:
+    settled = await settle_payments(user_ids, approve)
+    if settled:
+        context.application.create_task(_notify_settled(context.bot, settled, approve))
+    return settled
+
+async def _queued_or_legacy(user_id: int) -> bool:
+    """Make sure a proof sent before the queue existed is queued; False if there is none"""
+    if str(user_id) in pending_payments():
+        return True
+    entry = payment_entry(user_id, storage.get_user_data(user_id))
+    if entry is None:
+        return False
+    await sharding.call_key('pending_payments', 'queue_payment', user_id=user_id, entry=entry)
+    return True
+
 async def approve_payment(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Admin approves payment"""
     query = update.callback_query
@@ -136,39 +253,12 @@ async def approve_payment(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     
     user_id = int(query.data.split('_')[2])
-    selected_plan = storage.get_user_property(user_id, 'selected_plan')
-    expiry_pending = storage.get_user_property(user_id, 'premium_expiry_pending')
-    
-    if not selected_plan or not expiry_pending:
-        await query.edit_message_text("❌ Payment data not found.")
+    if not await _queued_or_legacy(user_id):
+        await _edit_proof_message(query, "❌ Payment data not found.")
         return
     
-    # Activate premium
-    import datetime
-    expiry_timestamp = int(datetime.datetime.fromisoformat(expiry_pending).timestamp() * 1000)
-    
-    storage.set_user_property(user_id, 'is_premium', True)
-    storage.set_user_property(user_id, 'premium_plan', selected_plan)
-    storage.set_bot_property(f"user_{user_id}_premium_expiry", expiry_timestamp)
-    storage.set_bot_property(f"user_{user_id}_premium_plan", selected_plan)
-    
-    # Clean up
-    storage.set_user_property(user_id, 'selected_plan', None)
-    storage.set_user_property(user_id, 'premium_expiry_pending', None)
-    storage.set_user_property(user_id, 'payment_proof', None)
-    
-    await query.edit_message_text("✅ Payment approved and premium activated!")
-    
-    # Notify user
-    plan_info = PREMIUM_PLANS[selected_plan]
-    try:
-        await context.bot.send_message(
-            user_id,
-            f"🎉 *Premium Activated!*\n\nYour {plan_info['name']} is now active!\n\nEnjoy unlimited access to all premium features! 🌟",
-            parse_mode=ParseMode.MARKDOWN
-        )
-    except:
-        pass
+    await _settle(context, [user_id], approve=True)
+    await _edit_proof_message(query, "✅ Payment approved and premium activated!")
 
 async def reject_payment(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Admin rejects payment"""
@@ -180,23 +270,152 @@ async def reject_payment(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     
     user_id = int(query.data.split('_')[2])
+    if not await _queued_or_legacy(user_id):
+        await _edit_proof_message(query, "❌ Payment data not found.")
+        return
     
-    # Clean up
-    storage.set_user_property(user_id, 'selected_plan', None)
-    storage.set_user_property(user_id, 'premium_expiry_pending', None)
-    storage.set_user_property(user_id, 'payment_proof', None)
-    storage.set_user_property(user_id, 'awaiting_payment_proof', False)
+    await _settle(context, [user_id], approve=False)
+    await _edit_proof_message(query, "❌ Payment rejected.")
+
+async def _edit_proof_message(query, text: str):
+    # Proofs are shown as photos, which only have a caption to edit
+    if query.message is not None and query.message.photo:
+        await query.edit_message_caption(text)
+    else:
+        await query.edit_message_text(text)
+
+def _payments_page(page: int) -> Tuple[str, Optional[InlineKeyboardMarkup]]:
+    """Text and keyboard of one page of the pending payments list"""
+    entries = list(pending_payments().values())
+    if not entries:
+        return "✅ No pending payments.", None
+    
+    shown, page, pages = paginate(entries, page, PAYMENTS_PAGE_SIZE)
+    lines = [f"💳 Pending payments: {len(entries)}" + (f" (page {page + 1} of {pages})" if pages > 1 else ""), ""]
+    buttons = []
+    for number, entry in enumerate(shown, start=page * PAYMENTS_PAGE_SIZE + 1):
+        plan_info = PREMIUM_PLANS[entry['plan']]
+        submitted = time.strftime('%m-%d %H:%M', time.localtime(entry['submitted']))
+        lines.append(f"{number}. {entry['name']} (ID: {entry['user_id']}) - {plan_info['name']}, "
+                     f"{plan_info['price']} - {submitted}")
+        buttons.append([
+            InlineKeyboardButton(f"🖼 #{number}", callback_data=f"payment_proof_{entry['user_id']}"),
+            InlineKeyboardButton("✅", callback_data=f"approve_payment_{entry['user_id']}"),
+            InlineKeyboardButton("❌", callback_data=f"reject_payment_{entry['user_id']}")
+        ])
+    # Page actions carry a digest of exactly what was shown and only act if it still matches
+    digest = page_digest(shown)
+    buttons.append([
+        InlineKeyboardButton("✅ Approve page", callback_data=f"approve_payments_{page}_{digest}"),
+        InlineKeyboardButton("❌ Reject page", callback_data=f"reject_payments_{page}_{digest}")
+    ])
+    nav = page_buttons("payments", page, pages)
+    if nav:
+        buttons.append(nav)
+    return "\n".join(lines), InlineKeyboardMarkup(buttons)
+
+def page_digest(entries: List[Dict]) -> str:
+    """Short digest of the entries on a page: their users and proofs, in order.
+    
+    Callback data is limited to 64 bytes, too little for a page of ids. Any entry
+    moved, added, removed or resubmitted with a new proof changes the digest.
+    """
+    shown = ','.join(f"{entry['user_id']}:{entry['proof']}" for entry in entries)
+    return hashlib.sha1(shown.encode('utf-8')).hexdigest()[:16]
+
+async def list_payments(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """List pending payments (/payments [page]) or turn to another page of the list"""
+    query = update.callback_query
+    user_id = update.effective_user.id
     
-    await query.edit_message_text("❌ Payment rejected.")
+    if user_id != ADMIN_ID:
+        if query:
+            await query.answer("❌ Unauthorized", show_alert=True)
+        else:
+            await update.message.reply_text("⛔ You are not authorized.")
+        return
     
-    # Notify user
-    try:
-        await context.bot.send_message(
-            user_id,
-            "❌ Your payment could not be verified. Please try again or contact support."
-        )
-    except:
-        pass
+    if query:
+        text, reply_markup = _payments_page(callback_page(query.data))
+        await query.edit_message_text(text, reply_markup=reply_markup)
+    else:
+        page = int(context.args[0]) - 1 if context.args and context.args[0].isdigit() else 0
+        text, reply_markup = _payments_page(page)
+        await update.message.reply_text(text, reply_markup=reply_markup)
+
+async def show_payment_proof(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Send the admin one queued proof with approve/reject buttons"""
+    query = update.callback_query
+    if query.from_user.id != ADMIN_ID:
+        await query.answer("❌ Unauthorized", show_alert=True)
+        return
+    
+    user_id = int(query.data.split('_')[2])
+    entry = pending_payments().get(str(user_id))
+    if entry is None:
+        await context.bot.send_message(ADMIN_ID, "❌ That payment is no longer pending.")
+        return
+    
+    plan_info = PREMIUM_PLANS[entry['plan']]
+    keyboard = [
+        [InlineKeyboardButton("✅ Approve", callback_data=f"approve_payment_{user_id}")],
+        [InlineKeyboardButton("❌ Reject", callback_data=f"reject_payment_{user_id}")]
+    ]
+    await context.bot.send_photo(
+        ADMIN_ID,
+        photo=entry['proof'],
+        caption=f"💳 Payment Verification Needed\n\nUser: {entry['name']} (ID: {user_id})\n"
+                f"Plan: {plan_info['name']}\nAmount: {plan_info['price']} ({plan_info['price_usd']})",
+        reply_markup=InlineKeyboardMarkup(keyboard)
+    )
+
+async def settle_payments_page(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Approve or reject every payment on a page of the list (approve_payments_<page>_<digest>)"""
+    query = update.callback_query
+    if query.from_user.id != ADMIN_ID:
+        await query.answer("❌ Unauthorized", show_alert=True)
+        return
+    
+    action, _, page, digest = query.data.split('_')
+    shown, page, _ = paginate(list(pending_payments().values()), int(page), PAYMENTS_PAGE_SIZE)
+    if not shown or page_digest(shown) != digest:
+        text, reply_markup = _payments_page(page)
+        await query.edit_message_text("⚠️ The list changed; nothing was done. Check it again:\n\n" + text,
+                                      reply_markup=reply_markup)
+        return
+    
+    approve = action == 'approve'
+    settled = await _settle(context, [entry['user_id'] for entry in shown], approve)
+    text, reply_markup = _payments_page(page)
+    await query.edit_message_text(f"{'✅ Approved' if approve else '❌ Rejected'} {len(settled)} payments.\n\n" + text,
+                                  reply_markup=reply_markup)
+
+async def approve_payments(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Approve payments by user id (/approve <id> ...)"""
+    await _settle_by_ids(update, context, approve=True)
+
+async def reject_payments(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Reject payments by user id (/reject <id> ...)"""
+    await _settle_by_ids(update, context, approve=False)
+
+async def _settle_by_ids(update: Update, context: ContextTypes.DEFAULT_TYPE, approve: bool):
+    if update.effective_user.id != ADMIN_ID:
+        await update.message.reply_text("⛔ You are not authorized.")
+        return
+    
+    command = 'approve' if approve else 'reject'
+    user_ids = [int(arg) for arg in context.args if arg.isdigit()]
+    if not user_ids:
+        await update.message.reply_text(f"Usage: /{command} <user_id> [user_id ...]")
+        return
+    
+    settled = await _settle(context, user_ids, approve)
+    missing = len(set(user_ids)) - len(settled)
+    await update.message.reply_text(
+        f"{'✅ Approved' if approve else '❌ Rejected'} {len(settled)} payments."
+        + (f"\n⚠️ {missing} of the ids had no pending payment." if missing else "")
+        + f"\n\n💳 Still pending: {len(pending_payments())}"
+    )
 
 async def boost_profile(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Boost user's profile"""
@@ -241,10 +460,7 @@ async def boost_profile(update: Update, context: ContextTypes.DEFAULT_TYPE):
     storage.set_user_property(user_id, 'boost_expires_at', now + boost_duration)
     
     # Add to boosted profiles list
-    boosted_profiles = storage.get_bot_property('boosted_profiles') or []
-    if user_id not in boosted_profiles:
-        boosted_profiles.append(user_id)
-        storage.set_bot_property('boosted_profiles', boosted_profiles)
+    await sharding.add_to_bot_list('boosted_profiles', user_id)
     
     await query.edit_message_text(
         "🚀 Your profile is boosted and will appear more in matches for the next *12 hours*!",
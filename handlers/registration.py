@@ -1,8 +1,10 @@
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import ContextTypes
-from telegram.constants import ParseMode
 from utils.storage import Storage
 from utils.helpers import get_user_name
+from utils import cards
+from utils.drafts import drafts
+from config import MIN_AGE, MAX_AGE
 
 storage = Storage()
 
@@ -12,18 +14,28 @@ async def start_registration(update: Update, context: ContextTypes.DEFAULT_TYPE)
     user_id = user.id
     name = get_user_name(user)
     
-    # Save basic user info
-    storage.set_user_property(user_id, 'telegram_id', user_id)
-    storage.set_user_property(user_id, 'username', user.username)
-    storage.set_user_property(user_id, 'registration_state', 'awaiting_name')
+    # Answers stay in memory until the photo step commits the profile
+    drafts.start(user_id, 'awaiting_name', telegram_id=user_id, username=user.username)
     
     await update.message.reply_text(f"👋 Welcome, {name}!\n\nLet's set up your dating profile.\n\n👤 What name should we call you?")
 
+async def _restart_registration(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """The draft is gone (expired or lost in a crash); begin again"""
+    if update.callback_query:
+        await update.callback_query.edit_message_text("⌛ Your registration timed out. Send /start to begin again.")
+        return
+    await update.message.reply_text("⌛ Your registration timed out, let's start over.")
+    await start_registration(update, context)
+
 async def handle_registration_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle registration input based on current state"""
     user_id = update.effective_user.id
     message_text = update.message.text
-    state = storage.get_user_property(user_id, 'registration_state')
+    draft = drafts.get(user_id)
+    if draft is None:
+        await _restart_registration(update, context)
+        return
+    state = draft.state
     
     if state == 'awaiting_name':
         await handle_name_input(update, context, message_text)
@@ -42,8 +54,7 @@ async def handle_name_input(update: Update, context: ContextTypes.DEFAULT_TYPE,
         await update.message.reply_text("❌ Please enter a valid name (2-50 characters).")
         return
     
-    storage.set_user_property(user_id, 'name', name)
-    storage.set_user_property(user_id, 'registration_state', 'awaiting_gender')
+    drafts.get(user_id).advance('awaiting_gender', name=name)
     
     keyboard = [
         [InlineKeyboardButton("Male", callback_data="gender_male")],
@@ -63,8 +74,11 @@ async def handle_gender_selection(update: Update, context: ContextTypes.DEFAULT_
     user_id = query.from_user.id
     gender = query.data.split('_')[1].capitalize()
     
-    storage.set_user_property(user_id, 'gender', gender)
-    storage.set_user_property(user_id, 'registration_state', 'awaiting_interest')
+    draft = drafts.get(user_id)
+    if draft is None or draft.state != 'awaiting_gender':
+        await _restart_registration(update, context)
+        return
+    draft.advance('awaiting_interest', gender=gender)
     
     keyboard = [
         [InlineKeyboardButton("Male", callback_data="interest_male")],
@@ -84,10 +98,13 @@ async def handle_interest_selection(update: Update, context: ContextTypes.DEFAUL
     user_id = query.from_user.id
     interest = query.data.split('_')[1].capitalize()
     
-    storage.set_user_property(user_id, 'interest', interest)
-    storage.set_user_property(user_id, 'registration_state', 'awaiting_age')
+    draft = drafts.get(user_id)
+    if draft is None or draft.state != 'awaiting_interest':
+        await _restart_registration(update, context)
+        return
+    draft.advance('awaiting_age', interest=interest)
     
-    await query.edit_message_text(f"✅ Interest set to {interest}!\n\n🎂 How old are you? (Enter a number between 18-100)")
+    await query.edit_message_text(f"✅ Interest set to {interest}!\n\n🎂 How old are you? (Enter a number between {MIN_AGE}-{MAX_AGE})")
 
 async def handle_age_input(update: Update, context: ContextTypes.DEFAULT_TYPE, age_text: str):
     """Handle age input"""
@@ -95,15 +112,14 @@ async def handle_age_input(update: Update, context: ContextTypes.DEFAULT_TYPE, a
     
     try:
         age = int(age_text)
-        if age < 18 or age > 100:
-            await update.message.reply_text("❌ Please enter a valid age between 18 and 100.")
+        if age < MIN_AGE or age > MAX_AGE:
+            await update.message.reply_text(f"❌ Please enter a valid age between {MIN_AGE} and {MAX_AGE}.")
             return
     except ValueError:
         await update.message.reply_text("❌ Please enter a valid number for your age.")
         return
     
-    storage.set_user_property(user_id, 'age', age)
-    storage.set_user_property(user_id, 'registration_state', 'awaiting_location')
+    drafts.get(user_id).advance('awaiting_location', age=age)
     
     await update.message.reply_text("✅ Age saved!\n\n📍 Where are you located? (City, Country)")
 
@@ -115,8 +131,7 @@ async def handle_location_input(update: Update, context: ContextTypes.DEFAULT_TY
         await update.message.reply_text("❌ Please enter a valid location (2-100 characters).")
         return
     
-    storage.set_user_property(user_id, 'location', location)
-    storage.set_user_property(user_id, 'registration_state', 'awaiting_bio')
+    drafts.get(user_id).advance('awaiting_bio', location=location)
     
     await update.message.reply_text("✅ Location saved!\n\n📝 Write a short bio about yourself (max 500 characters):")
 
@@ -128,8 +143,7 @@ async def handle_bio_input(update: Update, context: ContextTypes.DEFAULT_TYPE, b
         await update.message.reply_text("❌ Bio is too long. Please keep it under 500 characters.")
         return
     
-    storage.set_user_property(user_id, 'bio', bio)
-    storage.set_user_property(user_id, 'registration_state', 'awaiting_photo')
+    drafts.get(user_id).advance('awaiting_photo', bio=bio)
     
     await update.message.reply_text("✅ Bio saved!\n\n📸 Now send a profile photo:")
 
@@ -138,10 +152,21 @@ async def handle_profile_photo(update: Update, context: ContextTypes.DEFAULT_TYP
     user_id = update.effective_user.id
     photo = update.message.photo[-1]  # Get highest resolution
     
-    # Save photo file_id
-    storage.set_user_property(user_id, 'profile_photo', photo.file_id)
-    storage.set_user_property(user_id, 'is_registered', True)
-    storage.set_user_property(user_id, 'registration_state', None)
+    draft = drafts.get(user_id)
+    if draft is None or draft.state != 'awaiting_photo':
+        await _restart_registration(update, context)
+        return
+    
+    # Commit the whole profile in one write; saving it updates the profile index too
+    record = {
+        **storage.get_user_data(user_id),
+        **draft.fields,
+        'profile_photo': photo.file_id,
+        'is_registered': True,
+        'registration_state': None
+    }
+    storage.save_user_data(user_id, record)
+    drafts.discard(user_id)
     
     await update.message.reply_text("✅ Profile photo saved and registration complete! 🎉")
     
@@ -174,24 +199,15 @@ async def show_profile(update: Update, context: ContextTypes.DEFAULT_TYPE):
         else:
             premium_tag = "⭐ Premium"
     
-    # Build profile message
-    caption = f"""👤 *Your Profile Preview*
-
-🧑 Name: *{user_data.get('name', 'Anonymous')}* {premium_tag}
-🚻 Gender: *{user_data.get('gender', 'Unknown')}*
-🎂 Age: *{user_data.get('age', 'N/A')}*
-📍 Location: *{user_data.get('location', 'Not set')}*
-📝 Bio: _{user_data.get('bio', 'No bio yet')}_
-🆔 Username: @{user_data.get('username', 'N/A')}"""
+    card = cards.self_card(user_id, user_data, premium_tag)
     
     # Send profile photo with caption
-    photo_id = user_data.get('profile_photo')
-    if photo_id:
+    if card.photo:
         await context.bot.send_photo(
             chat_id=query.message.chat_id,
-            photo=photo_id,
-            caption=caption,
-            parse_mode=ParseMode.MARKDOWN
+            photo=card.photo,
+            caption=card.caption,
+            parse_mode=card.parse_mode
         )
     else:
-        await query.edit_message_text(caption, parse_mode=ParseMode.MARKDOWN)
+        await query.edit_message_text(card.caption, parse_mode=card.parse_mode)
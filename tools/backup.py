@@ -0,0 +1,55 @@
+"""Snapshot and restore the data directory.
+
+While a single-process bot runs, use the /backup admin command: it snapshots from
+inside the process so the archive is point-in-time consistent. This tool snapshots a
+stopped bot's data (the only way in worker mode) and restores archives (the bot must
+be stopped for a restore).
+
+    python -m tools.backup snapshot [--incremental]
+    python -m tools.backup list
+    python -m tools.backup restore --latest
+    python -m tools.backup restore backups/snapshot-...-full.tar.gz backups/snapshot-...-inc.tar.gz
+"""
+import argparse
+import sys
+import time
+
+from config import BACKUP_DIR, BACKUP_COMPRESSLEVEL
+from utils import backup
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--data-dir', default='data')
+    parser.add_argument('--backup-dir', default=BACKUP_DIR)
+    commands = parser.add_subparsers(dest='command', required=True)
+    snapshot = commands.add_parser('snapshot', help="archive the data directory")
+    snapshot.add_argument('--incremental', action='store_true', help="only files changed since the last snapshot")
+    commands.add_parser('list', help="list snapshots")
+    restore = commands.add_parser('restore', help="restore a full snapshot and its incrementals")
+    restore.add_argument('archives', nargs='*')
+    restore.add_argument('--latest', action='store_true', help="restore the latest snapshot chain")
+    args = parser.parse_args()
+    
+    start = time.perf_counter()
+    if args.command == 'snapshot':
+        manifest = backup.create_offline(args.data_dir, args.backup_dir, args.incremental, BACKUP_COMPRESSLEVEL)
+        print(f"{manifest['id']}: {manifest['files_included']} of {manifest['files_total']} files, "
+              f"{manifest['archive_bytes']} bytes in {time.perf_counter() - start:.1f}s")
+    elif args.command == 'list':
+        for manifest in backup.list_snapshots(args.backup_dir):
+            created = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(manifest['created']))
+            print(f"{manifest['id']}  {created}  {manifest['type']:11}  "
+                  f"{manifest['files_included']}/{manifest['files_total']} files  {manifest['archive_bytes']} bytes")
+    else:
+        archives = backup.restore_chain(args.backup_dir) if args.latest else args.archives
+        if not archives:
+            sys.exit("Nothing to restore")
+        try:
+            result = backup.restore(archives, args.data_dir)
+        except (RuntimeError, ValueError, FileNotFoundError) as e:
+            sys.exit(f"Not restored: {e}")
+        print(f"Restored {result['restored']} files from {len(archives)} archives, removed {result['removed']} "
+              f"in {time.perf_counter() - start:.1f}s")
+
+if __name__ == '__main__':
+    main()
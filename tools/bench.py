@@ -0,0 +1,201 @@
+"""Microbenchmarks for storage and matching primitives.
+
+Times each primitive against a synthetic dataset (see tools.gen_dataset) in a
+scratch copy, prints a table and can write the results as JSON. Results saved as a
+baseline are compared on later runs, showing the change in median time per
+benchmark as a percentage.
+
+    python -m tools.bench --users 10000 --save-baseline bench-10k.json
+    python -m tools.bench --users 10000 --baseline bench-10k.json --max-regression 20
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+from typing import Callable, Dict, List, Optional
+
+SAMPLE_MESSAGES = [
+    "Hey, how was your day?",
+    "I love that place, we should go sometime",
+    "What kind of music are you into?",
+    "Send me your number and let's talk on whatsapp",
+    "Haha that's funny 😂",
+    "Are you free this weekend?"
+]
+
+def measure(func: Callable, repeat: int, warmup: int = 1) -> List[float]:
+    """Run func repeat times and return the durations in milliseconds"""
+    for _ in range(warmup):
+        func()
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        durations.append((time.perf_counter() - start) * 1000)
+    return durations
+
+async def measure_async(func: Callable, repeat: int, warmup: int = 1) -> List[float]:
+    for _ in range(warmup):
+        await func()
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        await func()
+        durations.append((time.perf_counter() - start) * 1000)
+    return durations
+
+def summarize(durations: List[float]) -> Dict[str, float]:
+    ordered = sorted(durations)
+    return {
+        'runs': len(ordered),
+        'mean_ms': round(statistics.fmean(ordered), 4),
+        'p50_ms': round(ordered[len(ordered) // 2], 4),
+        'p95_ms': round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))], 4),
+        'min_ms': round(ordered[0], 4)
+    }
+
+async def run_benchmarks(repeat: int, only: Optional[List[str]], seed: int) -> Dict[str, Dict]:
+    # Imported here: storage binds ./data, which must be the scratch copy
+    from handlers import matching
+    from tools.stress_likes import StubBot, make_like_update
+    from utils.context import with_user_context
+    from utils.helpers import filter_profiles_by_interest, contains_banned_words
+    from utils.storage import Storage
+    
+    storage = Storage()
+    rng = random.Random(seed)
+    profiles = storage.get_profiles()
+    banned = set(storage.get_bot_property('banned_users') or [])
+    user_ids = [p['id'] for p in profiles if p['id'] not in banned]
+    viewer = rng.choice(profiles)
+    
+    bot = StubBot(0)
+    context = SimpleNamespace(bot=bot, application=SimpleNamespace(create_task=asyncio.ensure_future))
+    like = with_user_context(matching.like_user)
+    
+    def pair():
+        a, b = rng.sample(user_ids, 2)
+        return a, b
+    
+    async def like_once():
+        a, b = pair()
+        await like(make_like_update(bot, a, b), context)
+    
+    async def match_once():
+        a, b = pair()
+        with storage.unit_of_work():
+            await matching.handle_match(a, b, f"User {a}", f"User {b}")
+    
+    def banned_words_batch():
+        for text in SAMPLE_MESSAGES:
+            contains_banned_words(text)
+    
+    sync_benchmarks = {
+        'storage.get_profiles': (storage.get_profiles, max(3, repeat // 10)),
+        'helpers.filter_profiles_by_interest': (
+            lambda: filter_profiles_by_interest(profiles, viewer['gender'], viewer['interest'], viewer['id']), repeat),
+        'helpers.contains_banned_words': (banned_words_batch, repeat * 10)
+    }
+    async_benchmarks = {
+        'matching.like_user': (like_once, repeat),
+        'matching.handle_match': (match_once, repeat)
+    }
+    
+    results = {}
+    for name, (func, runs) in sync_benchmarks.items():
+        if not only or name in only:
+            results[name] = summarize(measure(func, runs))
+    for name, (func, runs) in async_benchmarks.items():
+        if not only or name in only:
+            results[name] = summarize(await measure_async(func, runs))
+    return results
+
+def compare(results: Dict[str, Dict], baseline: Dict[str, Dict]) -> Dict[str, Optional[float]]:
+    """Percentage change of the median against the baseline (positive is slower)"""
+    deltas = {}
+    for name, result in results.items():
+        base = baseline.get(name)
+        if base and base.get('p50_ms'):
+            deltas[name] = round((result['p50_ms'] - base['p50_ms']) / base['p50_ms'] * 100, 1)
+        else:
+            deltas[name] = None
+    return deltas
+
+def print_table(results: Dict[str, Dict], deltas: Dict[str, Optional[float]]):
+    print(f"{'benchmark':40} {'runs':>6} {'p50 ms':>10} {'p95 ms':>10} {'mean ms':>10} {'vs base':>9}")
+    for name, result in results.items():
+        delta = deltas.get(name)
+        delta_str = '' if delta is None else f"{delta:+.1f}%"
+        print(f"{name:40} {result['runs']:>6} {result['p50_ms']:>10.3f} {result['p95_ms']:>10.3f} "
+              f"{result['mean_ms']:>10.3f} {delta_str:>9}")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=1000, help="size of the generated dataset")
+    parser.add_argument('--data', help="existing dataset directory (containing data/) instead of generating one")
+    parser.add_argument('--repeat', type=int, default=50)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--only', action='append', help="run only this benchmark (repeatable)")
+    parser.add_argument('--output', help="write results as JSON to this file")
+    parser.add_argument('--baseline', help="compare against results saved with --save-baseline")
+    parser.add_argument('--save-baseline', help="save these results as a baseline")
+    parser.add_argument('--max-regression', type=float,
+                        help="exit non-zero if any median is this many percent slower than the baseline")
+    args = parser.parse_args()
+    
+    # Paths given by the user are resolved before moving to the scratch directory
+    output, baseline_path, save_path = (os.path.abspath(p) if p else None
+                                        for p in (args.output, args.baseline, args.save_baseline))
+    
+    # Benchmarks write to storage, so always work on a throwaway copy
+    scratch = tempfile.mkdtemp(prefix="lumi-bench-")
+    if args.data:
+        shutil.copytree(os.path.join(args.data, 'data'), os.path.join(scratch, 'data'))
+        users = len(os.listdir(os.path.join(scratch, 'data', 'users')))
+    else:
+        from tools.gen_dataset import generate
+        users = generate(scratch, args.users, args.seed)['users']
+    os.chdir(scratch)
+    
+    try:
+        results = asyncio.run(run_benchmarks(args.repeat, args.only, args.seed))
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+    
+    report = {
+        'users': users,
+        'python': platform.python_version(),
+        'timestamp': int(time.time()),
+        'results': results
+    }
+    baseline = {}
+    if baseline_path:
+        with open(baseline_path, encoding='utf-8') as f:
+            baseline = json.load(f)
+        if baseline.get('users') != users:
+            print(f"Warning: baseline was recorded with {baseline.get('users')} users, this run has {users}")
+    deltas = compare(results, baseline.get('results', {}))
+    report['deltas_pct'] = deltas
+    
+    print_table(results, deltas)
+    for path in (output, save_path):
+        if path:
+            with open(path, 'w', encoding='utf-8') as f:
+                json.dump(report, f, indent=2)
+    
+    if args.max_regression is not None:
+        regressions = {name: d for name, d in deltas.items() if d is not None and d > args.max_regression}
+        for name, delta in regressions.items():
+            print(f"REGRESSION {name}: {delta:+.1f}%")
+        sys.exit(1 if regressions else 0)
+
+if __name__ == '__main__':
+    main()
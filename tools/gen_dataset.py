@@ -0,0 +1,187 @@
+"""Synthetic dataset generator for benchmarks and load tests.
+
+Writes data/users/*.json and data/bot_data.json under the output directory, shaped
+like production data: registered profiles spread over common cities, like counts
+and popularity following a power law, mutual likes turned into matches, and a few
+notifications, boosts, bans and reports. Records and bot_data keys are the ones the
+handlers write: registration steps use the awaiting_* states, premium lives in the
+user_<id>_premium_* keys and like notifications are the digest messages.
+
+    python -m tools.gen_dataset --users 10000 --out /tmp/lumi-10k
+"""
+import argparse
+import json
+import os
+import random
+import time
+from typing import Dict, List
+
+from config import LIKE_DIGEST_INTERVAL, PREMIUM_PLANS
+
+CITIES = ['Lagos', 'Abuja, Nigeria', 'Ibadan', 'Port Harcourt', 'Accra', 'Kumasi, Ghana',
+          'Nairobi', 'Johannesburg', 'Cape Town', 'London, UK', 'Manchester', 'New York, USA']
+NAMES = ['Ada', 'Tunde', 'Chioma', 'Kwame', 'Amina', 'Femi', 'Zainab', 'Kofi', 'Wanjiru',
+         'Thabo', 'Emeka', 'Ngozi', 'Sade', 'Musa', 'Efua', 'Jide', 'Halima', 'Obi']
+BIOS = ['Love music and good food', 'Looking for something real', 'Football fan',
+        'Travel, books and long walks', 'Just here to meet new people', None]
+# Registration steps in order, with the field each one fills in
+REGISTRATION_STEPS = [('awaiting_name', 'name'), ('awaiting_gender', 'gender'),
+                      ('awaiting_interest', 'interest'), ('awaiting_age', 'age'),
+                      ('awaiting_location', 'location'), ('awaiting_bio', 'bio'),
+                      ('awaiting_photo', 'profile_photo')]
+
+def power_law(rng: random.Random, alpha: float, cap: int, scale: float = 1) -> int:
+    """Heavy-tailed count: most users small, a few very large"""
+    return min(cap, int(scale * (rng.paretovariate(alpha) - 1)))
+
+def window_text(seconds: float) -> str:
+    """Digest window as the bot words it (utils.digests.window_text)"""
+    if seconds == 3600:
+        return "hour"
+    if seconds < 3600:
+        return f"{max(1, round(seconds / 60))} minutes"
+    return f"{round(seconds / 3600)} hours"
+
+def digest_message(likers: List[str]) -> str:
+    """Like digest text as LikeDigests.message writes it"""
+    if len(likers) == 1:
+        return f"❤️ {likers[0]} liked your profile!"
+    return f"❤️ {len(likers)} people liked you in the last {window_text(LIKE_DIGEST_INTERVAL)}"
+
+def make_user(rng: random.Random, user_id: int, now_ms: int) -> Dict:
+    gender = rng.choice(['Male', 'Female'])
+    profile = {
+        'name': rng.choice(NAMES),
+        'gender': gender,
+        'interest': rng.choices(['Female' if gender == 'Male' else 'Male', 'Both', gender],
+                                weights=[0.85, 0.1, 0.05])[0],
+        'age': rng.randint(18, 55),
+        'location': rng.choice(CITIES),
+        'bio': rng.choice(BIOS),
+        'profile_photo': f"AgACAgQAAxkBAAI{user_id:08d}"
+    }
+    user = {
+        'user_id': user_id,
+        'telegram_id': user_id,
+        'username': f"user{user_id}" if rng.random() < 0.6 else None,
+        'is_registered': rng.random() < 0.9,
+        'registration_state': None,
+        'is_premium': False,
+        'premium_plan': None,
+        'liked_users': [],
+        'notifications': [],
+        'last_active': int(now_ms / 1000) - power_law(rng, 1.2, 90) * 86400
+    }
+    if user['is_registered']:
+        user.update(profile)
+    else:
+        # An unfinished registration from before drafts: the answers given so far and
+        # the step it stopped at
+        step = rng.randrange(len(REGISTRATION_STEPS))
+        user['registration_state'] = REGISTRATION_STEPS[step][0]
+        user.update((field, profile[field]) for _, field in REGISTRATION_STEPS[:step])
+    return user
+
+def generate(out_dir: str, count: int, seed: int = 1, alpha: float = 1.5,
+             reciprocity: float = 0.1) -> Dict[str, int]:
+    """Write a dataset of `count` users; returns summary counts"""
+    rng = random.Random(seed)
+    now_ms = int(time.time() * 1000)
+    users_dir = os.path.join(out_dir, 'data', 'users')
+    os.makedirs(users_dir, exist_ok=True)
+    
+    user_ids = list(range(100000001, 100000001 + count))
+    users = {user_id: make_user(rng, user_id, now_ms) for user_id in user_ids}
+    bot_data: Dict = {}
+    
+    # Only finished profiles are shown in matching, so only they like and get liked
+    registered = [user_id for user_id in user_ids if users[user_id]['is_registered']]
+    
+    # Popularity is Zipf-like, so a few profiles collect most of the likes
+    popularity = [1 / (rank + 1) ** 0.8 for rank in range(len(registered))]
+    popular = registered[:]
+    rng.shuffle(popular)
+    liked: Dict[int, List[int]] = {user_id: [] for user_id in user_ids}
+    for user_id in registered:
+        wanted = power_law(rng, alpha, min(500, len(registered) - 1), scale=10)
+        targets = set(rng.choices(popular, weights=popularity, k=wanted)) - {user_id}
+        for target in targets:
+            liked[user_id].append(target)
+            # Some likes are returned, which makes the matches
+            if rng.random() < reciprocity:
+                liked[target].append(user_id)
+    
+    likes = 0
+    for user_id in user_ids:
+        targets = list(dict.fromkeys(liked[user_id]))
+        users[user_id]['liked_users'] = targets
+        for target in targets:
+            bot_data.setdefault(f"likes_{target}", []).append(user_id)
+        likes += len(targets)
+    
+    matches = 0
+    for user_id in user_ids:
+        for target in users[user_id]['liked_users']:
+            if user_id < target and user_id in users[target]['liked_users']:
+                bot_data.setdefault(f"matches_{user_id}", []).append(target)
+                bot_data.setdefault(f"matches_{target}", []).append(user_id)
+                matches += 1
+    
+    # Recent likes arrive as digests, one per window with one or more likers each
+    for user_id in user_ids:
+        likers = (bot_data.get(f"likes_{user_id}") or [])[-20:]
+        windows = []
+        while likers:
+            size = power_law(rng, 1.5, len(likers) - 1) + 1
+            windows.append([users[liker].get('name', 'Someone') for liker in likers[:size]])
+            likers = likers[size:]
+        sent = now_ms // 1000 - len(windows) * int(LIKE_DIGEST_INTERVAL)
+        for window in windows:
+            sent += int(LIKE_DIGEST_INTERVAL)
+            users[user_id]['notifications'].append({'message': digest_message(window), 'timestamp': sent})
+    
+    # Premium is granted the way activate_premium does it: flags on the record, expiry
+    # and plan in bot_data
+    for user_id in registered:
+        if rng.random() < 0.05:
+            plan = rng.choice(list(PREMIUM_PLANS))
+            users[user_id].update(is_premium=True, premium_plan=plan)
+            expiry = now_ms + rng.randint(1, PREMIUM_PLANS[plan]['duration_days']) * 86400 * 1000
+            bot_data[f"user_{user_id}_premium_expiry"] = expiry
+            bot_data[f"user_{user_id}_premium_plan"] = plan
+    
+    bot_data['banned_users'] = rng.sample(user_ids, max(1, count // 200))
+    # Boosting is a premium feature
+    premium = [user_id for user_id in registered if users[user_id]['is_premium']]
+    bot_data['boosted_profiles'] = rng.sample(premium, len(premium) // 5)
+    for user_id in bot_data['boosted_profiles']:
+        users[user_id]['boost_expires_at'] = now_ms + 12 * 3600 * 1000
+    bot_data['user_reports'] = [{
+        'reporter_id': rng.choice(user_ids),
+        'reported_id': rng.choice(user_ids),
+        'timestamp': now_ms // 1000,
+        'reason': 'General misconduct'
+    } for _ in range(max(1, count // 500))]
+    
+    for user_id, user in users.items():
+        with open(os.path.join(users_dir, f"{user_id}.json"), 'w', encoding='utf-8') as f:
+            json.dump(user, f, ensure_ascii=False, indent=2)
+    with open(os.path.join(out_dir, 'data', 'bot_data.json'), 'w', encoding='utf-8') as f:
+        json.dump(bot_data, f, ensure_ascii=False, indent=2)
+    
+    return {'users': count, 'likes': likes, 'matches': matches}
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--out', required=True, help="directory to write data/ into")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--alpha', type=float, default=1.5, help="power-law exponent of likes per user")
+    parser.add_argument('--reciprocity', type=float, default=0.1, help="share of likes that are returned")
+    args = parser.parse_args()
+    
+    summary = generate(args.out, args.users, args.seed, args.alpha, args.reciprocity)
+    print(json.dumps(summary))
+
+if __name__ == '__main__':
+    main()
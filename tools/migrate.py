@@ -0,0 +1,239 @@
+"""Copy the JSON data directory into the SQLite layout, then verify the copy.
+
+To migrate a live bot with no downtime, first restart it with STORAGE_MIRROR set so
+every write also lands in the database, then run this tool against the same data
+directory. Records are inserted only if the database doesn't hold them yet, so a
+newer copy written by the bot while the tool runs is never replaced by the older
+file the tool read. Progress is checkpointed in the database with every commit; an
+interrupted run continues where it stopped. Commits are kept to a few dozen rows so
+the bot's mirror writes, which only wait STORAGE_MIRROR_TIMEOUT for the lock, rarely
+give up.
+
+Records the verify pass finds missing or different (mirror writes that failed while
+the bot ran) are then rewritten from disk; with --verify-only that takes --repair.
+
+    python -m tools.migrate --data-dir data
+    python -m tools.migrate --data-dir data --verify-only --deep --repair
+
+The lumi_mirror_reads_total metric then shows how often reads served from the JSON
+files agree with the database. Switching reads over to the database is not part of
+this tool or of Storage yet: the JSON files stay the source of truth.
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Tuple
+
+from utils.sqlite_store import SqliteStore, encode
+
+CHECKPOINT_KEY = 'migrate.users.last_id'
+
+# Rows per commit: the write lock is held this long, and the bot's mirror writes wait
+TRANSACTION_ROWS = 50
+
+def source_ids(users_dir: str) -> List[int]:
+    """Ids of the user records on disk, ascending (the order checkpoints rely on)"""
+    ids = []
+    for entry in os.scandir(users_dir):
+        if entry.name.endswith('.json'):
+            try:
+                ids.append(int(entry.name[:-5]))
+            except ValueError:
+                continue
+    return sorted(ids)
+
+def _load(users_dir: str, user_id: int):
+    with open(os.path.join(users_dir, f"{user_id}.json"), 'rb') as f:
+        return json.loads(f.read())
+
+def read_batch(users_dir: str, batch: List[int]) -> Tuple[List[Tuple[int, str]], List[int]]:
+    """Parse a batch of records in a worker process: (encoded rows, unreadable ids)"""
+    rows, failed = [], []
+    for user_id in batch:
+        try:
+            rows.append((user_id, encode(_load(users_dir, user_id))))
+        except FileNotFoundError:
+            # Deleted since the listing
+            continue
+        except (OSError, ValueError):
+            failed.append(user_id)
+    return rows, failed
+
+def compare_batch(users_dir: str, target: str, batch: List[int]) -> Tuple[List[int], List[int]]:
+    """Compare a batch of records with the database: (missing ids, differing ids)"""
+    store = SqliteStore(target)
+    missing, differing = [], []
+    try:
+        for user_id in batch:
+            try:
+                data = _load(users_dir, user_id)
+            except (OSError, ValueError):
+                continue
+            mirrored = store.read_user(user_id)
+            if mirrored is None:
+                missing.append(user_id)
+            elif mirrored != data:
+                differing.append(user_id)
+    finally:
+        store.close()
+    return missing, differing
+
+def _batches(ids: List[int], size: int):
+    for i in range(0, len(ids), size):
+        yield ids[i:i + size]
+
+def _stream(executor: ProcessPoolExecutor, func, batches, *args, window: int):
+    """Yield (batch, result) in order, keeping at most `window` batches in flight"""
+    pending = deque()
+    for batch in batches:
+        pending.append((batch, executor.submit(func, *args, batch)))
+        if len(pending) >= window:
+            batch, future = pending.popleft()
+            yield batch, future.result()
+    while pending:
+        batch, future = pending.popleft()
+        yield batch, future.result()
+
+def migrate(data_dir: str, store: SqliteStore, workers: int, batch_size: int) -> Dict:
+    users_dir = os.path.join(data_dir, 'users')
+    ids = source_ids(users_dir)
+    checkpoint = int(store.get_meta(CHECKPOINT_KEY) or 0)
+    pending = [user_id for user_id in ids if user_id > checkpoint]
+    stats = {'source': len(ids), 'skipped_by_checkpoint': len(ids) - len(pending),
+             'read': 0, 'inserted': 0, 'unreadable': []}
+    
+    start = time.perf_counter()
+    reported = start
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for batch, (rows, failed) in _stream(executor, read_batch, _batches(pending, batch_size), users_dir,
+                                             window=workers * 2):
+            # The checkpoint moves in the same transaction as the rows it covers
+            for i in range(0, max(len(rows), 1), TRANSACTION_ROWS):
+                chunk = rows[i:i + TRANSACTION_ROWS]
+                last = chunk[-1][0] if i + TRANSACTION_ROWS < len(rows) else batch[-1]
+                with store.transaction():
+                    stats['inserted'] += store.insert_users(chunk)
+                    store.set_meta(CHECKPOINT_KEY, str(last))
+            stats['read'] += len(rows)
+            stats['unreadable'].extend(failed)
+            if time.perf_counter() - reported >= 5:
+                reported = time.perf_counter()
+                done = stats['read'] + len(stats['unreadable'])
+                print(f"  {done}/{len(pending)} records, {done / (reported - start):.0f}/s")
+    
+    # Bot data files; like records, a copy the bot already mirrored is kept
+    stats['documents'] = 0
+    for name in sorted(os.listdir(data_dir)):
+        if name.startswith('bot_data') and name.endswith('.json'):
+            with open(os.path.join(data_dir, name), 'rb') as f:
+                stats['documents'] += store.insert_document(name, encode(json.loads(f.read())))
+    stats['seconds'] = round(time.perf_counter() - start, 2)
+    return stats
+
+def repair(data_dir: str, store: SqliteStore, ids: List[int]) -> Dict:
+    """Overwrite the database copy of each record with the one on disk now.
+    
+    Files are read inside the write transaction. The bot writes a record's file before
+    its mirror row, and can't write the row while the transaction holds the lock, so
+    the copy read is never older than the row it replaces; a bot write that comes after
+    the read lands after the commit.
+    """
+    users_dir = os.path.join(data_dir, 'users')
+    stats = {'rewritten': 0, 'gone': 0, 'unreadable': []}
+    for chunk in _batches(sorted(ids), TRANSACTION_ROWS):
+        with store.transaction():
+            for user_id in chunk:
+                try:
+                    data = _load(users_dir, user_id)
+                except FileNotFoundError:
+                    stats['gone'] += 1
+                    continue
+                except (OSError, ValueError):
+                    stats['unreadable'].append(user_id)
+                    continue
+                if store.read_user(user_id) != data:
+                    store.write_user(user_id, data)
+                    stats['rewritten'] += 1
+    return stats
+
+def verify(data_dir: str, store: SqliteStore, workers: int, batch_size: int, deep: bool) -> Dict:
+    """Compare record counts and ids (and with deep, every record and bot data file)"""
+    users_dir = os.path.join(data_dir, 'users')
+    ids = source_ids(users_dir)
+    target_ids = set(store.user_ids())
+    source = set(ids)
+    result = {
+        'source_users': len(ids),
+        'target_users': len(target_ids),
+        'missing': sorted(source - target_ids),
+        'extra': sorted(target_ids - source),
+        'differing': []
+    }
+    if deep:
+        present = [user_id for user_id in ids if user_id in target_ids]
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            for _, (missing, differing) in _stream(executor, compare_batch, _batches(present, batch_size),
+                                                   users_dir, store.path, window=workers * 2):
+                result['missing'].extend(missing)
+                result['differing'].extend(differing)
+        for name in sorted(os.listdir(data_dir)):
+            if name.startswith('bot_data') and name.endswith('.json'):
+                with open(os.path.join(data_dir, name), 'rb') as f:
+                    if store.read_document(name) != json.loads(f.read()):
+                        result['differing'].append(name)
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--data-dir', default='data')
+    parser.add_argument('--target', help="database file (default: STORAGE_MIRROR, or lumi.sqlite3, in the data dir)")
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--batch-size', type=int, default=500)
+    parser.add_argument('--restart', action='store_true', help="ignore the checkpoint and scan every record again")
+    parser.add_argument('--verify-only', action='store_true')
+    parser.add_argument('--deep', action='store_true', help="compare every record, not just counts and ids")
+    parser.add_argument('--repair', action='store_true',
+                        help="rewrite missing and differing records from disk (always on when migrating)")
+    args = parser.parse_args()
+    
+    target = args.target or os.path.join(args.data_dir, os.getenv('STORAGE_MIRROR') or 'lumi.sqlite3')
+    store = SqliteStore(target)
+    if args.restart:
+        store.set_meta(CHECKPOINT_KEY, '0')
+    
+    if not args.verify_only:
+        print(f"Migrating {args.data_dir} into {target} with {args.workers} workers")
+        stats = migrate(args.data_dir, store, args.workers, args.batch_size)
+        print(f"{stats['source']} records on disk, {stats['skipped_by_checkpoint']} done in an earlier run; "
+              f"read {stats['read']}, inserted {stats['inserted']} "
+              f"({stats['read'] - stats['inserted']} already mirrored), {len(stats['unreadable'])} unreadable; "
+              f"{stats['documents']} bot data files in {stats['seconds']}s")
+        if stats['unreadable']:
+            print(f"Unreadable: {stats['unreadable'][:20]}")
+    
+    result = verify(args.data_dir, store, args.workers, args.batch_size, args.deep)
+    print(f"Verify: {result['source_users']} records on disk, {result['target_users']} in the database, "
+          f"{len(result['missing'])} missing, {len(result['extra'])} extra"
+          + (f", {len(result['differing'])} differing" if args.deep else ""))
+    for key in ('missing', 'extra', 'differing'):
+        if result[key]:
+            print(f"  {key}: {result[key][:20]}")
+    
+    broken = [user_id for user_id in result['missing'] + result['differing'] if isinstance(user_id, int)]
+    if broken and (args.repair or not args.verify_only):
+        stats = repair(args.data_dir, store, broken)
+        missing, differing = compare_batch(os.path.join(args.data_dir, 'users'), target, sorted(broken))
+        result['missing'], result['differing'] = missing, differing + [
+            name for name in result['differing'] if not isinstance(name, int)]
+        print(f"Repair: rewrote {stats['rewritten']} records from disk ({stats['gone']} deleted meanwhile, "
+              f"{len(stats['unreadable'])} unreadable); {len(missing)} missing and {len(differing)} differing after")
+    store.close()
+    if result['missing'] or result['differing']:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
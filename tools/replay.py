@@ -0,0 +1,325 @@
+"""End-to-end load harness replaying synthetic updates through the real bot.
+
+Builds the Application from bot.build_application() with a stub HTTP layer that
+records Bot API calls and simulates their latency, then feeds a mix of /start,
+browse, like, chat text and photo and admin updates at a target rate against a
+scratch dataset (see tools.gen_dataset). Reports handler latency percentiles,
+throughput and storage file reads/writes per update type.
+
+    python -m tools.replay --users 5000 --rate 200 --duration 30
+    python -m tools.replay --data /tmp/lumi-100k --mix browse=60,like=40 --json replay.json
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import shutil
+import statistics
+import tempfile
+import time
+from collections import Counter, defaultdict
+from contextvars import ContextVar
+from typing import Dict, List, Optional, Tuple
+
+from telegram import Update
+from telegram.request import BaseRequest, RequestData
+
+DEFAULT_MIX = {'start': 5, 'browse': 30, 'like': 25, 'chat_text': 30, 'chat_photo': 5, 'admin': 1}
+
+CHAT_MESSAGES = [
+    "Hey, how was your day?",
+    "I love that place, we should go sometime",
+    "What kind of music are you into?",
+    "Haha that's funny 😂",
+    "Are you free this weekend?"
+]
+
+BOT_USER = {'id': 1000000001, 'is_bot': True, 'first_name': 'Lumi', 'username': 'lumi_stub_bot'}
+
+# Update type being processed, so storage I/O can be attributed to it
+_current_kind: ContextVar[str] = ContextVar("replay_update_kind", default="other")
+
+class StubRequest(BaseRequest):
+    """Bot API stand-in: records each call and answers after a simulated latency"""
+    
+    def __init__(self, latency: float, seed: int = 1):
+        self.latency = latency
+        self.rng = random.Random(seed)
+        self.calls: Counter = Counter()
+        self.message_id = 0
+    
+    async def initialize(self):
+        pass
+    
+    async def shutdown(self):
+        pass
+    
+    async def do_request(self, url: str, method: str, request_data: Optional[RequestData] = None,
+                         read_timeout=None, write_timeout=None, connect_timeout=None,
+                         pool_timeout=None) -> Tuple[int, bytes]:
+        endpoint = url.rsplit('/', 1)[-1]
+        self.calls[endpoint] += 1
+        if self.latency:
+            await asyncio.sleep(self.rng.uniform(0.5, 1.5) * self.latency)
+        params = request_data.parameters if request_data else {}
+        return 200, json.dumps({'ok': True, 'result': self._result(endpoint, params)}).encode()
+    
+    def _result(self, endpoint: str, params: Dict):
+        if endpoint == 'getMe':
+            return BOT_USER
+        if endpoint.startswith(('send', 'edit', 'copy', 'forward')):
+            self.message_id += 1
+            return {
+                'message_id': self.message_id,
+                'date': int(time.time()),
+                'chat': {'id': int(params.get('chat_id') or 0), 'type': 'private'},
+                'from': BOT_USER
+            }
+        return True
+
+class UpdateFactory:
+    """Builds Telegram update payloads for the synthetic users"""
+    
+    def __init__(self, user_ids: List[int], chatting: List[int], admin_id: int, rng: random.Random):
+        self.user_ids = user_ids
+        self.chatting = chatting or user_ids
+        self.admin_id = admin_id
+        self.rng = rng
+        self.update_id = 0
+    
+    def _user(self, user_id: int) -> Dict:
+        return {'id': user_id, 'is_bot': False, 'first_name': f"User {user_id}"}
+    
+    def _message(self, user_id: int, **fields) -> Dict:
+        self.update_id += 1
+        return {
+            'message_id': self.update_id,
+            'date': int(time.time()),
+            'chat': {'id': user_id, 'type': 'private'},
+            'from': self._user(user_id),
+            **fields
+        }
+    
+    def command(self, user_id: int, text: str) -> Dict:
+        length = len(text.split()[0])
+        return {'message': self._message(user_id, text=text,
+                                         entities=[{'type': 'bot_command', 'offset': 0, 'length': length}])}
+    
+    def callback(self, user_id: int, data: str) -> Dict:
+        self.update_id += 1
+        return {'callback_query': {
+            'id': str(self.update_id),
+            'from': self._user(user_id),
+            'chat_instance': str(user_id),
+            'data': data,
+            'message': {**self._message(user_id, text="…"), 'from': BOT_USER}
+        }}
+    
+    def make(self, kind: str) -> Dict:
+        user_id = self.rng.choice(self.user_ids)
+        if kind == 'start':
+            payload = self.command(user_id, '/start')
+        elif kind == 'browse':
+            payload = self.callback(user_id, 'find_match')
+        elif kind == 'like':
+            payload = self.callback(user_id, f"like_{self.rng.choice(self.user_ids)}")
+        elif kind == 'chat_text':
+            payload = {'message': self._message(self.rng.choice(self.chatting), text=self.rng.choice(CHAT_MESSAGES))}
+        elif kind == 'chat_photo':
+            payload = {'message': self._message(self.rng.choice(self.chatting), photo=[{
+                'file_id': f"AgACAgQAAxkBAAI{self.update_id:08d}", 'file_unique_id': str(self.update_id),
+                'width': 800, 'height': 600
+            }])}
+        elif kind == 'admin':
+            payload = self.command(self.admin_id, '/stats')
+        else:
+            raise ValueError(f"Unknown update kind: {kind}")
+        payload['update_id'] = self.update_id
+        return payload
+
+def count_storage_io(io: Dict[str, Counter]):
+    """Attribute storage file reads and writes to the update type being processed"""
+    from utils.storage import Storage
+    
+    load_json, save_json = Storage._load_json, Storage._save_json
+    
+    def counted_load(self, filepath):
+        io[_current_kind.get()]['reads'] += 1
+        return load_json(self, filepath)
+    
+    def counted_save(self, filepath, data):
+        io[_current_kind.get()]['writes'] += 1
+        return save_json(self, filepath, data)
+    
+    Storage._load_json, Storage._save_json = counted_load, counted_save
+
+def open_chats(pairs: int) -> List[int]:
+    """Put some matched pairs into chat mode so chat updates are relayed; returns the chatting users"""
+    from utils.storage import Storage
+    
+    storage = Storage()
+    chatting = []
+    with storage.unit_of_work():
+        for key, matches in list(storage.bot_data.items()):
+            if len(chatting) >= pairs * 2:
+                break
+            if not key.startswith('matches_') or not matches:
+                continue
+            user_id, partner_id = int(key[len('matches_'):]), matches[0]
+            if user_id in chatting or partner_id in chatting:
+                continue
+            storage.set_bot_property(f"chat_{user_id}", partner_id)
+            storage.set_bot_property(f"chat_{partner_id}", user_id)
+            chatting += [user_id, partner_id]
+    return chatting
+
+def percentile(ordered: List[float], pct: float) -> float:
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+async def replay(args, mix: Dict[str, float]) -> Dict:
+    # Imported here: storage binds ./data, which must be the scratch copy
+    import bot
+    from config import ADMIN_ID
+    from utils.storage import Storage
+    logging.getLogger().setLevel(logging.WARNING)
+    
+    io: Dict[str, Counter] = defaultdict(Counter)
+    count_storage_io(io)
+    
+    storage = Storage()
+    banned = set(storage.get_bot_property('banned_users') or [])
+    user_ids = [p['id'] for p in storage.get_profiles() if p['id'] not in banned]
+    factory = UpdateFactory(user_ids, open_chats(args.chats), ADMIN_ID, random.Random(args.seed))
+    
+    request = StubRequest(args.latency, args.seed)
+    if args.outbound_rate:
+        bot.outbound.global_rate = args.outbound_rate
+    application = bot.build_application(token="1000000001:replay", request=request)
+    
+    errors: Counter = Counter()
+    
+    async def on_error(update, context):
+        errors[_current_kind.get()] += 1
+        if sum(errors.values()) == 1:
+            logging.getLogger(__name__).error("First handler error", exc_info=context.error)
+    application.add_error_handler(on_error)
+    
+    latencies: Dict[str, List[float]] = defaultdict(list)
+    
+    async def process(kind: str, payload: Dict):
+        _current_kind.set(kind)
+        update = Update.de_json(payload, application.bot)
+        start = time.perf_counter()
+        await application.update_processor.process_update(update, application.process_update(update))
+        latencies[kind].append((time.perf_counter() - start) * 1000)
+    
+    kinds, weights = list(mix), list(mix.values())
+    rng = random.Random(args.seed)
+    total = int(args.rate * args.duration)
+    
+    await application.initialize()
+    await application.start()
+    io.clear()
+    try:
+        tasks = []
+        start = time.perf_counter()
+        for i in range(total):
+            # Open loop: updates arrive on schedule whether or not earlier ones finished
+            delay = start + i / args.rate - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            kind = rng.choices(kinds, weights)[0]
+            tasks.append(asyncio.create_task(process(kind, factory.make(kind))))
+        await asyncio.gather(*tasks)
+        elapsed = time.perf_counter() - start
+    finally:
+        await application.stop()
+        await application.shutdown()
+    
+    report = {
+        'updates': total,
+        'elapsed_s': round(elapsed, 3),
+        'target_rate': args.rate,
+        'throughput': round(total / elapsed, 1),
+        'kinds': {},
+        'bot_api_calls': dict(request.calls),
+        'outbound': bot.outbound.stats()
+    }
+    for kind, values in sorted(latencies.items()):
+        ordered = sorted(values)
+        report['kinds'][kind] = {
+            'count': len(ordered),
+            'errors': errors[kind],
+            'p50_ms': round(percentile(ordered, 50), 3),
+            'p95_ms': round(percentile(ordered, 95), 3),
+            'p99_ms': round(percentile(ordered, 99), 3),
+            'mean_ms': round(statistics.fmean(ordered), 3),
+            'reads_per_update': round(io[kind]['reads'] / len(ordered), 2),
+            'writes_per_update': round(io[kind]['writes'] / len(ordered), 2)
+        }
+    return report
+
+def print_report(report: Dict):
+    print(f"{report['updates']} updates in {report['elapsed_s']:.2f}s: "
+          f"{report['throughput']}/s (target {report['target_rate']}/s)")
+    print(f"{'update':12} {'count':>7} {'errors':>7} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} "
+          f"{'reads':>7} {'writes':>7}")
+    for kind, row in report['kinds'].items():
+        print(f"{kind:12} {row['count']:>7} {row['errors']:>7} {row['p50_ms']:>9.2f} {row['p95_ms']:>9.2f} "
+              f"{row['p99_ms']:>9.2f} {row['reads_per_update']:>7.2f} {row['writes_per_update']:>7.2f}")
+    calls = ', '.join(f"{name} {count}" for name, count in sorted(report['bot_api_calls'].items()))
+    print(f"Bot API calls: {calls}")
+
+def parse_mix(text: Optional[str]) -> Dict[str, float]:
+    if not text:
+        return dict(DEFAULT_MIX)
+    mix = {}
+    for part in text.split(','):
+        kind, _, weight = part.partition('=')
+        if kind.strip() not in DEFAULT_MIX:
+            raise SystemExit(f"Unknown update kind '{kind}'; expected one of {', '.join(DEFAULT_MIX)}")
+        mix[kind.strip()] = float(weight or 1)
+    return mix
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=2000, help="size of the generated dataset")
+    parser.add_argument('--data', help="existing dataset directory (containing data/) instead of generating one")
+    parser.add_argument('--rate', type=float, default=100, help="updates per second")
+    parser.add_argument('--duration', type=float, default=10, help="seconds of traffic")
+    parser.add_argument('--mix', help="update mix, e.g. browse=30,like=25,chat_text=30 "
+                                      f"(kinds: {', '.join(DEFAULT_MIX)})")
+    parser.add_argument('--latency', type=float, default=0.05, help="mean simulated Bot API latency (s)")
+    parser.add_argument('--outbound-rate', type=float,
+                        help="override the global outbound rate limit (default: production setting)")
+    parser.add_argument('--chats', type=int, default=200, help="matched pairs put in chat mode")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', help="write the report as JSON to this file")
+    args = parser.parse_args()
+    
+    mix = parse_mix(args.mix)
+    json_path = os.path.abspath(args.json) if args.json else None
+    
+    # Handlers write to storage, so always work on a throwaway copy
+    scratch = tempfile.mkdtemp(prefix="lumi-replay-")
+    if args.data:
+        shutil.copytree(os.path.join(args.data, 'data'), os.path.join(scratch, 'data'))
+    else:
+        from tools.gen_dataset import generate
+        generate(scratch, args.users, args.seed)
+    os.chdir(scratch)
+    
+    try:
+        report = asyncio.run(replay(args, mix))
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+    
+    print_report(report)
+    if json_path:
+        with open(json_path, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,130 @@
+"""Concurrency stress test for likes and matches.
+
+Fires many concurrent like updates through the real handlers (with the per-user
+context and locks) against a throwaway data directory, then checks that no like
+or match was lost, both in memory and on disk.
+
+    python -m tools.stress_likes --users 200 --likes 20
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+
+class StubBot:
+    """Bot stand-in that yields to the event loop like a real API call"""
+    
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.calls = 0
+    
+    async def _call(self, *args, **kwargs):
+        self.calls += 1
+        await asyncio.sleep(random.uniform(0, self.latency))
+    
+    send_message = send_photo = edit_message_text = _call
+
+def make_like_update(bot: StubBot, user_id: int, liked_id: int):
+    user = SimpleNamespace(id=user_id, first_name=f"User {user_id}", username=None)
+    query = SimpleNamespace(
+        from_user=user,
+        data=f"like_{liked_id}",
+        message=SimpleNamespace(chat_id=user_id),
+        edit_message_text=bot.edit_message_text,
+        answer=bot._call
+    )
+    return SimpleNamespace(update_id=0, effective_user=user, callback_query=query,
+                           effective_chat=SimpleNamespace(id=user_id))
+
+def seed_users(users_dir: str, count: int):
+    for user_id in range(1, count + 1):
+        with open(os.path.join(users_dir, f"{user_id}.json"), 'w', encoding='utf-8') as f:
+            json.dump({
+                'name': f"User {user_id}",
+                'gender': 'Male' if user_id % 2 else 'Female',
+                'interest': 'Female' if user_id % 2 else 'Male',
+                'age': 18 + user_id % 40,
+                'profile_photo': f"photo_{user_id}",
+                'is_registered': True,
+                'is_premium': True
+            }, f)
+
+async def run(args) -> int:
+    from handlers import matching
+    from utils.context import with_user_context
+    from utils.storage import Storage
+    
+    storage = Storage()
+    bot = StubBot(args.latency)
+    context = SimpleNamespace(bot=bot, application=SimpleNamespace(create_task=asyncio.ensure_future))
+    like = with_user_context(matching.like_user)
+    
+    rng = random.Random(args.seed)
+    user_ids = list(range(1, args.users + 1))
+    plan = []
+    for user_id in user_ids:
+        for liked_id in rng.sample([u for u in user_ids if u != user_id], args.likes):
+            plan.append((user_id, liked_id))
+    # Make sure plenty of pairs like each other at the same time
+    plan += [(b, a) for a, b in plan[:len(plan) // 4]]
+    rng.shuffle(plan)
+    
+    start = time.perf_counter()
+    await asyncio.gather(*(like(make_like_update(bot, a, b), context) for a, b in plan))
+    elapsed = time.perf_counter() - start
+    
+    liked = {}
+    for a, b in plan:
+        liked.setdefault(a, set()).add(b)
+    
+    def load(path):
+        with open(path, encoding='utf-8') as f:
+            return json.load(f)
+    
+    disk_bot = load(storage.bot_data_file)
+    errors = []
+    for a, targets in liked.items():
+        disk_user = load(os.path.join(storage.users_dir, f"{a}.json"))
+        if set(disk_user.get('liked_users', [])) != targets:
+            errors.append(f"user {a}: liked_users mismatch")
+        for b in targets:
+            if a not in (disk_bot.get(f"likes_{b}") or []):
+                errors.append(f"like {a}->{b} lost")
+            mutual = a in liked.get(b, ())
+            if mutual and b not in (disk_bot.get(f"matches_{a}") or []):
+                errors.append(f"match {a}<->{b} lost")
+            if not mutual and b in (disk_bot.get(f"matches_{a}") or []):
+                errors.append(f"spurious match {a}<->{b}")
+    
+    pairs = sum(1 for a, t in liked.items() for b in t if a < b and a in liked.get(b, ()))
+    print(f"{len(plan)} like updates, {pairs} mutual pairs, {bot.calls} bot calls in {elapsed:.2f}s")
+    for error in errors[:20]:
+        print(f"FAIL {error}")
+    print("FAILED" if errors else "OK: no lost likes or matches")
+    return 1 if errors else 0
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--likes', type=int, default=20, help="likes sent per user")
+    parser.add_argument('--latency', type=float, default=0.005, help="max simulated API latency (s)")
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+    
+    # Storage uses ./data, so run against a scratch directory
+    os.chdir(tempfile.mkdtemp(prefix="lumi-stress-"))
+    os.makedirs(os.path.join("data", "users"))
+    seed_users(os.path.join("data", "users"), args.users)
+    # Import the handlers before the loop starts, as bot.py does, so module-level asyncio
+    # objects (locks, the outbound scheduler) are exercised the way production builds them
+    import handlers.matching
+    
+    sys.exit(asyncio.run(run(args)))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,57 @@
+import time
+from typing import Dict, Iterable, Optional
+from utils import warm_state
+from utils.storage import Storage
+from config import ACTIVITY_FLUSH_INTERVAL
+
+storage = Storage()
+
+class ActivityTracker:
+    """In-memory last-active table.
+    
+    Every update stamps the table; the stamp is persisted to the user's record as
+    `last_active` (epoch seconds) at most once per flush interval, riding on the
+    update's own unit of work, so chatty users cost no extra writes. Users this
+    process hasn't seen fall back to the `last_active` of their record or profile.
+    """
+    
+    def __init__(self, flush_interval: float = ACTIVITY_FLUSH_INTERVAL):
+        self.flush_interval = flush_interval
+        self.seen: Dict[int, float] = {}
+        self.flushed: Dict[int, float] = {}
+    
+    def touch(self, user_id: int, record: Dict, now: Optional[float] = None):
+        """Stamp the user as active; `record` is their current record"""
+        now = time.time() if now is None else now
+        self.seen[user_id] = now
+        # Users who never started the bot have no record to stamp
+        if record and now - self.flushed.get(user_id, 0) >= self.flush_interval:
+            self.flushed[user_id] = now
+            storage.set_user_property(user_id, 'last_active', int(now))
+    
+    def last_active(self, user_id: int, record: Optional[Dict] = None) -> Optional[float]:
+        """Last activity time, or None if unknown"""
+        return self.seen.get(user_id) or (record or {}).get('last_active')
+    
+    def is_active(self, user_id: int, days: float, record: Optional[Dict] = None,
+                  now: Optional[float] = None) -> bool:
+        """Whether the user was active within the last `days` days"""
+        last_active = self.last_active(user_id, record)
+        now = time.time() if now is None else now
+        return last_active is not None and now - last_active <= days * 86400
+    
+    def count_active(self, records: Iterable[Dict], days: float) -> int:
+        """Number of user records active within the last `days` days"""
+        now = time.time()
+        return sum(1 for record in records if record.get('user_id')
+                   and self.is_active(record['user_id'], days, record, now))
+
+    def dump(self) -> Dict[int, float]:
+        return self.seen
+    
+    def restore(self, seen: Dict[int, float]):
+        # Stamps already taken since boot are newer
+        self.seen = {**seen, **self.seen}
+
+activity = ActivityTracker()
+warm_state.register('activity', activity.dump, activity.restore, session=True)
@@ -0,0 +1,283 @@
+import asyncio
+import fcntl
+import io
+import json
+import logging
+import os
+import tarfile
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional, Tuple
+from utils import storage as storage_module
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_NAME = 'manifest.json'
+
+# Marker for files left out of an incremental snapshot because they did not change
+_UNCHANGED = object()
+
+def data_files(data_dir: str) -> Iterator[str]:
+    """Paths (relative to data_dir) of the files that make up the store"""
+    for entry in os.scandir(data_dir):
+        if entry.is_file() and entry.name.startswith('bot_data') and entry.name.endswith('.json'):
+            yield entry.name
+    users_dir = os.path.join(data_dir, 'users')
+    if os.path.isdir(users_dir):
+        for entry in os.scandir(users_dir):
+            if entry.name.endswith('.json'):
+                yield f"users/{entry.name}"
+
+class Snapshot:
+    """Point-in-time copy of the data directory, taken while the bot keeps writing.
+    
+    Storage replaces files atomically and a unit of work flushes without yielding to
+    the event loop, so the files on disk at any await point form a consistent state.
+    The snapshot fixes that moment in begin() and then archives in a thread: storage
+    reports each file it is about to replace or delete, and the first time that happens
+    to a file the archive hasn't reached yet, its current contents are kept aside
+    (copy-on-write). Only writes of this process are seen.
+    """
+    
+    def __init__(self, data_dir: str, base: Optional[Dict] = None):
+        self.data_dir = data_dir
+        self.base = base
+        self.lock = threading.Lock()
+        self.done = set()
+        self.preserved: Dict[str, Optional[Tuple[bytes, int]]] = {}
+        self.started_ns = 0
+    
+    def begin(self):
+        """Fix the snapshot's point in time (call on the event loop, between updates)"""
+        self.started_ns = time.time_ns()
+        storage_module.add_write_observer(self.before_write)
+    
+    def end(self):
+        storage_module.remove_write_observer(self.before_write)
+    
+    def before_write(self, path: str):
+        rel = os.path.relpath(path, self.data_dir).replace(os.sep, '/')
+        with self.lock:
+            if rel not in self.done and rel not in self.preserved:
+                self.preserved[rel] = self._read(path)
+    
+    def _read(self, path: str) -> Optional[Tuple[bytes, int]]:
+        try:
+            mtime = os.stat(path).st_mtime_ns
+            with open(path, 'rb') as f:
+                return f.read(), mtime
+        except FileNotFoundError:
+            return None
+    
+    def _capture(self, rel: str, since_ns: int):
+        """Contents of a file as of the snapshot (None if it didn't exist then)"""
+        path = os.path.join(self.data_dir, rel)
+        with self.lock:
+            self.done.add(rel)
+            if rel in self.preserved:
+                content = self.preserved.pop(rel)
+            else:
+                try:
+                    if os.stat(path).st_mtime_ns < since_ns:
+                        return _UNCHANGED
+                except FileNotFoundError:
+                    return None
+                content = self._read(path)
+        if content is not None and content[1] < since_ns:
+            return _UNCHANGED
+        return content
+    
+    def write_archive(self, archive_path: str, compresslevel: int = 3) -> Dict:
+        """Write the snapshot as a gzipped tar; incremental snapshots hold only files changed since the base"""
+        since_ns = self.base['started_ns'] if self.base else 0
+        with self.lock:
+            files = set(data_files(self.data_dir)) | set(self.preserved)
+        # Bot data first: it is rewritten most often, so keeping it aside is most likely
+        ordered = sorted(files, key=lambda rel: (rel.startswith('users/'), rel))
+        
+        present, included, size = [], 0, 0
+        tmp_path = f"{archive_path}.tmp"
+        with tarfile.open(tmp_path, 'w:gz', compresslevel=compresslevel) as tar:
+            for rel in ordered:
+                content = self._capture(rel, since_ns)
+                if content is None:
+                    continue
+                present.append(rel)
+                if content is _UNCHANGED:
+                    continue
+                data, mtime = content
+                info = tarfile.TarInfo(rel)
+                info.size = len(data)
+                info.mtime = mtime / 1e9
+                tar.addfile(info, io.BytesIO(data))
+                included += 1
+                size += len(data)
+            
+            manifest = {
+                'id': os.path.basename(archive_path),
+                'type': 'incremental' if self.base else 'full',
+                'base': self.base['id'] if self.base else None,
+                'started_ns': self.started_ns,
+                'created': int(time.time()),
+                'files_total': len(present),
+                'files_included': included,
+                'bytes': size
+            }
+            raw = json.dumps({**manifest, 'files': present}).encode('utf-8')
+            info = tarfile.TarInfo(MANIFEST_NAME)
+            info.size = len(raw)
+            info.mtime = time.time()
+            tar.addfile(info, io.BytesIO(raw))
+        os.replace(tmp_path, archive_path)
+        
+        manifest['archive_bytes'] = os.path.getsize(archive_path)
+        with open(f"{archive_path}.json", 'w', encoding='utf-8') as f:
+            json.dump(manifest, f, indent=2)
+        return manifest
+
+def list_snapshots(backup_dir: str) -> List[Dict]:
+    """Manifests of the snapshots in a directory, oldest first"""
+    manifests = []
+    if os.path.isdir(backup_dir):
+        for name in os.listdir(backup_dir):
+            if name.endswith('.tar.gz.json'):
+                with open(os.path.join(backup_dir, name), encoding='utf-8') as f:
+                    manifests.append(json.load(f))
+    return sorted(manifests, key=lambda manifest: manifest['started_ns'])
+
+def restore_chain(backup_dir: str) -> List[str]:
+    """Archives to restore for the latest state: the last full snapshot and its incrementals"""
+    by_id = {manifest['id']: manifest for manifest in list_snapshots(backup_dir)}
+    if not by_id:
+        return []
+    chain = [max(by_id.values(), key=lambda manifest: manifest['started_ns'])]
+    while chain[-1]['base'] is not None:
+        base = by_id.get(chain[-1]['base'])
+        if base is None:
+            raise FileNotFoundError(f"Base snapshot {chain[-1]['base']} of {chain[-1]['id']} is missing")
+        chain.append(base)
+    return [os.path.join(backup_dir, manifest['id']) for manifest in reversed(chain)]
+
+def _new_snapshot(data_dir: str, backup_dir: str, incremental: bool) -> Tuple[Snapshot, str]:
+    os.makedirs(backup_dir, exist_ok=True)
+    snapshots = list_snapshots(backup_dir)
+    base = snapshots[-1] if incremental and snapshots else None
+    kind = 'inc' if base else 'full'
+    now = time.time()
+    stamp = time.strftime('%Y%m%d-%H%M%S', time.localtime(now)) + f"{int(now * 1000) % 1000:03d}"
+    archive_path = os.path.join(backup_dir, f"snapshot-{stamp}-{kind}.tar.gz")
+    return Snapshot(data_dir, base), archive_path
+
+_snapshot_running = False
+
+async def create_online(data_dir: str, backup_dir: str, incremental: bool = False,
+                        compresslevel: int = 3) -> Dict:
+    """Snapshot the store from inside the running bot without pausing updates"""
+    global _snapshot_running
+    if _snapshot_running:
+        raise RuntimeError("A snapshot is already running")
+    _snapshot_running = True
+    try:
+        snapshot, archive_path = _new_snapshot(data_dir, backup_dir, incremental)
+        snapshot.begin()
+        try:
+            return await asyncio.to_thread(snapshot.write_archive, archive_path, compresslevel)
+        finally:
+            snapshot.end()
+    finally:
+        _snapshot_running = False
+
+def create_offline(data_dir: str, backup_dir: str, incremental: bool = False, compresslevel: int = 3) -> Dict:
+    """Snapshot the store while the bot is stopped"""
+    snapshot, archive_path = _new_snapshot(data_dir, backup_dir, incremental)
+    snapshot.begin()
+    try:
+        return snapshot.write_archive(archive_path, compresslevel)
+    finally:
+        snapshot.end()
+
+RUNNING_LOCK_NAME = '.running.lock'
+
+# Held (shared) by every bot process for its lifetime; the kernel drops it when the process exits
+_running_lock = None
+
+def mark_running(data_dir: str):
+    """Note that a bot process is using data_dir, so a restore refuses to run"""
+    global _running_lock
+    if _running_lock is None:
+        _running_lock = open(os.path.join(data_dir, RUNNING_LOCK_NAME), 'a')
+        fcntl.flock(_running_lock, fcntl.LOCK_SH)
+
+@contextmanager
+def _bot_stopped(data_dir: str):
+    """Hold data_dir exclusively; raises RuntimeError if a bot process is using it"""
+    with open(os.path.join(data_dir, RUNNING_LOCK_NAME), 'a') as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            raise RuntimeError(f"The bot is running on {data_dir}; stop it before restoring") from None
+        yield
+
+def read_manifest(archive: str) -> Dict:
+    """Manifest of an archive, from its sidecar file or else from the archive itself"""
+    try:
+        with open(f"{archive}.json", encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        pass
+    with tarfile.open(archive, 'r|gz') as tar:
+        for member in tar:
+            if member.name == MANIFEST_NAME:
+                return json.load(tar.extractfile(member))
+    raise ValueError(f"{archive} has no manifest")
+
+def check_chain(archives: List[str]) -> List[Dict]:
+    """Manifests of a restore chain after checking it starts full and each link follows the last"""
+    manifests = [read_manifest(archive) for archive in archives]
+    for i, (archive, manifest) in enumerate(zip(archives, manifests)):
+        if i == 0 and manifest['type'] != 'full':
+            raise ValueError(f"{archive} is incremental; restore starts from a full snapshot")
+        if i > 0 and manifest['base'] != manifests[i - 1]['id']:
+            raise ValueError(f"{archive} does not follow {manifests[i - 1]['id']}")
+    return manifests
+
+def restore(archives: List[str], data_dir: str) -> Dict[str, int]:
+    """Stream a full snapshot and its incrementals (in order) into data_dir.
+    
+    The chain is checked before anything is written, and the restore refuses to run
+    while a bot process is using data_dir.
+    """
+    os.makedirs(data_dir, exist_ok=True)
+    with _bot_stopped(data_dir):
+        expected = check_chain(archives)
+        manifest, restored = None, 0
+        for archive, checked in zip(archives, expected):
+            manifest = None
+            with tarfile.open(archive, 'r|gz') as tar:
+                for member in tar:
+                    if member.name == MANIFEST_NAME:
+                        manifest = json.load(tar.extractfile(member))
+                        continue
+                    rel = os.path.normpath(member.name)
+                    if not member.isfile() or rel.startswith('..') or os.path.isabs(rel):
+                        raise ValueError(f"Unexpected entry {member.name} in {archive}")
+                    target = os.path.join(data_dir, rel)
+                    os.makedirs(os.path.dirname(target), exist_ok=True)
+                    tmp_path = f"{target}.restore.tmp"
+                    with open(tmp_path, 'wb') as f:
+                        f.write(tar.extractfile(member).read())
+                    os.replace(tmp_path, target)
+                    restored += 1
+            if manifest is None or manifest['id'] != checked['id']:
+                raise ValueError(f"{archive} does not match its manifest file")
+        
+        # Files created after the last snapshot are not part of the restored state
+        removed = 0
+        if manifest is not None:
+            keep = set(manifest['files'])
+            for rel in list(data_files(data_dir)):
+                if rel not in keep:
+                    os.remove(os.path.join(data_dir, rel))
+                    removed += 1
+    return {'restored': restored, 'removed': removed}
@@ -0,0 +1,102 @@
+from collections import OrderedDict
+from typing import Dict, Hashable, Optional, Tuple
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.constants import ParseMode
+from utils import metrics
+
+from config import CARD_CACHE_SIZE
+
+class ProfileCard:
+    """Rendered profile: caption and photo, plus the per-viewer keyboards built on demand"""
+    
+    __slots__ = ('profile_id', 'caption', 'parse_mode', 'photo', 'username', '_markups')
+    
+    def __init__(self, profile_id: int, caption: str, photo: Optional[str], username: Optional[str] = None):
+        self.profile_id = profile_id
+        self.caption = caption
+        self.parse_mode = ParseMode.MARKDOWN
+        self.photo = photo
+        self.username = username
+        self._markups: Dict[bool, InlineKeyboardMarkup] = {}
+    
+    def markup(self, viewer_is_premium: bool) -> InlineKeyboardMarkup:
+        """Like/Pass buttons plus the chat link or upgrade prompt for this kind of viewer"""
+        markup = self._markups.get(viewer_is_premium)
+        if markup is None:
+            buttons = [
+                [
+                    InlineKeyboardButton("❤️ Like", callback_data=f"like_{self.profile_id}"),
+                    InlineKeyboardButton("❌ Pass", callback_data="find_match")
+                ]
+            ]
+            
+            if viewer_is_premium and self.username:
+                buttons.append([InlineKeyboardButton("💬 Chat", url=f"https://t.me/{self.username}")])
+            elif not viewer_is_premium:
+                buttons.append([InlineKeyboardButton("🔒 Upgrade to Premium to Chat", callback_data="upgrade")])
+            
+            markup = self._markups[viewer_is_premium] = InlineKeyboardMarkup(buttons)
+        return markup
+
+class CardCache:
+    """LRU of rendered cards keyed by profile id and profile version"""
+    
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.cards: "OrderedDict[Tuple, ProfileCard]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+    
+    def get(self, key: Hashable) -> Optional[ProfileCard]:
+        card = self.cards.get(key)
+        if card is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self.cards.move_to_end(key)
+        return card
+    
+    def put(self, key: Hashable, card: ProfileCard):
+        self.cards[key] = card
+        if len(self.cards) > self.capacity:
+            self.cards.popitem(last=False)
+
+match_cards = CardCache(CARD_CACHE_SIZE)
+self_cards = CardCache(CARD_CACHE_SIZE // 10)
+
+metrics.register_cache('match_cards', match_cards)
+metrics.register_cache('self_cards', self_cards)
+
+def match_card(profile: Dict) -> ProfileCard:
+    """Card shown to other users while browsing"""
+    key = (profile['id'], profile.get('version', 0))
+    card = match_cards.get(key)
+    if card is None:
+        caption = f"""💘 *Match Found!*
+🧑 Name: *{profile['name']}*
+🚻 Gender: *{profile['gender']}*
+🎂 Age: *{profile['age']}*
+📍 Location: *{profile['location']}*
+📝 Bio: {profile['bio']}
+
+🎉😍"""
+        card = ProfileCard(profile['id'], caption, profile.get('photo'), profile.get('username'))
+        match_cards.put(key, card)
+    return card
+
+def self_card(user_id: int, user_data: Dict, premium_tag: str) -> ProfileCard:
+    """Card a user sees when previewing their own profile"""
+    key = (user_id, user_data.get('profile_version', 0), premium_tag)
+    card = self_cards.get(key)
+    if card is None:
+        caption = f"""👤 *Your Profile Preview*
+
+🧑 Name: *{user_data.get('name', 'Anonymous')}* {premium_tag}
+🚻 Gender: *{user_data.get('gender', 'Unknown')}*
+🎂 Age: *{user_data.get('age', 'N/A')}*
+📍 Location: *{user_data.get('location', 'Not set')}*
+📝 Bio: _{user_data.get('bio', 'No bio yet')}_
+🆔 Username: @{user_data.get('username', 'N/A')}"""
+        card = ProfileCard(user_id, caption, user_data.get('profile_photo'))
+        self_cards.put(key, card)
+    return card
@@ -0,0 +1,103 @@
+import asyncio
+import logging
+import os
+import time
+from typing import Dict, Iterable, List, Set
+from utils import metrics, storage as storage_module
+from utils.sharding import key_user
+from utils.storage import Storage
+
+logger = logging.getLogger(__name__)
+
+storage = Storage()
+
+COMPACTION_REMOVED = metrics.counter('lumi_compaction_removed_total', "Bot data entries removed by compaction",
+                                     ('kind',))
+COMPACTION_RECLAIMED = metrics.counter('lumi_compaction_reclaimed_bytes_total',
+                                       "Bytes of bot data reclaimed by compaction")
+
+def record_ids(users_dir: str) -> Set[int]:
+    """Ids of the users that have a record on disk"""
+    ids = set()
+    for entry in os.scandir(users_dir):
+        if entry.name.endswith('.json'):
+            try:
+                ids.add(int(entry.name[:-5]))
+            except ValueError:
+                continue
+    return ids
+
+def stale_keys(bot_data: Dict, existing: Set[int]) -> Dict[str, List[str]]:
+    """Keys that can go: None tombstones and per-user keys of users without a record"""
+    found = {'tombstone': [], 'orphaned': []}
+    for key, value in bot_data.items():
+        if value is None:
+            found['tombstone'].append(key)
+            continue
+        user_id = key_user(key)
+        if user_id is not None and user_id not in existing:
+            found['orphaned'].append(key)
+    return found
+
+def live_boosts(boosted: Iterable[int], now_ms: int) -> List[int]:
+    """Boosted profile ids whose boost hasn't run out"""
+    return [user_id for user_id in boosted
+            if (storage.get_user_property(user_id, 'boost_expires_at') or 0) > now_ms]
+
+def _file_size(path: str) -> int:
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+def compact(existing: Set[int]) -> Dict[str, int]:
+    """Remove stale bot data and rewrite it once; `existing` is record_ids() of the data dir.
+    
+    A worker process can't remove keys (its shard file only overlays bot_data.json), so
+    there only shard 0 prunes boosted_profiles; the rest is compacted by the supervisor
+    when it consolidates bot data before starting workers.
+    """
+    router = storage_module.get_router()
+    path = storage.persisted_bot_data_file()
+    before = _file_size(path)
+    removed = {'tombstone': 0, 'orphaned': 0, 'expired_boost': 0}
+    
+    with storage.unit_of_work():
+        if router is None:
+            found = stale_keys(storage.bot_data, existing)
+            # Users who registered after the listing was taken keep their keys
+            found['orphaned'] = [key for key in found['orphaned']
+                                 if not os.path.exists(os.path.join(storage.users_dir, f"{key_user(key)}.json"))]
+            storage.remove_bot_properties(found['tombstone'] + found['orphaned'])
+            removed['tombstone'] = len(found['tombstone'])
+            removed['orphaned'] = len(found['orphaned'])
+        if router is None or router.persists_key('boosted_profiles'):
+            boosted = storage.get_bot_property('boosted_profiles') or []
+            live = live_boosts(boosted, int(time.time() * 1000))
+            if len(live) < len(boosted):
+                storage.set_bot_property('boosted_profiles', live)
+                removed['expired_boost'] = len(boosted) - len(live)
+    
+    after = _file_size(path)
+    for kind, count in removed.items():
+        if count:
+            COMPACTION_REMOVED.inc(kind, amount=count)
+    reclaimed = max(0, before - after) if any(removed.values()) else 0
+    COMPACTION_RECLAIMED.inc(amount=reclaimed)
+    return {**removed, 'bytes_before': before, 'bytes_after': after, 'reclaimed': reclaimed}
+
+async def run_periodically(interval: float):
+    """Compact bot data every `interval` seconds (started from the post_init hook)"""
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            # Listing the users directory is the slow part; keep it off the event loop
+            existing = await asyncio.to_thread(record_ids, storage.users_dir)
+            start = time.perf_counter()
+            result = compact(existing)
+            logger.info("Compacted bot data in %.2fs: %d tombstones, %d orphaned keys, %d expired boosts; "
+                        "%d -> %d bytes (%d reclaimed)", time.perf_counter() - start, result['tombstone'],
+                        result['orphaned'], result['expired_boost'], result['bytes_before'],
+                        result['bytes_after'], result['reclaimed'])
+        except OSError as e:
+            logger.warning("Bot data compaction failed: %s", e)
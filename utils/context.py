@@ -0,0 +1,137 @@
+import functools
+import logging
+import re
+import time
+from contextvars import ContextVar
+from typing import Any, Callable, Dict, Optional
+from telegram import Update
+from telegram.error import TelegramError
+from telegram.ext import CallbackContext, ExtBot
+from utils.storage import Storage
+from utils.locks import user_locks
+from utils.activity import activity
+from utils.drafts import registration_state
+from utils import metrics, tracing
+from utils.sharding import RemoteCallError
+
+logger = logging.getLogger(__name__)
+
+storage = Storage()
+
+_current_user: ContextVar[Optional["UserContext"]] = ContextVar("current_user_context", default=None)
+
+HANDLER_SECONDS = metrics.histogram('lumi_handler_seconds', "Update handling time by handler and callback route",
+                                    ('handler', 'route'))
+LOCK_WAIT_SECONDS = metrics.histogram('lumi_user_lock_wait_seconds', "Time updates waited for their user's lock",
+                                      ('handler',))
+
+# Callback data with the trailing id removed (like_123 -> like); capped since clients can send any data
+_ROUTE_ID = re.compile(r'_-?\d+$')
+_MAX_ROUTES = 200
+_routes = set()
+
+def callback_route(update: Update) -> str:
+    """Metrics label for the callback route of an update, or '' for other updates"""
+    query = update.callback_query
+    if query is None or not query.data:
+        return ''
+    route = _ROUTE_ID.sub('', query.data)[:64]
+    if route not in _routes:
+        if len(_routes) >= _MAX_ROUTES:
+            return 'other'
+        _routes.add(route)
+    return route
+
+class UserContext:
+    """Request-scoped view of the acting user's record and bot keys"""
+    
+    def __init__(self, user_id: int):
+        self.user_id = user_id
+        # The single read for this update; later storage calls hit the same record
+        self.record: Dict = storage.get_user_data(user_id)
+    
+    def get(self, key: str, default: Any = None) -> Any:
+        """Get a field of the user's record"""
+        value = self.record.get(key)
+        return default if value is None else value
+    
+    def set(self, key: str, value: Any):
+        """Set a field of the user's record, written back after the handler returns"""
+        storage.set_user_property(self.user_id, key, value)
+    
+    @property
+    def is_registered(self) -> bool:
+        return bool(self.record.get('is_registered'))
+    
+    @property
+    def is_premium(self) -> bool:
+        return bool(self.record.get('is_premium'))
+    
+    @property
+    def registration_state(self) -> Optional[str]:
+        return registration_state(self.user_id, self.record)
+    
+    @property
+    def is_banned(self) -> bool:
+        return self.user_id in (storage.get_bot_property('banned_users') or [])
+    
+    @property
+    def chat_partner(self) -> Optional[int]:
+        return storage.get_bot_property(f"chat_{self.user_id}")
+
+class BotContext(CallbackContext[ExtBot, dict, dict, dict]):
+    """Callback context exposing the request-scoped user context"""
+    
+    @property
+    def user_ctx(self) -> Optional[UserContext]:
+        return _current_user.get()
+
+def current_user_context() -> Optional[UserContext]:
+    """Get the user context of the update being processed"""
+    return _current_user.get()
+
+async def _reply_unavailable(update: Update):
+    """Tell the user their action didn't go through (another worker didn't answer)"""
+    text = "⚠️ Something went wrong on our side. Please try again in a moment."
+    try:
+        if update.callback_query:
+            await update.callback_query.answer(text, show_alert=True)
+        elif update.effective_message:
+            await update.effective_message.reply_text(text)
+    except TelegramError:
+        pass
+
+def with_user_context(callback: Callable) -> Callable:
+    """Run the handler under the user's lock, loading the user once and flushing changes once"""
+    @functools.wraps(callback)
+    async def wrapper(update: Update, context: CallbackContext):
+        user = update.effective_user
+        if user is None or _current_user.get() is not None:
+            return await callback(update, context)
+        
+        route = callback_route(update)
+        name = f"{callback.__name__}:{route}" if route else callback.__name__
+        start = time.perf_counter()
+        acquired = None
+        try:
+            with tracing.update_trace(name, user.id, update.update_id):
+                async with user_locks.hold(user.id):
+                    # Waiting behind the user's earlier updates is measured apart from handling
+                    acquired = time.perf_counter()
+                    LOCK_WAIT_SECONDS.observe(acquired - start, callback.__name__)
+                    with storage.unit_of_work():
+                        user_ctx = UserContext(user.id)
+                        activity.touch(user.id, user_ctx.record)
+                        token = _current_user.set(user_ctx)
+                        try:
+                            return await callback(update, context)
+                        finally:
+                            _current_user.reset(token)
+        except RemoteCallError as e:
+            # The update's changes were discarded with its unit of work
+            logger.warning("%s for user %s failed: %s", name, user.id, e)
+            await _reply_unavailable(update)
+        finally:
+            if acquired is not None:
+                HANDLER_SECONDS.observe(time.perf_counter() - acquired, callback.__name__, route)
+    return wrapper
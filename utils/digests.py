@@ -0,0 +1,114 @@
+import asyncio
+import logging
+from typing import Dict, List, Tuple
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.error import TelegramError
+from utils import metrics, warm_state
+from utils.helpers import add_notification, store_notification
+from utils.outbound import Priority
+from utils.storage import Storage
+from config import LIKE_DIGEST_INTERVAL, LIKE_DIGEST_PUSH, BROADCAST_BATCH_SIZE
+
+logger = logging.getLogger(__name__)
+
+storage = Storage()
+
+LIKES_COALESCED = metrics.counter('lumi_likes_coalesced_total', "Likes buffered into notification digests")
+DIGESTS_WRITTEN = metrics.counter('lumi_like_digests_total', "Like digests written to recipients' records")
+
+def window_text(seconds: float) -> str:
+    """'hour', '15 minutes', '6 hours' for a digest window"""
+    if seconds == 3600:
+        return "hour"
+    if seconds < 3600:
+        return f"{max(1, round(seconds / 60))} minutes"
+    return f"{round(seconds / 3600)} hours"
+
+class LikeDigests:
+    """Like notifications buffered per recipient and written as one digest per window.
+    
+    Likes are recorded on the liked user's shard, so the buffer only ever holds that
+    shard's users and a flush writes each recipient's record once, however many likes
+    arrived. Match notifications don't pass through here and stay immediate.
+    """
+    
+    def __init__(self, interval: float = LIKE_DIGEST_INTERVAL):
+        self.interval = interval
+        # recipient -> liker id -> liker name, in arrival order
+        self.pending: Dict[int, Dict[int, str]] = {}
+    
+    def add(self, user_id: int, liker_id: int, liker_name: str):
+        """Note that liker_id liked user_id (written at once when digests are off)"""
+        if self.interval <= 0:
+            add_notification(user_id, f"❤️ {liker_name} liked your profile!")
+            return
+        self.pending.setdefault(user_id, {})[liker_id] = liker_name
+        LIKES_COALESCED.inc()
+    
+    def discard(self, user_id: int, liker_id: int):
+        """Drop a buffered like that turned into a match; the match is announced instead"""
+        likers = self.pending.get(user_id)
+        if likers is not None:
+            likers.pop(liker_id, None)
+            if not likers:
+                del self.pending[user_id]
+    
+    def message(self, likers: Dict[int, str]) -> str:
+        if len(likers) == 1:
+            return f"❤️ {next(iter(likers.values()))} liked your profile!"
+        return f"❤️ {len(likers)} people liked you in the last {window_text(self.interval)}"
+    
+    def flush(self) -> List[Tuple[int, str]]:
+        """Write every buffered digest in one unit of work; returns (recipient, message) pairs.
+        
+        If writing fails the likes go back into the buffer for the next flush.
+        """
+        pending, self.pending = self.pending, {}
+        digests = [(user_id, self.message(likers)) for user_id, likers in pending.items()]
+        try:
+            with storage.unit_of_work():
+                for user_id, message in digests:
+                    store_notification(user_id, message)
+        except Exception:
+            self.restore(pending)
+            raise
+        DIGESTS_WRITTEN.inc(amount=len(digests))
+        return digests
+    
+    def dump(self) -> Dict[int, Dict[int, str]]:
+        return self.pending
+    
+    def restore(self, pending: Dict[int, Dict[int, str]]):
+        # Likes buffered since are newer and keep their place after the restored ones
+        for user_id, likers in pending.items():
+            self.pending[user_id] = {**likers, **self.pending.get(user_id, {})}
+
+like_digests = LikeDigests()
+warm_state.register('like_digests', like_digests.dump, like_digests.restore, session=True)
+
+async def push(bot, digests: List[Tuple[int, str]]):
+    """Send digests to their recipients, a batch at a time at notification priority"""
+    reply_markup = InlineKeyboardMarkup([[InlineKeyboardButton("🔔 Notifications", callback_data="notifications")]])
+    
+    async def send(user_id: int, message: str):
+        try:
+            await bot.send_message(user_id, message, reply_markup=reply_markup, rate_limit_args=Priority.NOTIFICATION)
+        except TelegramError:
+            pass
+    
+    for i in range(0, len(digests), BROADCAST_BATCH_SIZE):
+        await asyncio.gather(*(send(user_id, message) for user_id, message in digests[i:i + BROADCAST_BATCH_SIZE]))
+
+async def run_periodically(bot, interval: float = LIKE_DIGEST_INTERVAL, deliver: bool = LIKE_DIGEST_PUSH):
+    """Flush like digests every `interval` seconds (started from the post_init hook)"""
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            digests = like_digests.flush()
+        except OSError as e:
+            logger.warning("Writing like digests failed, retrying next time: %s", e)
+            continue
+        if digests:
+            logger.info("Wrote %d like digests", len(digests))
+            if deliver:
+                await push(bot, digests)
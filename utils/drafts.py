@@ -0,0 +1,90 @@
+import time
+from typing import Any, Dict, Optional
+from utils import warm_state
+from config import REGISTRATION_DRAFT_TTL
+
+class Draft:
+    """A registration in progress: the step the user is on and the answers so far"""
+    
+    __slots__ = ('state', 'fields', 'updated')
+    
+    def __init__(self, state: str, fields: Optional[Dict[str, Any]] = None, updated: Optional[float] = None):
+        self.state = state
+        self.fields = fields or {}
+        self.updated = time.time() if updated is None else updated
+    
+    def advance(self, state: str, **fields):
+        """Record answers and move to the next step"""
+        self.fields.update(fields)
+        self.state = state
+        self.updated = time.time()
+
+class DraftStore:
+    """In-memory registration drafts.
+    
+    Nothing is written to the user's record until the last step commits the whole
+    profile at once, so abandoned registrations leave no file behind. Drafts idle for
+    longer than the TTL are dropped; they survive clean restarts through the warm-state
+    snapshot.
+    """
+    
+    SWEEP_INTERVAL = 60
+    
+    def __init__(self, ttl: float = REGISTRATION_DRAFT_TTL):
+        self.ttl = ttl
+        self.drafts: Dict[int, Draft] = {}
+        self.next_sweep = 0.0
+    
+    def get(self, user_id: int, now: Optional[float] = None) -> Optional[Draft]:
+        """The user's draft, or None if there is none or it expired"""
+        draft = self.drafts.get(user_id)
+        if draft is None:
+            return None
+        now = time.time() if now is None else now
+        if now - draft.updated > self.ttl:
+            del self.drafts[user_id]
+            return None
+        return draft
+    
+    def start(self, user_id: int, state: str, **fields) -> Draft:
+        """Begin (or restart) a user's registration"""
+        now = time.time()
+        if now >= self.next_sweep:
+            self.expire(now)
+            self.next_sweep = now + self.SWEEP_INTERVAL
+        draft = self.drafts[user_id] = Draft(state, fields, now)
+        return draft
+    
+    def discard(self, user_id: int):
+        self.drafts.pop(user_id, None)
+    
+    def expire(self, now: Optional[float] = None) -> int:
+        """Drop drafts idle past the TTL; returns how many were dropped"""
+        now = time.time() if now is None else now
+        expired = [user_id for user_id, draft in self.drafts.items() if now - draft.updated > self.ttl]
+        for user_id in expired:
+            del self.drafts[user_id]
+        return len(expired)
+    
+    def dump(self) -> Dict[int, tuple]:
+        return {user_id: (draft.state, draft.fields, draft.updated) for user_id, draft in self.drafts.items()}
+    
+    def restore(self, dumped: Dict[int, tuple]):
+        for user_id, (state, fields, updated) in dumped.items():
+            # Drafts started since boot are newer
+            self.drafts.setdefault(user_id, Draft(state, fields, updated))
+        self.expire()
+
+drafts = DraftStore()
+warm_state.register('registration_drafts', drafts.dump, drafts.restore, session=True)
+
+def registration_state(user_id: int, record: Dict) -> Optional[str]:
+    """Registration step the user is on, or None if they aren't registering.
+    
+    A record still carrying registration_state is a registration from before drafts
+    existed or one whose draft expired; its next message starts over.
+    """
+    draft = drafts.get(user_id)
+    if draft is not None:
+        return draft.state
+    return record.get('registration_state')
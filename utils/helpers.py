@@ -1,8 +1,9 @@
 import time
 import random
-from typing import List, Dict
-from telegram import User
+from typing import List, Dict, Optional, Tuple
+from telegram import User, InlineKeyboardButton
 from utils.storage import Storage
+from utils import sharding
 
 storage = Storage()
 
@@ -64,6 +65,12 @@ def contains_banned_words(text: str) -> bool:
 
 def add_notification(user_id: int, message: str):
     """Add notification for user"""
+    # The record is appended to where it lives so concurrent notifications aren't lost
+    sharding.cast(user_id, 'store_notification', user_id=user_id, message=message)
+
+@sharding.remote
+def store_notification(user_id: int, message: str):
+    """Append a notification to the user's record"""
     notifications = storage.get_user_property(user_id, 'notifications') or []
     notifications.append({
         'message': message,
@@ -73,3 +80,25 @@ def add_notification(user_id: int, message: str):
     if len(notifications) > 50:
         notifications = notifications[-50:]
     storage.set_user_property(user_id, 'notifications', notifications)
+
+def callback_page(data: str) -> int:
+    """Page number at the end of a list view's callback data (view_likes_2), 0 if none"""
+    tail = data.rsplit('_', 1)[-1]
+    return int(tail) if tail.isdigit() else 0
+
+def paginate(items: List, page: int, per_page: int) -> Tuple[List, int, int]:
+    """Items on a page, the page number clamped to range and the page count"""
+    pages = max(1, (len(items) + per_page - 1) // per_page)
+    page = min(max(page, 0), pages - 1)
+    return items[page * per_page:(page + 1) * per_page], page, pages
+
+def page_buttons(prefix: str, page: int, pages: int) -> Optional[List[InlineKeyboardButton]]:
+    """Previous/next row for a paginated list, None for a single page"""
+    if pages <= 1:
+        return None
+    row = []
+    if page > 0:
+        row.append(InlineKeyboardButton("⬅️ Previous", callback_data=f"{prefix}_{page - 1}"))
+    if page < pages - 1:
+        row.append(InlineKeyboardButton("Next ➡️", callback_data=f"{prefix}_{page + 1}"))
+    return row
@@ -0,0 +1,149 @@
+import asyncio
+import json
+import logging
+from typing import Awaitable, Callable, Dict, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+MAX_BODY_SIZE = 1024 * 1024  # Telegram updates are far below 1 MB
+
+REASONS = {
+    200: "OK", 400: "Bad Request", 403: "Forbidden", 404: "Not Found",
+    405: "Method Not Allowed", 413: "Payload Too Large", 500: "Internal Server Error",
+    503: "Service Unavailable"
+}
+
+class Request:
+    """Parsed HTTP request"""
+    
+    def __init__(self, method: str, path: str, headers: Dict[str, str], body: bytes):
+        self.method = method
+        self.path = path
+        self.headers = headers
+        self.body = body
+    
+    def json(self):
+        return json.loads(self.body.decode('utf-8'))
+
+# (status, content type, body)
+Response = Tuple[int, str, bytes]
+Route = Callable[[Request], Awaitable[Response]]
+
+def json_response(status: int, data) -> Response:
+    """Build a JSON response"""
+    return status, "application/json", json.dumps(data).encode('utf-8')
+
+class HttpServer:
+    """Minimal asyncio HTTP/1.1 listener for local endpoints (webhook, health, metrics)"""
+    
+    def __init__(self, host: str, port: int):
+        self.host = host
+        self.port = port
+        self.routes: Dict[Tuple[str, str], Route] = {}
+        self.server: Optional[asyncio.AbstractServer] = None
+        self.in_flight = 0
+        self._idle = asyncio.Event()
+        self._idle.set()
+    
+    def add_route(self, method: str, path: str, handler: Route):
+        """Register a handler for a method and exact path"""
+        self.routes[(method.upper(), path)] = handler
+    
+    async def start(self):
+        """Start accepting connections"""
+        self.server = await asyncio.start_server(self._handle_connection, self.host, self.port)
+        sockets = self.server.sockets or []
+        if sockets:
+            # Port 0 picks a free port; expose the real one
+            self.port = sockets[0].getsockname()[1]
+        logger.info("HTTP listener on %s:%s", self.host, self.port)
+    
+    async def stop(self, timeout: float = 10.0):
+        """Stop accepting connections and wait for in-flight requests"""
+        if self.server is None:
+            return
+        self.server.close()
+        await self.server.wait_closed()
+        try:
+            await asyncio.wait_for(self._idle.wait(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning("HTTP listener stopped with %s requests in flight", self.in_flight)
+        self.server = None
+    
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                request = await self._read_request(reader)
+                if request is None:
+                    break
+                if isinstance(request, int):
+                    await self._write_response(writer, (request, "text/plain", REASONS[request].encode()), True)
+                    break
+                
+                self.in_flight += 1
+                self._idle.clear()
+                try:
+                    response = await self._dispatch(request)
+                finally:
+                    self.in_flight -= 1
+                    if not self.in_flight:
+                        self._idle.set()
+                
+                close = request.headers.get('connection', '').lower() == 'close' or self.server is None
+                await self._write_response(writer, response, close)
+                if close:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+    
+    async def _read_request(self, reader: asyncio.StreamReader):
+        """Read one request; returns None on EOF or an error status on malformed input"""
+        line = await reader.readline()
+        if not line:
+            return None
+        parts = line.decode('latin-1').split()
+        if len(parts) != 3:
+            return 400
+        method, target, _ = parts
+        
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+        
+        try:
+            length = int(headers.get('content-length', '0'))
+        except ValueError:
+            return 400
+        if length > MAX_BODY_SIZE:
+            return 413
+        body = await reader.readexactly(length) if length else b''
+        return Request(method.upper(), target.split('?', 1)[0], headers, body)
+    
+    async def _dispatch(self, request: Request) -> Response:
+        handler = self.routes.get((request.method, request.path))
+        if handler is None:
+            if any(path == request.path for _, path in self.routes):
+                return 405, "text/plain", b"Method Not Allowed"
+            return 404, "text/plain", b"Not Found"
+        try:
+            return await handler(request)
+        except Exception as e:
+            logger.exception("Error handling %s %s: %s", request.method, request.path, e)
+            return 500, "text/plain", b"Internal Server Error"
+    
+    async def _write_response(self, writer: asyncio.StreamWriter, response: Response, close: bool):
+        status, content_type, body = response
+        head = (
+            f"HTTP/1.1 {status} {REASONS.get(status, 'Error')}\r\n"
+            f"Content-Type: {content_type}\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            f"Connection: {'close' if close else 'keep-alive'}\r\n\r\n"
+        )
+        writer.write(head.encode('latin-1') + body)
+        await writer.drain()
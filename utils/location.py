@@ -0,0 +1,82 @@
+import json
+import os
+import re
+from functools import lru_cache
+from typing import Dict, List, Optional, Tuple
+
+ALIASES_FILE = os.path.join(os.path.dirname(__file__), "location_aliases.json")
+
+_SEPARATORS = re.compile(r'[,/|;\n]+')
+_NOISE = re.compile(r"[^\w\s.'-]+")
+_SPACES = re.compile(r'\s+')
+
+class LocationTable:
+    """Canonical city and country names with their aliases (local data, no geocoding)"""
+    
+    def __init__(self, data: Dict):
+        self.countries: Dict[str, str] = {}
+        self.cities: Dict[str, str] = {}
+        self.city_country: Dict[str, str] = {}
+        for country, aliases in data.get('countries', {}).items():
+            for name in [country] + aliases:
+                self.countries[fold(name)] = country
+        for city, info in data.get('cities', {}).items():
+            self.city_country[city] = info.get('country')
+            for name in [city] + info.get('aliases', []):
+                self.cities[fold(name)] = city
+
+@lru_cache(maxsize=1)
+def get_table() -> LocationTable:
+    with open(ALIASES_FILE, 'r', encoding='utf-8') as f:
+        return LocationTable(json.load(f))
+
+def fold(text: str) -> str:
+    """Case-fold and tidy one location part"""
+    text = _NOISE.sub(' ', text.casefold())
+    return _SPACES.sub(' ', text).strip(" .'-")
+
+@lru_cache(maxsize=65536)
+def normalize_location(text: Optional[str]) -> Tuple[Optional[str], Optional[str]]:
+    """Turn free-text location into (city, country), either of which may be unknown"""
+    if not text:
+        return None, None
+    table = get_table()
+    parts = []
+    for part in _SEPARATORS.split(text):
+        parts.extend(_split_trailing_country(fold(part), table))
+    parts = [part for part in parts if part]
+    
+    city = country = None
+    # Country usually comes last, city first ("Ikeja, Lagos, Nigeria")
+    for part in reversed(parts):
+        if country is None and part in table.countries:
+            country = table.countries[part]
+        elif city is None and part in table.cities:
+            city = table.cities[part]
+    
+    if city is None:
+        # Unknown city: keep the first non-country part as its own token
+        city = next((part for part in parts if part not in table.countries), None)
+    if country is None and city is not None:
+        country = table.city_country.get(city)
+    return city, country
+
+def _split_trailing_country(part: str, table: LocationTable) -> List[str]:
+    """Split "london uk" into ["london", "uk"] when the tail is a known country"""
+    if part in table.countries or part in table.cities:
+        return [part]
+    words = part.split(' ')
+    for size in (3, 2, 1):
+        if len(words) > size and ' '.join(words[-size:]) in table.countries:
+            return [' '.join(words[:-size]), ' '.join(words[-size:])]
+    return [part]
+
+def location_tokens(text: Optional[str]) -> List[str]:
+    """Index tokens for a location, e.g. ['city:lagos', 'country:nigeria']"""
+    city, country = normalize_location(text)
+    tokens = []
+    if city:
+        tokens.append(f"city:{city}")
+    if country:
+        tokens.append(f"country:{country}")
+    return tokens
@@ -0,0 +1,54 @@
+import asyncio
+from contextlib import asynccontextmanager
+from typing import Hashable, List, Optional
+
+from config import LOCK_STRIPES
+
+class StripedLock:
+    """Fixed pool of asyncio locks shared by hashing keys onto stripes.
+    
+    The locks are created on first use in the running loop (and again if a later
+    asyncio.run brings a new one): on Python 3.9 a lock built at import time is bound to
+    another loop and fails as soon as two tasks contend for it.
+    """
+    
+    def __init__(self, stripes: int):
+        self.stripes = stripes
+        self._locks: List[asyncio.Lock] = []
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+    
+    def _stripe(self, key: Hashable) -> int:
+        return hash(key) % self.stripes
+    
+    def _pool(self) -> List[asyncio.Lock]:
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._locks = [asyncio.Lock() for _ in range(self.stripes)]
+            self._loop = loop
+        return self._locks
+    
+    def lock(self, key: Hashable) -> asyncio.Lock:
+        """The lock a single key maps to (for waits that need a timeout)"""
+        return self._pool()[self._stripe(key)]
+    
+    @asynccontextmanager
+    async def hold(self, *keys: Hashable):
+        """Hold the locks for all keys, acquired in stripe order so callers can't deadlock"""
+        locks = self._pool()
+        stripes = sorted({self._stripe(key) for key in keys})
+        acquired = []
+        try:
+            for stripe in stripes:
+                await locks[stripe].acquire()
+                acquired.append(stripe)
+            yield
+        finally:
+            for stripe in reversed(acquired):
+                locks[stripe].release()
+
+# Serializes each user's updates; held for a whole update
+user_locks = StripedLock(LOCK_STRIPES)
+
+# Guards read-modify-write of data shared by two users (likes, matches).
+# Separate from user_locks so an update holding its user's lock can still take a pair lock.
+pair_locks = StripedLock(LOCK_STRIPES)
@@ -0,0 +1,159 @@
+import bisect
+import logging
+import math
+from typing import Callable, Dict, List, Sequence, Tuple
+from utils.http_server import HttpServer, Request, Response
+
+logger = logging.getLogger(__name__)
+
+# Latency buckets in seconds, from cache hits to slow Bot API round trips
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+def _escape(value: str) -> str:
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+def _labels(names: Sequence[str], values: Sequence, extra: str = '') -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+def _number(value: float) -> str:
+    if value == math.inf:
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) and not value.is_integer() else str(int(value))
+
+class Metric:
+    """Base of all metrics; values are kept per tuple of label values"""
+    
+    kind = 'untyped'
+    
+    def __init__(self, name: str, description: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.description = description
+        self.labelnames = tuple(labels)
+    
+    def samples(self) -> List[str]:
+        raise NotImplementedError
+    
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(self.samples())
+        return '\n'.join(lines)
+
+class Counter(Metric):
+    """Monotonic count"""
+    
+    kind = 'counter'
+    
+    def __init__(self, name: str, description: str, labels: Sequence[str] = ()):
+        super().__init__(name, description, labels)
+        self.values: Dict[Tuple, float] = {}
+    
+    def inc(self, *labels, amount: float = 1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+    
+    def samples(self) -> List[str]:
+        return [f"{self.name}{_labels(self.labelnames, key)} {_number(value)}"
+                for key, value in sorted(self.values.items())]
+
+class Histogram(Metric):
+    """Bucketed distribution of observations (cumulative buckets rendered at scrape time)"""
+    
+    kind = 'histogram'
+    
+    def __init__(self, name: str, description: str, labels: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, description, labels)
+        self.buckets = tuple(buckets)
+        # label values -> [count per bucket (last is +Inf), sum]
+        self.values: Dict[Tuple, List] = {}
+    
+    def observe(self, value: float, *labels):
+        entry = self.values.get(labels)
+        if entry is None:
+            entry = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+        entry[0][bisect.bisect_left(self.buckets, value)] += 1
+        entry[1] += value
+    
+    def samples(self) -> List[str]:
+        lines = []
+        for key, (counts, total) in sorted(self.values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), counts):
+                cumulative += count
+                le = 'le="%s"' % _number(bound)
+                lines.append(f"{self.name}_bucket{_labels(self.labelnames, key, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.labelnames, key)} {_number(total)}")
+            lines.append(f"{self.name}_count{_labels(self.labelnames, key)} {cumulative}")
+        return lines
+
+class Collected(Metric):
+    """Values read from their owner at scrape time (cache counters, queue depths)"""
+    
+    def __init__(self, name: str, description: str, kind: str, labels: Sequence[str],
+                 collect: Callable[[], Dict[Tuple, float]]):
+        super().__init__(name, description, labels)
+        self.kind = kind
+        self.collect = collect
+    
+    def samples(self) -> List[str]:
+        return [f"{self.name}{_labels(self.labelnames, key)} {_number(value)}"
+                for key, value in sorted(self.collect().items())]
+
+class Registry:
+    """All metrics of this process"""
+    
+    def __init__(self):
+        self.metrics: Dict[str, Metric] = {}
+    
+    def register(self, metric: Metric) -> Metric:
+        if metric.name in self.metrics:
+            raise ValueError(f"Metric {metric.name} registered twice")
+        self.metrics[metric.name] = metric
+        return metric
+    
+    def render(self) -> str:
+        """Prometheus text exposition format"""
+        return '\n'.join(metric.render() for metric in self.metrics.values()) + '\n'
+
+registry = Registry()
+
+def counter(name: str, description: str, labels: Sequence[str] = ()) -> Counter:
+    return registry.register(Counter(name, description, labels))
+
+def histogram(name: str, description: str, labels: Sequence[str] = (),
+              buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+    return registry.register(Histogram(name, description, labels, buckets))
+
+def collected(name: str, description: str, kind: str, labels: Sequence[str],
+              collect: Callable[[], Dict[Tuple, float]]) -> Collected:
+    return registry.register(Collected(name, description, kind, labels, collect))
+
+# Caches with hits/misses attributes, reported together as lumi_cache_lookups_total
+_caches: List[Tuple[str, object]] = []
+
+def register_cache(name: str, cache: object):
+    """Report a cache's hits and misses (caches sharing a name are summed)"""
+    _caches.append((name, cache))
+
+def _cache_lookups() -> Dict[Tuple, float]:
+    counts: Dict[Tuple, float] = {}
+    for name, cache in _caches:
+        for result, count in (('hit', cache.hits), ('miss', cache.misses)):
+            counts[(name, result)] = counts.get((name, result), 0) + count
+    return counts
+
+collected('lumi_cache_lookups_total', "Cache lookups by cache and result", 'counter', ('cache', 'result'),
+          _cache_lookups)
+
+async def _metrics_route(request: Request) -> Response:
+    return 200, "text/plain; version=0.0.4", registry.render().encode('utf-8')
+
+async def start_server(host: str, port: int) -> HttpServer:
+    """Serve GET /metrics on a local port"""
+    server = HttpServer(host, port)
+    server.add_route('GET', '/metrics', _metrics_route)
+    await server.start()
+    logger.info("Metrics on http://%s:%s/metrics", host, server.port)
+    return server
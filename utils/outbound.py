@@ -0,0 +1,230 @@
+import asyncio
+import itertools
+import logging
+import time
+from collections import deque
+from enum import IntEnum
+from typing import Any, Callable, Coroutine, Deque, Dict, List, Optional, Union
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+from utils import metrics, tracing
+
+logger = logging.getLogger(__name__)
+
+class Priority(IntEnum):
+    """Outbound priority classes, highest first; pass as rate_limit_args"""
+    INTERACTIVE = 0
+    CHAT_RELAY = 1
+    NOTIFICATION = 2
+    BROADCAST = 3
+
+API_SECONDS = metrics.histogram('lumi_api_call_seconds', "Bot API call time by method, including rate limit waits and retries", ('method',))
+API_ERRORS = metrics.counter('lumi_api_errors_total', "Failed Bot API calls by method and error", ('method', 'error'))
+
+# Endpoints that deliver something to a chat and count towards Telegram's flood limits
+_LIMITED_PREFIXES = ('send', 'edit', 'copy', 'forward')
+
+class TokenBucket:
+    """Classic token bucket on the event loop clock"""
+    
+    def __init__(self, rate: float, burst: float, now: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = now
+        self.blocked_until = 0.0
+    
+    def _refill(self, now: float):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+    
+    def wait_time(self, now: float) -> float:
+        """Seconds until a token is available"""
+        self._refill(now)
+        wait = 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+        return max(wait, self.blocked_until - now)
+    
+    def consume(self):
+        self.tokens -= 1
+    
+    def is_idle(self, now: float) -> bool:
+        self._refill(now)
+        return self.tokens >= self.burst and self.blocked_until <= now
+
+class _Waiter:
+    __slots__ = ('chat_id', 'future')
+    
+    def __init__(self, chat_id, future: asyncio.Future):
+        self.chat_id = chat_id
+        self.future = future
+
+class OutboundScheduler(BaseRateLimiter[int]):
+    """Priority scheduler for Bot API calls with global and per-chat rate limits.
+    
+    Requests wait in one FIFO per priority class; the dispatcher always grants the
+    highest-priority request whose chat has capacity, so interactive replies overtake a
+    running broadcast. RetryAfter pauses the affected chat (or everything, for requests
+    without a chat) and the request is retried.
+    """
+    
+    def __init__(self, global_rate: float = 30, chat_rate: float = 1, chat_burst: float = 3,
+                 max_retries: int = 3):
+        self.global_rate = global_rate
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self._queues: Dict[Priority, Deque[_Waiter]] = {p: deque() for p in Priority}
+        self._global: Optional[TokenBucket] = None
+        self._chats: Dict[Any, TokenBucket] = {}
+        # Created with the dispatcher on the loop that runs it; asyncio primitives built at
+        # import time bind to a different loop on Python 3.9
+        self._wakeup: Optional[asyncio.Event] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._task: Optional[asyncio.Task] = None
+        self.sent: Dict[Priority, int] = {p: 0 for p in Priority}
+        self.retries = 0
+    
+    async def initialize(self):
+        pass
+    
+    async def shutdown(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+    
+    def queue_depths(self) -> Dict[str, int]:
+        """Requests waiting per priority class"""
+        return {p.name.lower(): len(q) for p, q in self._queues.items()}
+    
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'queued': self.queue_depths(),
+            'sent': {p.name.lower(): n for p, n in self.sent.items()},
+            'retries': self.retries,
+            'tracked_chats': len(self._chats)
+        }
+    
+    async def process_request(
+        self,
+        callback: Callable[..., Coroutine[Any, Any, Union[bool, Dict[str, Any], List[Dict[str, Any]]]]],
+        args: Any,
+        kwargs: Dict[str, Any],
+        endpoint: str,
+        data: Dict[str, Any],
+        rate_limit_args: Optional[int],
+    ) -> Union[bool, Dict[str, Any], List[Dict[str, Any]]]:
+        priority = Priority(rate_limit_args) if rate_limit_args is not None else Priority.INTERACTIVE
+        limited = endpoint.startswith(_LIMITED_PREFIXES)
+        chat_id = data.get('chat_id')
+        
+        start = time.perf_counter()
+        try:
+            with tracing.span(f"api.{endpoint}", str(chat_id or '')):
+                for attempt in range(self.max_retries + 1):
+                    if limited:
+                        await self._acquire(priority, chat_id)
+                    try:
+                        result = await callback(*args, **kwargs)
+                        self.sent[priority] += 1
+                        return result
+                    except RetryAfter as e:
+                        if attempt == self.max_retries:
+                            raise
+                        self.retries += 1
+                        logger.warning("%s hit flood control, retrying in %ss", endpoint, e.retry_after)
+                        self._pause(chat_id, e.retry_after)
+                        if not limited:
+                            await asyncio.sleep(e.retry_after)
+        except Exception as e:
+            API_ERRORS.inc(endpoint, type(e).__name__)
+            raise
+        finally:
+            API_SECONDS.observe(time.perf_counter() - start, endpoint)
+    
+    def _pause(self, chat_id, seconds: float):
+        """Stop granting slots to a chat (or to everyone) for a while"""
+        now = asyncio.get_running_loop().time()
+        bucket = self._chat_bucket(chat_id, now) if chat_id is not None else self._global_bucket(now)
+        bucket.blocked_until = max(bucket.blocked_until, now + seconds)
+    
+    def _global_bucket(self, now: float) -> TokenBucket:
+        if self._global is None:
+            self._global = TokenBucket(self.global_rate, self.global_rate, now)
+        return self._global
+    
+    def _chat_bucket(self, chat_id, now: float) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) > 10000:
+                # Forget chats that have fully recovered
+                self._chats = {c: b for c, b in self._chats.items() if not b.is_idle(now)}
+            bucket = self._chats[chat_id] = TokenBucket(self.chat_rate, self.chat_burst, now)
+        return bucket
+    
+    async def _acquire(self, priority: Priority, chat_id):
+        loop = asyncio.get_running_loop()
+        if self._task is None or self._task.done() or self._loop is not loop:
+            self._loop = loop
+            self._wakeup = asyncio.Event()
+            self._task = loop.create_task(self._dispatch())
+        future = loop.create_future()
+        self._queues[priority].append(_Waiter(chat_id, future))
+        self._wakeup.set()
+        await future
+    
+    def _next_eligible(self, now: float):
+        """Highest-priority waiter whose chat can send now, else the shortest chat wait"""
+        shortest = None
+        for priority in Priority:
+            queue = self._queues[priority]
+            blocked = set()
+            for index, waiter in enumerate(queue):
+                if waiter.future.done():
+                    continue
+                if waiter.chat_id in blocked:
+                    continue
+                if waiter.chat_id is None:
+                    return priority, index, 0.0
+                wait = self._chat_bucket(waiter.chat_id, now).wait_time(now)
+                if wait <= 0:
+                    return priority, index, 0.0
+                blocked.add(waiter.chat_id)
+                shortest = wait if shortest is None else min(shortest, wait)
+        return None, None, shortest
+    
+    async def _dispatch(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            # Drop waiters whose requests were cancelled
+            for queue in self._queues.values():
+                while queue and queue[0].future.done():
+                    queue.popleft()
+            
+            if not any(self._queues.values()):
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            
+            now = loop.time()
+            global_wait = self._global_bucket(now).wait_time(now)
+            if global_wait > 0:
+                await asyncio.sleep(global_wait)
+                continue
+            
+            priority, index, wait = self._next_eligible(now)
+            if priority is None:
+                # Every queued chat is at its limit; sleep until one frees up or new work arrives
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), wait)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            
+            queue = self._queues[priority]
+            waiter = queue[index]
+            del queue[index]
+            self._global.consume()
+            if waiter.chat_id is not None:
+                self._chats[waiter.chat_id].consume()
+            waiter.future.set_result(None)
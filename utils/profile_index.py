@@ -0,0 +1,218 @@
+import bisect
+import logging
+import random
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+from utils import storage as storage_module
+from utils import sharding, warm_state
+from utils.location import location_tokens
+from utils.storage import Storage, make_profile
+
+logger = logging.getLogger(__name__)
+
+storage = Storage()
+
+# Bucket token covering every location
+ANYWHERE = '*'
+
+class AgeBucket:
+    """Profile ids kept sorted by age, so an age range is two bisections"""
+    
+    def __init__(self):
+        self.keys: List[Tuple[int, int]] = []  # (age, user_id)
+    
+    def add(self, age: int, user_id: int):
+        bisect.insort(self.keys, (age, user_id))
+    
+    def discard(self, age: int, user_id: int):
+        i = bisect.bisect_left(self.keys, (age, user_id))
+        if i < len(self.keys) and self.keys[i] == (age, user_id):
+            del self.keys[i]
+    
+    def bounds(self, min_age: int, max_age: int) -> Tuple[int, int]:
+        """Slice positions of profiles aged min_age..max_age"""
+        return (bisect.bisect_left(self.keys, (min_age,)),
+                bisect.bisect_left(self.keys, (max_age + 1,)))
+    
+    def in_range(self, min_age: int, max_age: int) -> List[int]:
+        lo, hi = self.bounds(min_age, max_age)
+        return [user_id for _, user_id in self.keys[lo:hi]]
+    
+    def __len__(self):
+        return len(self.keys)
+
+class ProfileIndex:
+    """In-memory table of complete profiles with indexes for candidate lookup.
+    
+    Profiles are bucketed by (gender, location token), including an ANYWHERE token,
+    and each bucket is sorted by age. Built from one scan on first use and kept
+    current by storage write notifications, so matching never rescans data/users.
+    """
+    
+    def __init__(self):
+        self.loaded = False
+        self.profiles: Dict[int, Dict] = {}
+        self.buckets: Dict[Tuple[str, str], AgeBucket] = {}
+        self._keys: Dict[int, Tuple[int, List[Tuple[str, str]]]] = {}
+    
+    def ensure_loaded(self):
+        if not self.loaded:
+            self.loaded = True
+            self.build(storage.get_profiles())
+            logger.info("Profile index built with %s profiles", len(self.profiles))
+    
+    def build(self, profiles: Iterable[Dict]):
+        """Index many profiles at once, sorting each bucket once instead of inserting one by one"""
+        for profile in profiles:
+            self.remove(profile['id'])
+            age, keys = self._index_keys(profile)
+            self.profiles[profile['id']] = profile
+            self._keys[profile['id']] = (age, keys)
+            for key in keys:
+                if key not in self.buckets:
+                    self.buckets[key] = AgeBucket()
+                self.buckets[key].keys.append((age, profile['id']))
+        for bucket in self.buckets.values():
+            bucket.keys.sort()
+    
+    def dump(self) -> Dict:
+        """Warm-state snapshot of the index (None until it has been built)"""
+        if not self.loaded:
+            return None
+        return {'profiles': self.profiles, 'keys': self._keys,
+                'buckets': {key: bucket.keys for key, bucket in self.buckets.items()}}
+    
+    def restore(self, state: Optional[Dict]):
+        if state is None or self.loaded:
+            return
+        self.profiles = state['profiles']
+        self._keys = state['keys']
+        self.buckets = {}
+        for key, keys in state['buckets'].items():
+            bucket = self.buckets[key] = AgeBucket()
+            bucket.keys = keys
+        self.loaded = True
+    
+    def _index_keys(self, profile: Dict) -> Tuple[int, List[Tuple[str, str]]]:
+        age = profile_age(profile)
+        return age, [(profile['gender'], token) for token in [ANYWHERE] + location_tokens(profile.get('location'))]
+    
+    def upsert(self, profile: Dict):
+        """Add or replace a profile"""
+        self.remove(profile['id'])
+        user_id = profile['id']
+        age, keys = self._index_keys(profile)
+        self.profiles[user_id] = profile
+        self._keys[user_id] = (age, keys)
+        for key in keys:
+            if key not in self.buckets:
+                self.buckets[key] = AgeBucket()
+            self.buckets[key].add(age, user_id)
+    
+    def remove(self, user_id: int):
+        """Drop a profile from every index"""
+        if self.profiles.pop(user_id, None) is None:
+            return
+        age, keys = self._keys.pop(user_id)
+        for key in keys:
+            bucket = self.buckets.get(key)
+            if bucket is not None:
+                bucket.discard(age, user_id)
+                if not len(bucket):
+                    del self.buckets[key]
+    
+    def get(self, user_id: int) -> Optional[Dict]:
+        self.ensure_loaded()
+        return self.profiles.get(user_id)
+    
+    def genders(self, interest: Optional[str]) -> List[str]:
+        """Genders an interest covers ('Both' covers all)"""
+        self.ensure_loaded()
+        if interest == 'Both':
+            return sorted({gender for gender, _ in self.buckets})
+        return [interest] if interest else []
+    
+    def bucket(self, gender: str, token: str = ANYWHERE) -> Optional[AgeBucket]:
+        self.ensure_loaded()
+        return self.buckets.get((gender, token))
+    
+    def candidate_ids(self, genders: List[str], token: str, min_age: int, max_age: int) -> List[int]:
+        """All ids for the genders at a location token within an age range"""
+        ids = []
+        for gender in genders:
+            bucket = self.bucket(gender, token)
+            if bucket is not None:
+                ids.extend(bucket.in_range(min_age, max_age))
+        return ids
+    
+    def sample(self, genders: List[str], token: str, min_age: int, max_age: int,
+               excluded: Set[int], attempts: int = 16) -> Optional[int]:
+        """Random id for the genders at a location token within an age range, not in excluded"""
+        spans = []
+        for gender in genders:
+            bucket = self.bucket(gender, token)
+            if bucket is not None:
+                lo, hi = bucket.bounds(min_age, max_age)
+                if hi > lo:
+                    spans.append((bucket, lo, hi))
+        total = sum(hi - lo for _, lo, hi in spans)
+        if not total:
+            return None
+        
+        # Rejection sampling stays O(log n) while few candidates are excluded
+        for _ in range(attempts):
+            pick = random.randrange(total)
+            for bucket, lo, hi in spans:
+                if pick < hi - lo:
+                    user_id = bucket.keys[lo + pick][1]
+                    break
+                pick -= hi - lo
+            if user_id not in excluded:
+                return user_id
+        
+        # Mostly excluded (a small tier): enumerate what's left
+        remaining = [user_id for bucket, lo, hi in spans for _, user_id in bucket.keys[lo:hi]
+                     if user_id not in excluded]
+        return random.choice(remaining) if remaining else None
+    
+    def all_ids(self) -> Iterable[int]:
+        self.ensure_loaded()
+        return self.profiles.keys()
+
+def profile_age(profile: Dict) -> int:
+    """Age used for indexing; profiles without one sort first"""
+    try:
+        return int(profile.get('age') or 0)
+    except (TypeError, ValueError):
+        return 0
+
+profile_index = ProfileIndex()
+
+# Callbacks notified with (user_id, profile or None) of every profile change, in every
+# worker, whether or not the index is loaded there
+_change_listeners: List = []
+
+def add_change_listener(listener):
+    _change_listeners.append(listener)
+
+@sharding.remote
+def apply_profile(user_id: int, profile: Optional[Dict]):
+    """Apply a profile change announced by the worker that owns the user"""
+    for listener in _change_listeners:
+        listener(user_id, profile)
+    if not profile_index.loaded:
+        return
+    if profile is None:
+        profile_index.remove(user_id)
+    else:
+        profile_index.upsert(profile)
+
+def _on_user_change(user_id: int, record: Dict):
+    profile = make_profile(user_id, record)
+    apply_profile(user_id, profile)
+    router = storage_module.get_router()
+    if router is not None:
+        # Every worker matches against every profile
+        router.broadcast('apply_profile', {'user_id': user_id, 'profile': profile})
+
+storage_module.add_user_listener(_on_user_change)
+warm_state.register('profile_index', profile_index.dump, profile_index.restore)
@@ -0,0 +1,78 @@
+import heapq
+import time
+from typing import Callable, Dict, Iterable, List, Optional, Set
+
+from utils.activity import activity
+from config import RANKING_WEIGHTS
+
+class RankingSignals:
+    """Per-viewer data shared by all scorers during one ranking pass"""
+    
+    def __init__(self, viewer_id: int, viewer: Dict, liked_by: Set[int], now: Optional[float] = None):
+        self.viewer_id = viewer_id
+        self.viewer = viewer
+        self.liked_by = liked_by
+        self.now = now if now is not None else time.time()
+
+# Scorer: (candidate profile, signals) -> score in [0, 1]
+Scorer = Callable[[Dict, RankingSignals], float]
+
+_scorers: Dict[str, Scorer] = {}
+
+def scorer(name: str):
+    """Register a scoring function; its weight comes from RANKING_WEIGHTS[name]"""
+    def register(func: Scorer) -> Scorer:
+        _scorers[name] = func
+        return func
+    return register
+
+@scorer('reciprocal_interest')
+def score_reciprocal_interest(candidate: Dict, signals: RankingSignals) -> float:
+    """Candidate is interested in the viewer's gender and age"""
+    interest = candidate.get('interest')
+    if interest not in ('Both', signals.viewer.get('gender')):
+        return 0.0
+    age = signals.viewer.get('age')
+    min_age, max_age = candidate.get('age_min'), candidate.get('age_max')
+    if age and ((min_age and age < min_age) or (max_age and age > max_age)):
+        return 0.5
+    return 1.0
+
+@scorer('age_proximity')
+def score_age_proximity(candidate: Dict, signals: RankingSignals) -> float:
+    """Closer in age scores higher, fading out over 15 years"""
+    try:
+        gap = abs(int(candidate.get('age')) - int(signals.viewer.get('age')))
+    except (TypeError, ValueError):
+        return 0.0
+    return max(0.0, 1 - gap / 15)
+
+@scorer('boost')
+def score_boost(candidate: Dict, signals: RankingSignals) -> float:
+    """Profile boost is active"""
+    expiry = candidate.get('boost_expires_at') or 0
+    return 1.0 if expiry > signals.now * 1000 else 0.0
+
+@scorer('recency')
+def score_recency(candidate: Dict, signals: RankingSignals) -> float:
+    """Recently active users score higher, fading out over 30 days"""
+    last_active = activity.last_active(candidate['id'], candidate)
+    if not last_active:
+        return 0.0
+    days = (signals.now - last_active) / 86400
+    return max(0.0, 1 - days / 30)
+
+@scorer('liked_viewer')
+def score_liked_viewer(candidate: Dict, signals: RankingSignals) -> float:
+    """Candidate already liked the viewer, so a like would be a match"""
+    return 1.0 if candidate['id'] in signals.liked_by else 0.0
+
+def score(candidate: Dict, signals: RankingSignals, weights: Optional[Dict[str, float]] = None) -> float:
+    """Weighted sum of all registered scorers"""
+    weights = RANKING_WEIGHTS if weights is None else weights
+    return sum(weight * _scorers[name](candidate, signals) for name, weight in weights.items() if weight)
+
+def top_k(candidates: Iterable[Dict], signals: RankingSignals, k: int,
+          weights: Optional[Dict[str, float]] = None) -> List[Dict]:
+    """Best k candidates by score, using a bounded heap rather than a full sort"""
+    return heapq.nlargest(k, candidates, key=lambda candidate: score(candidate, signals, weights))
@@ -0,0 +1,487 @@
+import asyncio
+import itertools
+import logging
+import multiprocessing
+import queue
+import re
+import signal
+import threading
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from telegram import Bot, Update
+from utils import metrics, storage as storage_module
+from utils.locks import user_locks
+from utils.storage import Storage
+from config import REMOTE_LOCK_TIMEOUT, REMOTE_CALL_TIMEOUT
+
+logger = logging.getLogger(__name__)
+
+storage = Storage()
+
+# Multi-process worker mode
+# -------------------------
+# A supervisor process owns the single ingress (webhook listener or poller) and
+# runs N worker processes. User ids are hash-partitioned across workers; every
+# update is routed to the worker owning the acting user, which keeps that
+# shard's records hot in memory and is the only writer of its users' files and
+# per-user bot keys. Messages between processes are dicts sent over pipes, with
+# the supervisor relaying anything addressed to another shard:
+#
+#   update    supervisor -> worker    {'op', 'update'}
+#   call      worker -> owner         {'op', 'id', 'from', 'shard', 'user', 'method', 'kwargs'}
+#   reply     owner -> caller         {'op', 'id', 'shard', 'result'}
+#   cast      worker -> owner/all     {'op', 'shard', 'user', 'method', 'kwargs'} (no reply)
+#   user_set  worker -> owner         {'op', 'shard', 'user_id', 'key', 'value'}
+#   bot_set   worker -> owner/all     {'op', 'from', 'shard', 'key', 'value'}
+#   down      supervisor -> all       {'op', 'shard', 'index'} (worker `index` exited)
+#   stop      supervisor -> worker    {'op'}
+#
+# 'shard' is the destination; cast and bot_set with shard None are fanned out to
+# every other worker (profile index updates travel this way). Calls and casts for a
+# user run on the owner under that user's lock, like the user's own updates.
+#
+# Global bot keys (banned_users, user_reports, ...) belong to shard 0: it is their
+# only writer and persists them, and every change it makes is fanned out to the other
+# workers, which read their replica. Other workers change them through call_key()
+# (add_bot_item/remove_bot_item for lists) rather than writing back a whole value they
+# read, so two workers changing the same list at once can't lose each other's entry.
+
+# Bot-wide keys that belong to one user and so live on that user's shard
+_USER_KEY = re.compile(r'^(?:likes|matches|chat|notifies|seen_likes|seen_matches)_(\d+)$|^user_(\d+)_')
+
+# Update fields carrying the acting user
+_UPDATE_FIELDS = ('message', 'edited_message', 'callback_query', 'inline_query', 'chosen_inline_result',
+                  'shipping_query', 'pre_checkout_query', 'my_chat_member', 'chat_member', 'chat_join_request')
+
+# Shard owning the global bot keys
+GLOBAL_SHARD = 0
+
+# Functions that may be invoked on the shard owning a user
+_remote_methods: Dict[str, Callable] = {}
+
+class RemoteCallError(Exception):
+    """A call into another worker timed out, failed there or that worker is gone"""
+    
+    def __init__(self, message: str, reason: str = 'worker_down'):
+        super().__init__(message)
+        self.reason = reason
+
+def shard_of(user_id: int, count: int) -> int:
+    """Shard owning a user"""
+    return user_id % count
+
+def key_user(key: str) -> Optional[int]:
+    """User a bot-wide key belongs to, or None for global keys"""
+    match = _USER_KEY.match(key)
+    if not match:
+        return None
+    return int(match.group(1) or match.group(2))
+
+def update_user_id(data: Dict) -> Optional[int]:
+    """Acting user of a raw update"""
+    for field in _UPDATE_FIELDS:
+        obj = data.get(field)
+        if obj and obj.get('from'):
+            return obj['from']['id']
+    return None
+
+def remote(func: Callable) -> Callable:
+    """Register a synchronous function that call()/cast() may run on another shard"""
+    _remote_methods[func.__name__] = func
+    return func
+
+REMOTE_LOCK_TIMEOUTS = metrics.counter('lumi_remote_lock_timeouts_total',
+                                       "Remote calls run without their user's lock after waiting too long", ('method',))
+REMOTE_CALL_FAILURES = metrics.counter('lumi_remote_call_failures_total',
+                                       "Calls into other workers that timed out, failed or found the worker gone",
+                                       ('method', 'reason'))
+
+def _run_local(method: str, kwargs: Dict) -> Any:
+    with storage.unit_of_work():
+        return _remote_methods[method](**kwargs)
+
+async def call(owner_id: int, method: str, **kwargs) -> Any:
+    """Run a remote method on the shard owning owner_id and return its result"""
+    router = storage_module.get_router()
+    if router is None or router.owns_user(owner_id):
+        return _run_local(method, kwargs)
+    return await router.call(owner_id, method, kwargs)
+
+async def call_key(owner_key: str, method: str, **kwargs) -> Any:
+    """Run a remote method on the shard owning a bot key and return its result"""
+    router = storage_module.get_router()
+    if router is None or router.owns_key(owner_key):
+        return _run_local(method, kwargs)
+    return await router.call(None, method, kwargs, shard=router.key_shard(owner_key))
+
+@remote
+def add_bot_item(key: str, item: Any) -> bool:
+    """Append an item to a bot list unless it is there already; False if it was"""
+    items = list(storage.get_bot_property(key) or [])
+    if item in items:
+        return False
+    items.append(item)
+    storage.set_bot_property(key, items)
+    return True
+
+@remote
+def remove_bot_item(key: str, item: Any) -> bool:
+    """Remove an item from a bot list; False if it wasn't there"""
+    items = list(storage.get_bot_property(key) or [])
+    if item not in items:
+        return False
+    items.remove(item)
+    storage.set_bot_property(key, items)
+    return True
+
+async def add_to_bot_list(key: str, item: Any) -> bool:
+    """Add an item to a bot list on the key's owner; False if it was already there"""
+    return await call_key(key, 'add_bot_item', key=key, item=item)
+
+async def remove_from_bot_list(key: str, item: Any) -> bool:
+    """Remove an item from a bot list on the key's owner; False if it wasn't there"""
+    return await call_key(key, 'remove_bot_item', key=key, item=item)
+
+def cast(owner_id: int, method: str, **kwargs):
+    """Run a remote method on the shard owning owner_id without waiting for it"""
+    router = storage_module.get_router()
+    if router is None or router.owns_user(owner_id):
+        _run_local(method, kwargs)
+    else:
+        router.cast(owner_id, method, kwargs)
+
+class ShardRouter:
+    """A worker's view of the partition: what it owns and how to reach the rest"""
+    
+    def __init__(self, index: int, count: int, conn):
+        self.index = index
+        self.count = count
+        self.conn = conn
+        # call id -> (reply future, shard it was sent to)
+        self._pending: Dict[int, Tuple[asyncio.Future, int]] = {}
+        self._ids = itertools.count(1)
+    
+    def owns_user(self, user_id: int) -> bool:
+        return shard_of(user_id, self.count) == self.index
+    
+    def is_global_key(self, key: str) -> bool:
+        return key_user(key) is None
+    
+    def owns_key(self, key: str) -> bool:
+        return self.key_shard(key) == self.index
+    
+    def key_shard(self, key: str) -> int:
+        """Shard owning a bot key: the user's shard, or GLOBAL_SHARD for global keys"""
+        user_id = key_user(key)
+        return GLOBAL_SHARD if user_id is None else shard_of(user_id, self.count)
+    
+    def persists_key(self, key: str) -> bool:
+        return self.owns_key(key)
+    
+    def _send(self, message: Dict):
+        self.conn.send(message)
+    
+    def forward_user_set(self, user_id: int, key: str, value: Any):
+        self._send({'op': 'user_set', 'shard': shard_of(user_id, self.count),
+                    'user_id': user_id, 'key': key, 'value': value})
+    
+    def forward_bot_set(self, key: str, value: Any):
+        self._send({'op': 'bot_set', 'from': self.index, 'shard': self.key_shard(key), 'key': key, 'value': value})
+    
+    def broadcast_bot_set(self, key: str, value: Any):
+        self._send({'op': 'bot_set', 'from': self.index, 'shard': None, 'key': key, 'value': value})
+    
+    async def call(self, user_id: Optional[int], method: str, kwargs: Dict, shard: Optional[int] = None) -> Any:
+        """Run a method on the shard owning user_id (or on `shard`, without a user lock).
+        
+        Raises RemoteCallError after REMOTE_CALL_TIMEOUT seconds, when the method raised on
+        the other worker or when the supervisor reports the worker dead.
+        """
+        call_id = next(self._ids)
+        future = asyncio.get_running_loop().create_future()
+        if shard is None:
+            shard = shard_of(user_id, self.count)
+        self._pending[call_id] = (future, shard)
+        self._send({'op': 'call', 'id': call_id, 'from': self.index, 'shard': shard,
+                    'user': user_id, 'method': method, 'kwargs': kwargs})
+        try:
+            return await asyncio.wait_for(future, REMOTE_CALL_TIMEOUT)
+        except asyncio.TimeoutError:
+            REMOTE_CALL_FAILURES.inc(method, 'timeout')
+            raise RemoteCallError(f"{method} on worker {shard} timed out") from None
+        except RemoteCallError as e:
+            REMOTE_CALL_FAILURES.inc(method, e.reason)
+            raise
+        finally:
+            self._pending.pop(call_id, None)
+    
+    def fail_calls(self, shard: int):
+        """Fail every call waiting on a worker that exited"""
+        for future, target in list(self._pending.values()):
+            if target == shard and not future.done():
+                future.set_exception(RemoteCallError(f"worker {shard} exited"))
+    
+    def cast(self, user_id: int, method: str, kwargs: Dict):
+        self._send({'op': 'cast', 'shard': shard_of(user_id, self.count), 'user': user_id,
+                    'method': method, 'kwargs': kwargs})
+    
+    def broadcast(self, method: str, kwargs: Dict):
+        """Run a remote method on every other worker"""
+        self._send({'op': 'cast', 'shard': None, 'method': method, 'kwargs': kwargs})
+    
+    def handle(self, message: Dict, application, stop_event: asyncio.Event):
+        """Process one message from the supervisor"""
+        op = message['op']
+        if op == 'update':
+            application.update_queue.put_nowait(Update.de_json(message['update'], application.bot))
+        elif op == 'call':
+            application.create_task(self._serve_call(message))
+        elif op == 'reply':
+            pending = self._pending.pop(message['id'], None)
+            if pending is None or pending[0].done():
+                pass
+            elif message.get('error') is not None:
+                pending[0].set_exception(RemoteCallError(message['error'], reason='error'))
+            else:
+                pending[0].set_result(message['result'])
+        elif op == 'down':
+            self.fail_calls(message['index'])
+        elif op == 'cast':
+            if message.get('user') is None:
+                # Fanned out to every worker (profile index); touches no record
+                _run_local(message['method'], message['kwargs'])
+            else:
+                application.create_task(self._run_locked(message, timeout=None))
+        elif op == 'user_set':
+            with storage.unit_of_work():
+                storage.set_user_property(message['user_id'], message['key'], message['value'])
+        elif op == 'bot_set':
+            with storage.unit_of_work():
+                if self.owns_key(message['key']):
+                    # Forwarded to us as the owner: apply, persist and fan out global keys
+                    storage.set_bot_property(message['key'], message['value'])
+                else:
+                    storage.apply_bot_property(message['key'], message['value'])
+        elif op == 'stop':
+            stop_event.set()
+    
+    async def _run_locked(self, message: Dict, timeout: Optional[float]) -> Any:
+        """Run a remote method under its user's lock, so it never lands between the awaits
+        of an update of that user that is halfway through changing their data"""
+        method = message['method']
+        if message.get('user') is None:
+            # Calls for a global key run in one go on its owner, which is all they need
+            return _run_local(method, message['kwargs'])
+        lock = user_locks.lock(message['user'])
+        try:
+            await asyncio.wait_for(lock.acquire(), timeout)
+        except asyncio.TimeoutError:
+            # The lock's holder may itself be waiting on a call into our caller's shard
+            REMOTE_LOCK_TIMEOUTS.inc(method)
+            logger.warning("Running %s for user %s without its lock", method, message['user'])
+            return _run_local(method, message['kwargs'])
+        try:
+            return _run_local(method, message['kwargs'])
+        finally:
+            lock.release()
+    
+    async def _serve_call(self, message: Dict):
+        result, error = None, None
+        try:
+            result = await self._run_locked(message, REMOTE_LOCK_TIMEOUT)
+        except Exception as e:
+            logger.exception("Remote call %s failed: %s", message['method'], e)
+            # The caller must not take a failed write for a result
+            error = f"{message['method']} failed on worker {self.index}: {e}"
+        self._send({'op': 'reply', 'id': message['id'], 'shard': message['from'],
+                    'result': result, 'error': error})
+    
+    def receive(self, application, stop_event: asyncio.Event):
+        """Drain the pipe (called when it becomes readable)"""
+        try:
+            while self.conn.poll():
+                message = self.conn.recv()
+                try:
+                    self.handle(message, application, stop_event)
+                except Exception as e:
+                    # e.g. a relayed write that couldn't be saved; keep draining the pipe
+                    logger.exception("Handling %s from the supervisor failed: %s", message.get('op'), e)
+        except EOFError:
+            # Supervisor is gone
+            stop_event.set()
+
+def worker_main(index: int, count: int, conn):
+    """Entry point of a worker process"""
+    import bot
+    
+    # The supervisor coordinates shutdown
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    asyncio.run(_run_worker(bot.build_application(), ShardRouter(index, count, conn)))
+
+async def _run_worker(application, router: ShardRouter):
+    storage_module.set_router(router)
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    loop.add_reader(router.conn.fileno(), router.receive, application, stop_event)
+    
+    async with application:
+        if application.post_init:
+            await application.post_init(application)
+        await application.start()
+        logger.info("Worker %s/%s started", router.index, router.count)
+        await stop_event.wait()
+        
+        loop.remove_reader(router.conn.fileno())
+        await application.update_queue.join()
+        await application.stop()
+        if application.post_stop:
+            await application.post_stop(application)
+    router.conn.close()
+
+class _Outbox:
+    """Sends to a worker from a thread so a full pipe never blocks the relay loop"""
+    
+    def __init__(self, conn):
+        self.conn = conn
+        self.queue: "queue.SimpleQueue" = queue.SimpleQueue()
+        threading.Thread(target=self._run, daemon=True).start()
+    
+    def send(self, message: Dict):
+        self.queue.put(message)
+    
+    def _run(self):
+        while True:
+            message = self.queue.get()
+            try:
+                self.conn.send(message)
+            except (BrokenPipeError, OSError):
+                return
+
+class Supervisor:
+    """Runs the ingress and relays messages between worker processes"""
+    
+    def __init__(self, count: int):
+        self.count = count
+        self.conns: List = []
+        self.outboxes: List[_Outbox] = []
+        self.processes: List[multiprocessing.Process] = []
+        self.routed = 0
+        self.stopping = False
+    
+    def spawn(self):
+        from utils import backup, compaction
+        backup.mark_running(storage.data_dir)
+        # Workers start from one consistent bot_data.json regardless of the previous worker count
+        storage.consolidate_bot_data()
+        # Workers can't remove keys, so drop tombstones and orphaned keys while no one runs
+        result = compaction.compact(compaction.record_ids(storage.users_dir))
+        logger.info("Compacted bot data: %d bytes reclaimed", result['reclaimed'])
+        
+        mp = multiprocessing.get_context('spawn')
+        for index in range(self.count):
+            parent, child = mp.Pipe()
+            process = mp.Process(target=worker_main, args=(index, self.count, child), name=f"lumi-worker-{index}")
+            process.start()
+            child.close()
+            self.conns.append(parent)
+            self.outboxes.append(_Outbox(parent))
+            self.processes.append(process)
+    
+    async def route_update(self, data: Dict):
+        """Send a raw update to the worker owning its user"""
+        user_id = update_user_id(data)
+        shard = shard_of(user_id, self.count) if user_id is not None else 0
+        self.outboxes[shard].send({'op': 'update', 'update': data})
+        self.routed += 1
+    
+    def relay(self, index: int):
+        """Forward messages a worker addressed to other shards"""
+        conn = self.conns[index]
+        try:
+            while conn.poll():
+                message = conn.recv()
+                if message.get('shard') is None:
+                    for other, outbox in enumerate(self.outboxes):
+                        if other != index:
+                            outbox.send(message)
+                else:
+                    self.outboxes[message['shard']].send(message)
+        except EOFError:
+            asyncio.get_running_loop().remove_reader(conn.fileno())
+            if not self.stopping:
+                logger.error("Worker %s exited", index)
+                # Calls waiting on it would otherwise only fail at their timeout
+                for other, outbox in enumerate(self.outboxes):
+                    if other != index:
+                        outbox.send({'op': 'down', 'shard': other, 'index': index})
+    
+    def status(self) -> Dict:
+        return {
+            'workers': self.count,
+            'workers_alive': sum(1 for p in self.processes if p.is_alive()),
+            'routed_updates': self.routed
+        }
+    
+    async def run(self, allowed_updates: List[str]):
+        from config import (
+            BOT_TOKEN, BOT_MODE, WEBHOOK_URL, WEBHOOK_LISTEN, WEBHOOK_PORT, WEBHOOK_PATH,
+            WEBHOOK_SECRET, WEBHOOK_DRAIN_TIMEOUT
+        )
+        from utils.webhook import WebhookServer, stop_on_signals
+        
+        loop = asyncio.get_running_loop()
+        for index, conn in enumerate(self.conns):
+            loop.add_reader(conn.fileno(), self.relay, index)
+        stop_event = stop_on_signals()
+        
+        async with Bot(BOT_TOKEN) as bot:
+            if BOT_MODE == 'webhook':
+                if not WEBHOOK_SECRET:
+                    raise RuntimeError("WEBHOOK_SECRET must be set in webhook mode")
+                if WEBHOOK_URL:
+                    await bot.set_webhook(
+                        url=WEBHOOK_URL.rstrip('/') + WEBHOOK_PATH,
+                        secret_token=WEBHOOK_SECRET,
+                        allowed_updates=allowed_updates
+                    )
+                server = WebhookServer(WEBHOOK_LISTEN, WEBHOOK_PORT, WEBHOOK_PATH, WEBHOOK_SECRET,
+                                       self.route_update, self.status)
+                await server.start()
+                await stop_event.wait()
+                await server.close(WEBHOOK_DRAIN_TIMEOUT)
+            else:
+                await bot.delete_webhook()
+                poller = asyncio.create_task(self._poll(bot, allowed_updates))
+                await stop_event.wait()
+                poller.cancel()
+        
+        self.stopping = True
+        for outbox in self.outboxes:
+            outbox.send({'op': 'stop'})
+        # Keep relaying cross-shard messages while workers drain
+        while any(p.is_alive() for p in self.processes):
+            await asyncio.sleep(0.1)
+        for conn in self.conns:
+            loop.remove_reader(conn.fileno())
+    
+    async def _poll(self, bot: Bot, allowed_updates: List[str]):
+        offset = None
+        while True:
+            try:
+                updates = await bot.get_updates(offset=offset, timeout=30, allowed_updates=allowed_updates)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning("Polling failed: %s", e)
+                await asyncio.sleep(1)
+                continue
+            for update in updates:
+                await self.route_update(update.to_dict())
+                offset = update.update_id + 1
+
+def run_supervisor(count: int, allowed_updates: List[str]):
+    """Run the bot as a supervisor with `count` worker processes"""
+    supervisor = Supervisor(count)
+    supervisor.spawn()
+    asyncio.run(supervisor.run(allowed_updates))
+    for process in supervisor.processes:
+        process.join()
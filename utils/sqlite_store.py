@@ -0,0 +1,91 @@
+import json
+import sqlite3
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (user_id INTEGER PRIMARY KEY, data TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS documents (name TEXT PRIMARY KEY, data TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+"""
+
+def encode(data: Dict) -> str:
+    return json.dumps(data, ensure_ascii=False, separators=(',', ':'))
+
+class SqliteStore:
+    """SQLite copy of the JSON layout: one row per user record and one per bot data file.
+    
+    Documents are named after the file they mirror (bot_data.json, bot_data.shard0.json)
+    so the two layouts can be compared file for file. WAL mode lets several worker
+    processes write while others read.
+    """
+    
+    def __init__(self, path: str, timeout: float = 30):
+        self.path = path
+        # timeout: how long a write waits for another connection's transaction to end
+        self.conn = sqlite3.connect(path, isolation_level=None, timeout=timeout, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(SCHEMA)
+    
+    def close(self):
+        self.conn.close()
+    
+    def read_user(self, user_id: int) -> Optional[Dict]:
+        row = self.conn.execute("SELECT data FROM users WHERE user_id = ?", (user_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+    
+    def write_user(self, user_id: int, data: Dict):
+        self.conn.execute("INSERT OR REPLACE INTO users (user_id, data) VALUES (?, ?)", (user_id, encode(data)))
+    
+    def insert_users(self, rows: Iterable[Tuple[int, str]]) -> int:
+        """Add encoded records that aren't present yet (a newer copy written meanwhile wins)"""
+        before = self.conn.total_changes
+        self.conn.executemany("INSERT OR IGNORE INTO users (user_id, data) VALUES (?, ?)", rows)
+        return self.conn.total_changes - before
+    
+    def user_ids(self) -> Iterator[int]:
+        for (user_id,) in self.conn.execute("SELECT user_id FROM users ORDER BY user_id"):
+            yield user_id
+    
+    def count_users(self) -> int:
+        return self.conn.execute("SELECT COUNT(*) FROM users").fetchone()[0]
+    
+    def read_document(self, name: str) -> Optional[Dict]:
+        row = self.conn.execute("SELECT data FROM documents WHERE name = ?", (name,)).fetchone()
+        return json.loads(row[0]) if row else None
+    
+    def write_document(self, name: str, data: Dict):
+        self.conn.execute("INSERT OR REPLACE INTO documents (name, data) VALUES (?, ?)", (name, encode(data)))
+    
+    def insert_document(self, name: str, raw: str) -> bool:
+        cursor = self.conn.execute("INSERT OR IGNORE INTO documents (name, data) VALUES (?, ?)", (name, raw))
+        return cursor.rowcount > 0
+    
+    def delete_document(self, name: str):
+        self.conn.execute("DELETE FROM documents WHERE name = ?", (name,))
+    
+    def document_names(self) -> List[str]:
+        return [name for (name,) in self.conn.execute("SELECT name FROM documents ORDER BY name")]
+    
+    def get_meta(self, key: str) -> Optional[str]:
+        row = self.conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+    
+    def set_meta(self, key: str, value: str):
+        self.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, value))
+    
+    def transaction(self):
+        """Group writes into one commit: `with store.transaction(): ...`"""
+        return _Transaction(self.conn)
+
+class _Transaction:
+    def __init__(self, conn: sqlite3.Connection):
+        self.conn = conn
+    
+    def __enter__(self):
+        self.conn.execute("BEGIN IMMEDIATE")
+        return self
+    
+    def __exit__(self, exc_type, *exc):
+        self.conn.execute("ROLLBACK" if exc_type else "COMMIT")
+        return False
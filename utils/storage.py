@@ -1,6 +1,252 @@
+import copy
+import functools
+import glob
+import itertools
 import json
 import os
-from typing import Any, Dict, List, Optional
+import random
+import sqlite3
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+from utils import metrics, tracing
+from utils.sqlite_store import SqliteStore
+
+# Bot-wide data and hot user records are shared by every Storage instance pointing
+# at the same files, so module-level instances never see each other's writes as stale
+_shared_bot_data: Dict[str, Dict] = {}
+_shared_records: Dict[str, "RecordCache"] = {}
+
+# Hot user records kept in memory per data directory
+USER_CACHE_SIZE = int(os.getenv('USER_CACHE_SIZE', '20000'))
+
+STORAGE_SECONDS = metrics.histogram('lumi_storage_seconds', "Storage calls by method, cache hits included",
+                                    ('method',))
+STORAGE_BYTES = metrics.counter('lumi_storage_bytes_total', "Bytes read and written by the storage method that did it",
+                                ('method',))
+
+# Outermost storage method running, which file reads and writes are counted against
+_current_method: ContextVar[Optional[str]] = ContextVar("current_storage_method", default=None)
+
+def _storage_method(name: str):
+    """Trace a storage method and time it in lumi_storage_seconds{method}"""
+    def decorate(func):
+        traced = tracing.traced(name)(func)
+        
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            token = _current_method.set(name) if _current_method.get() is None else None
+            start = time.perf_counter()
+            try:
+                return traced(*args, **kwargs)
+            finally:
+                STORAGE_SECONDS.observe(time.perf_counter() - start, name)
+                if token is not None:
+                    _current_method.reset(token)
+        return wrapper
+    return decorate
+
+# Dual-write: every write is also applied to a SQLite database (file name inside the
+# data directory; empty disables) and a share of disk reads is checked against it
+STORAGE_MIRROR = os.getenv('STORAGE_MIRROR', '')
+STORAGE_COMPARE_RATE = float(os.getenv('STORAGE_COMPARE_RATE', '1'))
+# Mirror writes run on the event loop, so they wait at most this many seconds for a
+# lock held by another process (tools.migrate); one that gives up is counted in
+# lumi_mirror_errors_total and rewritten by the migrate tool's repair pass
+STORAGE_MIRROR_TIMEOUT = float(os.getenv('STORAGE_MIRROR_TIMEOUT', '0.05'))
+_shared_mirrors: Dict[str, SqliteStore] = {}
+
+MIRROR_READS = metrics.counter('lumi_mirror_reads_total', "Disk reads compared with the mirror by file and result",
+                               ('file', 'result'))
+MIRROR_ERRORS = metrics.counter('lumi_mirror_errors_total', "Failed mirror operations", ('op',))
+
+# Files written by each worker in multi-process mode, overlaid on bot_data.json at load
+_shard_files: Dict[str, List[str]] = {}
+
+# Other workers' shard files as last read: path -> (mtime_ns, data)
+_owner_shards: Dict[str, Tuple[int, Dict]] = {}
+
+# Shard router installed in multi-process worker mode (see utils.sharding)
+_router = None
+
+def set_router(router):
+    """Route writes for users owned by other worker processes through the router"""
+    global _router
+    _router = router
+
+def get_router():
+    return _router
+
+# Fields shown on profile cards; changing one gives the record a new profile_version so
+# rendered cards keyed by version go stale in every process
+PROFILE_FIELDS = frozenset(('name', 'age', 'gender', 'interest', 'location', 'bio', 'profile_photo', 'username'))
+
+# Fields that decide whether and how a user appears in matching
+INDEXED_FIELDS = PROFILE_FIELDS | {'is_registered', 'age_min', 'age_max', 'boost_expires_at'}
+
+# Callbacks notified with (user_id, record) after an indexed field is written
+_user_listeners: List = []
+
+_last_profile_version = 0
+
+def new_profile_version() -> int:
+    """A profile version never handed out before, even to an earlier record of the same user.
+    
+    Versions are write times in nanoseconds (strictly increasing within the process), so
+    a record deleted by a reset and registered again can't repeat an old version and
+    pick up cards rendered for the old profile.
+    """
+    global _last_profile_version
+    _last_profile_version = max(time.time_ns(), _last_profile_version + 1)
+    return _last_profile_version
+
+def add_user_listener(listener):
+    """Get notified when a user's profile-relevant fields change"""
+    _user_listeners.append(listener)
+
+def _notify(user_id: int, record: Dict):
+    for listener in _user_listeners:
+        listener(user_id, record)
+
+# Snapshots in progress (see utils.backup); told before any data file is replaced or removed
+_write_observers: List = []
+
+def add_write_observer(observer):
+    """Get called with a file path just before storage overwrites or deletes it"""
+    _write_observers.append(observer)
+
+def remove_write_observer(observer):
+    _write_observers.remove(observer)
+
+# Unit of work for the update currently being processed (see Storage.unit_of_work)
+_current_unit: ContextVar[Optional["UnitOfWork"]] = ContextVar("storage_unit_of_work", default=None)
+
+# Stamp of the latest change to each bot data key, (bot data file, key) -> stamp, so a
+# discarded update only takes back a value no other update has set since
+_bot_stamps: Dict[Tuple[str, str], int] = {}
+_next_bot_stamp = itertools.count(1)
+
+# Value of a bot data key that wasn't set
+_ABSENT = object()
+
+class RecordCache:
+    """LRU of user records; records pinned by an open unit of work are never evicted"""
+    
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.records: "OrderedDict[int, Dict]" = OrderedDict()
+        self.pins: Dict[int, int] = {}
+        self.hits = 0
+        self.misses = 0
+    
+    def get(self, user_id: int) -> Optional[Dict]:
+        record = self.records.get(user_id)
+        if record is not None:
+            self.records.move_to_end(user_id)
+        return record
+    
+    def put(self, user_id: int, record: Dict):
+        self.records[user_id] = record
+        self.records.move_to_end(user_id)
+        if len(self.records) > self.capacity:
+            for old_id in list(self.records):
+                if len(self.records) <= self.capacity:
+                    break
+                if old_id not in self.pins:
+                    del self.records[old_id]
+    
+    def pin(self, user_id: int):
+        self.pins[user_id] = self.pins.get(user_id, 0) + 1
+    
+    def unpin(self, user_id: int):
+        count = self.pins.get(user_id, 0) - 1
+        if count > 0:
+            self.pins[user_id] = count
+        else:
+            self.pins.pop(user_id, None)
+
+class UnitOfWork:
+    """Per-update write buffer: each record is read at most once and written at most once"""
+    
+    def __init__(self):
+        self.touched: Dict[Tuple[str, int], "Storage"] = {}
+        self.changed: Dict[Tuple[str, int], set] = {}
+        self.dirty_bot: Dict[str, "Storage"] = {}
+        # Bot data keys: (file, key) -> (storage, value when first read or set), and the
+        # stamp of this unit's last change to each key it set
+        self.bot_before: Dict[Tuple[str, str], Tuple["Storage", Any]] = {}
+        self.bot_set: Dict[Tuple[str, str], int] = {}
+        self.reads = 0
+        self.writes = 0
+    
+    def touch(self, storage: "Storage", user_id: int):
+        """Pin a record for the lifetime of this unit of work"""
+        key = (storage.users_dir, user_id)
+        if key not in self.touched:
+            self.touched[key] = storage
+            storage.records.pin(user_id)
+    
+    def remember_bot_value(self, storage: "Storage", key: str):
+        """Keep a key's value as this unit first saw it, for discard.
+        
+        Callers change lists and dicts in place before setting them back, so the value is
+        copied when first read. Only the top level is copied: a change nested deeper
+        than that can't be taken back.
+        """
+        entry = (storage.bot_data_file, key)
+        if entry not in self.bot_before:
+            value = storage.bot_data.get(key, _ABSENT)
+            self.bot_before[entry] = (storage, copy.copy(value) if isinstance(value, (list, dict)) else value)
+    
+    @_storage_method('storage.flush')
+    def flush(self):
+        """Write every changed record and the bot data once"""
+        for key, fields in self.changed.items():
+            if fields:
+                storage = self.touched[key]
+                storage._write_user(key[1], storage.records.get(key[1]) or {})
+                self.writes += 1
+        for storage in self.dirty_bot.values():
+            storage._save_bot_data()
+            self.writes += 1
+        self.changed.clear()
+        self.dirty_bot.clear()
+        self.bot_before.clear()
+        self.bot_set.clear()
+    
+    def discard(self):
+        """Drop the changes of an update that failed instead of writing them.
+        
+        Changed records only this unit holds go back to their copy on disk, and listeners
+        (the profile index) are told about it. Bot data keys this unit set go back to the
+        value it first saw, unless another update has set them since; changes already
+        forwarded to another worker stay.
+        """
+        for key, fields in self.changed.items():
+            storage, user_id = self.touched[key], key[1]
+            if fields and storage.records.pins.get(user_id) == 1:
+                record = storage._read_user(user_id)
+                storage.records.put(user_id, record)
+                _notify(user_id, record)
+        for entry, stamp in self.bot_set.items():
+            if _bot_stamps.get(entry) != stamp:
+                continue
+            storage, before = self.bot_before[entry]
+            if before is _ABSENT:
+                storage.bot_data.pop(entry[1], None)
+            else:
+                storage.bot_data[entry[1]] = before
+        self.changed.clear()
+        self.dirty_bot.clear()
+        self.bot_before.clear()
+        self.bot_set.clear()
+    
+    def close(self):
+        for (_, user_id), storage in self.touched.items():
+            storage.records.unpin(user_id)
+        self.touched.clear()
 
 class Storage:
     """Simple file-based storage system"""
@@ -14,83 +260,419 @@ class Storage:
         self.users_dir = os.path.join(data_dir, "users")
         os.makedirs(self.users_dir, exist_ok=True)
         
-        # Load bot data
-        self.bot_data = self._load_json(self.bot_data_file) or {}
+        if self.users_dir not in _shared_records:
+            _shared_records[self.users_dir] = RecordCache(USER_CACHE_SIZE)
+            metrics.register_cache('records', _shared_records[self.users_dir])
+        self.records = _shared_records[self.users_dir]
+        
+        self.mirror: Optional[SqliteStore] = None
+        if STORAGE_MIRROR:
+            if data_dir not in _shared_mirrors:
+                _shared_mirrors[data_dir] = SqliteStore(os.path.join(data_dir, STORAGE_MIRROR),
+                                                        timeout=STORAGE_MIRROR_TIMEOUT)
+            self.mirror = _shared_mirrors[data_dir]
+    
+    @property
+    def bot_data(self) -> Dict:
+        """Bot-wide data, loaded on first use rather than when modules create their Storage"""
+        data = _shared_bot_data.get(self.bot_data_file)
+        if data is None:
+            data = _shared_bot_data[self.bot_data_file] = self._load_bot_data()
+        return data
     
     def _load_json(self, filepath: str) -> Optional[Dict]:
         """Load JSON from file"""
         try:
             if os.path.exists(filepath):
-                with open(filepath, 'r', encoding='utf-8') as f:
-                    return json.load(f)
+                with tracing.span('file.read', filepath):
+                    with open(filepath, 'rb') as f:
+                        raw = f.read()
+                STORAGE_BYTES.inc(_current_method.get() or 'other', amount=len(raw))
+                with tracing.span('json.decode', filepath):
+                    return json.loads(raw)
         except Exception as e:
             print(f"Error loading {filepath}: {e}")
         return None
     
     def _save_json(self, filepath: str, data: Dict):
-        """Save JSON to file"""
+        """Save JSON to file; a failed write is reported and raised, leaving the old file"""
+        # Write a temp file and rename it so readers in other processes never see a partial file
+        tmp_path = f"{filepath}.{os.getpid()}.tmp"
         try:
-            with open(filepath, 'w', encoding='utf-8') as f:
-                json.dump(data, f, ensure_ascii=False, indent=2)
+            with tracing.span('json.encode', filepath):
+                raw = json.dumps(data, ensure_ascii=False, indent=2).encode('utf-8')
+            with tracing.span('file.write', filepath):
+                with open(tmp_path, 'wb') as f:
+                    f.write(raw)
+                for observer in _write_observers:
+                    observer(filepath)
+                os.replace(tmp_path, filepath)
+            STORAGE_BYTES.inc(_current_method.get() or 'other', amount=len(raw))
         except Exception as e:
             print(f"Error saving {filepath}: {e}")
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            raise
+    
+    def _mirror_call(self, op: str, func, *args):
+        """Apply a write to the mirror; a failing mirror never fails the primary write"""
+        try:
+            func(*args)
+        except sqlite3.Error as e:
+            MIRROR_ERRORS.inc(op)
+            print(f"Error mirroring {op}: {e}")
+    
+    def _compare_mirror(self, kind: str, data: Optional[Dict], read):
+        """Count whether the mirror holds the same data as the file just read"""
+        if random.random() >= STORAGE_COMPARE_RATE:
+            return
+        try:
+            mirrored = read()
+        except sqlite3.Error as e:
+            MIRROR_ERRORS.inc('read')
+            print(f"Error reading mirror: {e}")
+            return
+        if mirrored is None:
+            result = 'match' if data is None else 'missing'
+        else:
+            result = 'match' if mirrored == data else 'mismatch'
+        MIRROR_READS.inc(kind, result)
+    
+    def _shard_file(self, index: int) -> str:
+        return os.path.join(self.data_dir, f"bot_data.shard{index}.json")
+    
+    def _load_bot_data(self) -> Dict:
+        """Load bot data with any shard files from worker mode laid over it"""
+        data = self._load_json(self.bot_data_file)
+        if self.mirror is not None:
+            self._compare_mirror('bot_data', data, lambda: self.mirror.read_document("bot_data.json"))
+        data = data or {}
+        shard_files = sorted(glob.glob(os.path.join(self.data_dir, "bot_data.shard*.json")))
+        for path in shard_files:
+            shard = self._load_json(path)
+            if self.mirror is not None:
+                self._compare_mirror('bot_data', shard, lambda: self.mirror.read_document(os.path.basename(path)))
+            data.update(shard or {})
+        _shard_files[self.bot_data_file] = shard_files
+        return data
+    
+    def _save_bot_data(self):
+        """Persist bot data; a worker only writes the keys it owns to its shard file"""
+        router = _router
+        if router is not None:
+            owned = {key: value for key, value in self.bot_data.items() if router.persists_key(key)}
+            shard_file = self._shard_file(router.index)
+            self._save_json(shard_file, owned)
+            if self.mirror is not None:
+                self._mirror_call('write', self.mirror.write_document, os.path.basename(shard_file), owned)
+            return
+        
+        self._save_json(self.bot_data_file, self.bot_data)
+        if self.mirror is not None:
+            self._mirror_call('write', self.mirror.write_document, "bot_data.json", self.bot_data)
+        # The merged data now lives in the main file
+        for path in _shard_files.get(self.bot_data_file, []):
+            for observer in _write_observers:
+                observer(path)
+            os.remove(path)
+            if self.mirror is not None:
+                self._mirror_call('delete', self.mirror.delete_document, os.path.basename(path))
+        _shard_files[self.bot_data_file] = []
+    
+    def consolidate_bot_data(self):
+        """Fold shard files into bot_data.json (before workers start with a new layout)"""
+        if _shard_files.get(self.bot_data_file):
+            self._save_bot_data()
+    
+    def _user_file(self, user_id: int) -> str:
+        """Path of a user's record"""
+        return os.path.join(self.users_dir, f"{user_id}.json")
+    
+    def _read_user(self, user_id: int) -> Dict:
+        """Read a user's record from disk"""
+        data = self._load_json(self._user_file(user_id))
+        if self.mirror is not None:
+            self._compare_mirror('user', data, lambda: self.mirror.read_user(user_id))
+        return data or {}
+    
+    def _write_user(self, user_id: int, data: Dict):
+        """Write a user's record to disk"""
+        self._save_json(self._user_file(user_id), data)
+        if self.mirror is not None:
+            self._mirror_call('write', self.mirror.write_user, user_id, data)
+    
+    @contextmanager
+    def unit_of_work(self):
+        """Buffer reads and writes for the current update and flush them once on a clean exit
+        (an update that raised is discarded, see UnitOfWork.discard)"""
+        unit = _current_unit.get()
+        if unit is not None:
+            # Nested handler calls share the outer update's unit of work
+            yield unit
+            return
+        
+        unit = UnitOfWork()
+        token = _current_unit.set(unit)
+        clean = False
+        try:
+            yield unit
+            clean = True
+        finally:
+            _current_unit.reset(token)
+            try:
+                if clean:
+                    try:
+                        unit.flush()
+                    except Exception:
+                        # Records the flush didn't get to go back to their copy on disk
+                        unit.discard()
+                        raise
+                else:
+                    unit.discard()
+            finally:
+                unit.close()
     
+    @staticmethod
+    def detach_unit_of_work():
+        """Leave the inherited unit of work (for background tasks spawned by a handler)"""
+        _current_unit.set(None)
+    
+    def _cached_user(self, user_id: int, unit: Optional[UnitOfWork]) -> Dict:
+        """Get the shared hot copy of a user's record, loading it on first use"""
+        if _router is not None and not _router.owns_user(user_id):
+            # Another worker owns this record; read its latest flushed state
+            return self._read_user(user_id)
+        
+        record = self.records.get(user_id)
+        if record is None:
+            self.records.misses += 1
+            record = self._read_user(user_id)
+            self.records.put(user_id, record)
+            if unit is not None:
+                unit.reads += 1
+        else:
+            self.records.hits += 1
+        if unit is not None:
+            unit.touch(self, user_id)
+        return record
+    
+    @_storage_method('storage.get_user_data')
     def get_user_data(self, user_id: int) -> Dict:
         """Get all user data"""
-        user_file = os.path.join(self.users_dir, f"{user_id}.json")
-        return self._load_json(user_file) or {}
+        return self._cached_user(user_id, _current_unit.get())
     
+    @_storage_method('storage.save_user_data')
     def save_user_data(self, user_id: int, data: Dict):
         """Save all user data"""
-        user_file = os.path.join(self.users_dir, f"{user_id}.json")
-        self._save_json(user_file, data)
+        if _router is not None and not _router.owns_user(user_id):
+            for key, value in data.items():
+                _router.forward_user_set(user_id, key, value)
+            return
+        
+        unit = _current_unit.get()
+        if unit is not None:
+            unit.touch(self, user_id)
+        previous = self.records.get(user_id) or {}
+        if data is previous:
+            # The caller changed the cached record in place, so there is nothing to compare
+            # with; assume the profile changed if the record has one
+            changed = any(f in data for f in PROFILE_FIELDS)
+        else:
+            changed = any(previous.get(f) != data.get(f) for f in PROFILE_FIELDS)
+        if changed:
+            data['profile_version'] = new_profile_version()
+        self.records.put(user_id, data)
+        if unit is None:
+            self._write_user(user_id, data)
+        else:
+            unit.changed.setdefault((self.users_dir, user_id), set()).update(data.keys())
+        _notify(user_id, data)
+    
+    @_storage_method('storage.get_users_many')
+    def get_users_many(self, user_ids: Iterable[int], fields: Optional[Iterable[str]] = None) -> Dict[int, Dict]:
+        """Records of several users at once, projected to `fields` (all fields if None).
+        
+        Cached records are served from memory and the rest read from disk once and added
+        to the cache. Results are copies and don't join the unit of work; users without a
+        record are left out.
+        """
+        fields = tuple(fields) if fields is not None else None
+        unit = _current_unit.get()
+        found = {}
+        for user_id in user_ids:
+            if user_id in found:
+                continue
+            if _router is not None and not _router.owns_user(user_id):
+                record = self._read_user(user_id)
+            else:
+                record = self.records.get(user_id)
+                if record is None:
+                    self.records.misses += 1
+                    record = self._read_user(user_id)
+                    self.records.put(user_id, record)
+                    if unit is not None:
+                        unit.reads += 1
+                else:
+                    self.records.hits += 1
+            if record:
+                found[user_id] = ({field: record.get(field) for field in fields} if fields is not None
+                                  else dict(record))
+        return found
     
+    @_storage_method('storage.get_user_property')
     def get_user_property(self, user_id: int, key: str) -> Any:
         """Get specific user property"""
         user_data = self.get_user_data(user_id)
         return user_data.get(key)
     
+    @_storage_method('storage.set_user_property')
     def set_user_property(self, user_id: int, key: str, value: Any):
         """Set specific user property"""
-        user_data = self.get_user_data(user_id)
+        if _router is not None and not _router.owns_user(user_id):
+            _router.forward_user_set(user_id, key, value)
+            return
+        
+        unit = _current_unit.get()
+        user_data = self._cached_user(user_id, unit)
+        if key in PROFILE_FIELDS and user_data.get(key) != value:
+            user_data['profile_version'] = new_profile_version()
         user_data[key] = value
-        self.save_user_data(user_id, user_data)
+        if unit is None:
+            self._write_user(user_id, user_data)
+        else:
+            unit.changed.setdefault((self.users_dir, user_id), set()).update((key, 'profile_version'))
+        if key in INDEXED_FIELDS:
+            _notify(user_id, user_data)
     
+    @_storage_method('storage.get_bot_property')
     def get_bot_property(self, key: str) -> Any:
         """Get bot-wide property"""
+        if _router is not None and not _router.owns_key(key) and not _router.is_global_key(key):
+            return self._owner_bot_property(key)
+        # Global keys are fanned out by their owner, so the local replica is current
+        unit = _current_unit.get()
+        if unit is not None:
+            unit.remember_bot_value(self, key)
         return self.bot_data.get(key)
     
+    def _owner_bot_property(self, key: str) -> Any:
+        """Another worker's per-user key, as of that worker's latest flush.
+        
+        Only the owner changes such keys, so a local copy would go stale; the owner's
+        shard file is read instead and re-parsed only when it changed.
+        """
+        path = self._shard_file(_router.key_shard(key))
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except FileNotFoundError:
+            # The owner hasn't written since bot data was consolidated at start, so the
+            # value loaded then is current
+            return self.bot_data.get(key)
+        cached = _owner_shards.get(path)
+        if cached is None or cached[0] != mtime:
+            cached = _owner_shards[path] = (mtime, self._load_json(path) or {})
+        return cached[1].get(key)
+    
+    @_storage_method('storage.set_bot_property')
     def set_bot_property(self, key: str, value: Any):
-        """Set bot-wide property"""
-        self.bot_data[key] = value
-        self._save_json(self.bot_data_file, self.bot_data)
+        """Set bot-wide property.
+        
+        In worker mode a key owned by another worker is forwarded to it. Changing a
+        global list from any worker goes through sharding.add_to_bot_list and
+        remove_from_bot_list instead, so concurrent changes can't overwrite each other.
+        """
+        router = _router
+        if router is not None:
+            if not router.owns_key(key):
+                # The owning worker applies and persists it (and fans out global keys)
+                router.forward_bot_set(key, value)
+                return
+            if router.is_global_key(key):
+                router.broadcast_bot_set(key, value)
+        self.apply_bot_property(key, value)
+    
+    def apply_bot_property(self, key: str, value: Any):
+        """Set bot-wide property locally without routing it to other workers"""
+        self._bot_key_changing(key)
+        if value is None and _router is None:
+            # A missing key reads as None too; only a worker's shard file needs the None
+            # to shadow an older value in bot_data.json
+            self.bot_data.pop(key, None)
+        else:
+            self.bot_data[key] = value
+        self._bot_data_changed()
+    
+    def remove_bot_properties(self, keys: Iterable[str]):
+        """Drop bot-wide keys (single process only, see apply_bot_property)"""
+        for key in keys:
+            self._bot_key_changing(key)
+            self.bot_data.pop(key, None)
+        self._bot_data_changed()
     
+    def _bot_key_changing(self, key: str):
+        """Stamp a key about to change; in a unit of work, keep its value for discard"""
+        entry = (self.bot_data_file, key)
+        stamp = _bot_stamps[entry] = next(_next_bot_stamp)
+        unit = _current_unit.get()
+        if unit is not None:
+            unit.remember_bot_value(self, key)
+            unit.bot_set[entry] = stamp
+    
+    def _bot_data_changed(self):
+        unit = _current_unit.get()
+        if unit is None:
+            self._save_bot_data()
+        else:
+            unit.dirty_bot[self.bot_data_file] = self
+    
+    def persisted_bot_data_file(self) -> str:
+        """File this process writes bot data to"""
+        return self._shard_file(_router.index) if _router is not None else self.bot_data_file
+    
+    @_storage_method('storage.get_all_users')
     def get_all_users(self) -> List[Dict]:
         """Get all registered users"""
         users = []
         for filename in os.listdir(self.users_dir):
             if filename.endswith('.json'):
                 user_id = int(filename[:-5])  # Remove .json
-                user_data = self.get_user_data(user_id)
+                # Hot records may carry writes not flushed yet; copy so callers can't mutate them
+                cached = self.records.get(user_id)
+                user_data = dict(cached) if cached is not None else self._read_user(user_id)
                 if user_data.get('is_registered'):
                     user_data['user_id'] = user_id
                     users.append(user_data)
         return users
     
+    @_storage_method('storage.get_profiles')
     def get_profiles(self) -> List[Dict]:
         """Get all complete profiles"""
         profiles = []
         for user_data in self.get_all_users():
-            if user_data.get('profile_photo') and user_data.get('gender'):
-                profiles.append({
-                    'id': user_data['user_id'],
-                    'name': user_data.get('name', 'Anonymous'),
-                    'age': user_data.get('age'),
-                    'gender': user_data.get('gender'),
-                    'interest': user_data.get('interest'),
-                    'location': user_data.get('location', 'Not specified'),
-                    'bio': user_data.get('bio', 'No bio yet'),
-                    'photo': user_data.get('profile_photo'),
-                    'username': user_data.get('username')
-                })
+            profile = make_profile(user_data['user_id'], user_data)
+            if profile:
+                profiles.append(profile)
         return profiles
+
+def make_profile(user_id: int, user_data: Dict) -> Optional[Dict]:
+    """Matching view of a user record, or None if the profile is incomplete"""
+    if not (user_data.get('is_registered') and user_data.get('profile_photo') and user_data.get('gender')):
+        return None
+    return {
+        'id': user_id,
+        'name': user_data.get('name', 'Anonymous'),
+        'age': user_data.get('age'),
+        'gender': user_data.get('gender'),
+        'interest': user_data.get('interest'),
+        'location': user_data.get('location', 'Not specified'),
+        'bio': user_data.get('bio', 'No bio yet'),
+        'photo': user_data.get('profile_photo'),
+        'username': user_data.get('username'),
+        'version': user_data.get('profile_version', 0),
+        'age_min': user_data.get('age_min'),
+        'age_max': user_data.get('age_max'),
+        'boost_expires_at': user_data.get('boost_expires_at'),
+        'last_active': user_data.get('last_active')
+    }
@@ -0,0 +1,183 @@
+import functools
+import json
+import logging
+import os
+import random
+import time
+from contextvars import ContextVar
+from logging.handlers import RotatingFileHandler
+from typing import Callable, Dict, List, Optional
+
+from config import TRACE_SAMPLE_RATE, TRACE_SLOW_MS, TRACE_SLOW_LOG, TRACE_LOG_MAX_BYTES, TRACE_LOG_BACKUPS, TRACE_MAX_SPANS
+
+logger = logging.getLogger(__name__)
+
+class Trace:
+    """Spans recorded while handling one update.
+    
+    Every update is traced: each span is counted and timed in the per-name summary,
+    which is cheap. Only sampled traces also keep the individual spans with their
+    details, and only the first TRACE_MAX_SPANS of those, so a handler doing
+    thousands of reads stays cheap to trace.
+    """
+    
+    def __init__(self, name: str, user_id: Optional[int], update_id: Optional[int], sampled: bool = False):
+        self.name = name
+        self.user_id = user_id
+        self.update_id = update_id
+        self.sampled = sampled
+        self.start = time.perf_counter()
+        self.depth = 0
+        self.finished = False
+        self.spans: List[Dict] = []
+        self.summary: Dict[str, List[float]] = {}
+    
+    def record(self, name: str, detail: str, start: float, end: float, depth: int):
+        if self.finished:
+            return
+        entry = self.summary.get(name)
+        if entry is None:
+            entry = self.summary[name] = [0, 0.0]
+        entry[0] += 1
+        entry[1] += end - start
+        if self.sampled and len(self.spans) < TRACE_MAX_SPANS:
+            self.spans.append({
+                'name': name,
+                'detail': detail,
+                'at_ms': round((start - self.start) * 1000, 3),
+                'ms': round((end - start) * 1000, 3),
+                'depth': depth
+            })
+    
+    def to_dict(self, duration: float) -> Dict:
+        entry = {
+            'ts': int(time.time()),
+            'update': self.name,
+            'user_id': self.user_id,
+            'update_id': self.update_id,
+            'duration_ms': round(duration * 1000, 3),
+            'sampled': self.sampled,
+            'span_count': sum(count for count, _ in self.summary.values()),
+            'summary': {name: {'count': count, 'ms': round(total * 1000, 3)}
+                        for name, (count, total) in sorted(self.summary.items(), key=lambda item: -item[1][1])}
+        }
+        if self.sampled:
+            entry['spans'] = self.spans
+        return entry
+
+class _Span:
+    __slots__ = ('trace', 'name', 'detail', 'start', 'depth')
+    
+    def __init__(self, trace: Trace, name: str, detail: str):
+        self.trace = trace
+        self.name = name
+        self.detail = detail
+    
+    def __enter__(self):
+        self.depth = self.trace.depth
+        self.trace.depth += 1
+        self.start = time.perf_counter()
+        return self
+    
+    def __exit__(self, *exc):
+        self.trace.depth -= 1
+        self.trace.record(self.name, self.detail, self.start, time.perf_counter(), self.depth)
+        return False
+
+class _NullSpan:
+    __slots__ = ()
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc):
+        return False
+
+_NULL_SPAN = _NullSpan()
+
+# Trace of the update being handled
+_current_trace: ContextVar[Optional[Trace]] = ContextVar("current_trace", default=None)
+
+def span(name: str, detail: str = ''):
+    """Context manager timing a child span of the current update's trace (no-op when not traced)"""
+    trace = _current_trace.get()
+    if trace is None:
+        return _NULL_SPAN
+    return _Span(trace, name, detail)
+
+def _describe(arg) -> str:
+    """Span detail for one argument: ids as they are, anything else by type only, so
+    message texts and other user content never reach the log"""
+    if isinstance(arg, int) and not isinstance(arg, bool):
+        return str(arg)
+    return type(arg).__name__
+
+def traced(name: str) -> Callable:
+    """Decorator recording each call as a span, detailed (when sampled) with its ids and argument types"""
+    def decorate(func: Callable) -> Callable:
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            trace = _current_trace.get()
+            if trace is None:
+                return func(*args, **kwargs)
+            detail = ' '.join(_describe(arg) for arg in args[1:])[:120] if trace.sampled else ''
+            with _Span(trace, name, detail):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorate
+
+def detach():
+    """Stop tracing in a background task spawned by a traced handler"""
+    _current_trace.set(None)
+
+_slow_log: Optional[logging.Logger] = None
+
+def _slow_logger() -> logging.Logger:
+    global _slow_log
+    if _slow_log is None:
+        directory = os.path.dirname(TRACE_SLOW_LOG)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        handler = RotatingFileHandler(TRACE_SLOW_LOG, maxBytes=TRACE_LOG_MAX_BYTES,
+                                      backupCount=TRACE_LOG_BACKUPS, encoding='utf-8')
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        _slow_log = logging.getLogger('lumi.slow_updates')
+        _slow_log.propagate = False
+        _slow_log.setLevel(logging.INFO)
+        _slow_log.addHandler(handler)
+    return _slow_log
+
+class UpdateTrace:
+    """Context manager around one update's handling"""
+    
+    __slots__ = ('name', 'user_id', 'update_id', 'trace', 'token', 'start')
+    
+    def __init__(self, name: str, user_id: Optional[int] = None, update_id: Optional[int] = None):
+        self.name = name
+        self.user_id = user_id
+        self.update_id = update_id
+    
+    def __enter__(self):
+        sampled = TRACE_SAMPLE_RATE > 0 and random.random() < TRACE_SAMPLE_RATE
+        self.trace = Trace(self.name, self.user_id, self.update_id, sampled)
+        self.token = _current_trace.set(self.trace)
+        self.start = time.perf_counter()
+        return self.trace
+    
+    def __exit__(self, *exc):
+        duration = time.perf_counter() - self.start
+        _current_trace.reset(self.token)
+        self.trace.finished = True
+        if duration * 1000 >= TRACE_SLOW_MS:
+            try:
+                _slow_logger().info(json.dumps(self.trace.to_dict(duration), ensure_ascii=False))
+            except OSError as e:
+                logger.warning("Could not write slow update log: %s", e)
+        return False
+
+def update_trace(name: str, user_id: Optional[int] = None, update_id: Optional[int] = None) -> UpdateTrace:
+    """Trace one update: every update records per-operation timings, sampled ones also
+    record spans, and any update slower than TRACE_SLOW_MS is written to the slow log
+    with its timings (and its spans if it was sampled)"""
+    return UpdateTrace(name, user_id, update_id)
+
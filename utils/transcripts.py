@@ -0,0 +1,291 @@
+import asyncio
+import logging
+import os
+import shutil
+import struct
+import time
+from typing import Dict, List, Optional, Tuple
+from utils import storage as storage_module
+from config import (
+    TRANSCRIPT_DIR, TRANSCRIPT_SEGMENT_BYTES, TRANSCRIPT_SESSION_BYTES, TRANSCRIPT_RETENTION_DAYS
+)
+
+logger = logging.getLogger(__name__)
+
+TEXT = 0
+PHOTO = 1
+
+# Log record header: timestamp, kind, payload length; the payload is UTF-8 (a photo is
+# its file_id, a NUL byte and the caption)
+_RECORD = struct.Struct('<dBI')
+# Index entry per record: offset in the segment's log file and timestamp
+_INDEX = struct.Struct('<Qd')
+
+class _Log:
+    """Segments of one sender -> recipient log, oldest first"""
+    
+    __slots__ = ('path', 'starts', 'size', 'entries')
+    
+    def __init__(self, path: str):
+        self.path = path
+        self.starts: List[int] = []
+        # Size and record count of the newest segment
+        self.size = 0
+        self.entries = 0
+
+class TranscriptLog:
+    """Append-only transcripts of relayed chat messages, kept out of the JSON store.
+    
+    Each direction of a conversation (sender -> recipient) is its own log, so only the
+    process owning the sender ever appends to it. A log is a directory of segments named
+    after the sequence number of their first record: `<start>.log` holds the records and
+    `<start>.idx` a fixed-size entry per record, so the last N records before a time are
+    found by a binary search over the index and read with one seek. Segments roll at
+    TRANSCRIPT_SEGMENT_BYTES; the oldest are dropped once a log exceeds
+    TRANSCRIPT_SESSION_BYTES or ages past the retention period.
+    """
+    
+    def __init__(self, root: str = TRANSCRIPT_DIR, segment_bytes: int = TRANSCRIPT_SEGMENT_BYTES,
+                 session_bytes: int = TRANSCRIPT_SESSION_BYTES, retention_days: float = TRANSCRIPT_RETENTION_DAYS):
+        self.root = root
+        self.segment_bytes = segment_bytes
+        self.session_bytes = session_bytes
+        self.retention = retention_days * 86400
+        self.logs: Dict[Tuple[int, int], _Log] = {}
+    
+    def _log(self, sender_id: int, recipient_id: int) -> _Log:
+        key = (sender_id, recipient_id)
+        log = self.logs.get(key)
+        if log is None:
+            log = self.logs[key] = _Log(os.path.join(self.root, f"{sender_id}-{recipient_id}"))
+            log.starts = _segment_starts(log.path)
+            if log.starts:
+                log.size = _size(self._segment(log, log.starts[-1], '.log'))
+                log.entries = _size(self._segment(log, log.starts[-1], '.idx')) // _INDEX.size
+        return log
+    
+    def _segment(self, log: _Log, start: int, suffix: str) -> str:
+        return os.path.join(log.path, f"{start:012d}{suffix}")
+    
+    def append(self, sender_id: int, recipient_id: int, kind: int, text: str, caption: str = '',
+               now: Optional[float] = None):
+        """Record a relayed message; a failure is logged and never keeps the message from being relayed"""
+        now = time.time() if now is None else now
+        try:
+            try:
+                self._append(sender_id, recipient_id, kind, text, caption, now)
+            except FileNotFoundError:
+                # Segments went away under the cached state (retention, manual cleanup):
+                # list the log from disk again
+                self.logs.pop((sender_id, recipient_id), None)
+                self._append(sender_id, recipient_id, kind, text, caption, now)
+        except OSError as e:
+            logger.warning("Could not record transcript of %s -> %s: %s", sender_id, recipient_id, e)
+    
+    def _append(self, sender_id: int, recipient_id: int, kind: int, text: str, caption: str, now: float):
+        payload = text.encode('utf-8')
+        if kind == PHOTO:
+            payload += b'\0' + caption.encode('utf-8')
+        log = self._log(sender_id, recipient_id)
+        if not log.starts:
+            os.makedirs(log.path, exist_ok=True)
+            log.starts.append(0)
+        elif log.size >= self.segment_bytes:
+            self._roll(log)
+        
+        start = log.starts[-1]
+        log_file, idx_file = self._segment(log, start, '.log'), self._segment(log, start, '.idx')
+        record = _RECORD.pack(now, kind, len(payload)) + payload
+        try:
+            # The offset comes from the file, not the cached size: a record whose index entry
+            # didn't make it still takes up its bytes
+            with open(log_file, 'ab') as f:
+                offset = f.tell()
+                f.write(record)
+            # The index entry goes last: a record is only visible once it is indexed
+            with open(idx_file, 'ab') as f:
+                end = f.tell()
+                if end % _INDEX.size:
+                    # Drop a torn entry so the ones after it stay aligned
+                    f.truncate(end - end % _INDEX.size)
+                f.write(_INDEX.pack(offset, now))
+        except OSError:
+            log.size = _size(log_file)
+            log.entries = _size(idx_file) // _INDEX.size
+            raise
+        log.size = offset + len(record)
+        log.entries += 1
+    
+    def _roll(self, log: _Log):
+        log.starts.append(log.starts[-1] + log.entries)
+        log.size = 0
+        log.entries = 0
+        # Cap the log's total size by dropping its oldest segments
+        total = sum(_size(self._segment(log, start, '.log')) for start in log.starts)
+        while total > self.session_bytes and len(log.starts) > 1:
+            oldest = log.starts.pop(0)
+            total -= _size(self._segment(log, oldest, '.log'))
+            for suffix in ('.log', '.idx'):
+                _remove(self._segment(log, oldest, suffix))
+    
+    def tail(self, sender_id: int, recipient_id: int, count: int, before: Optional[float] = None) -> List[Dict]:
+        """Last `count` messages of one direction sent before a time (default: now), oldest first"""
+        # Listed afresh: in worker mode another process may own this direction's log
+        log = _Log(os.path.join(self.root, f"{sender_id}-{recipient_id}"))
+        found: List[Dict] = []
+        for start in reversed(_segment_starts(log.path)):
+            if len(found) >= count:
+                break
+            found[:0] = self._read_segment(log, start, count - len(found), before)
+        for message in found:
+            message['sender'] = sender_id
+        return found
+    
+    def _read_segment(self, log: _Log, start: int, count: int, before: Optional[float]) -> List[Dict]:
+        try:
+            index = open(self._segment(log, start, '.idx'), 'rb')
+        except FileNotFoundError:
+            return []
+        with index:
+            entries = os.fstat(index.fileno()).st_size // _INDEX.size
+            end = entries if before is None else _bisect_before(index, entries, before)
+            first = max(0, end - count)
+            if first >= end:
+                return []
+            # One entry past the range, if there is one, tells where the last record ends
+            index.seek(first * _INDEX.size)
+            raw = index.read((min(end + 1, entries) - first) * _INDEX.size)
+            offsets = [_INDEX.unpack_from(entry)[0] for entry in _chunks(raw)]
+        stop = offsets.pop() if len(offsets) > end - first else None
+        
+        messages = []
+        with open(self._segment(log, start, '.log'), 'rb') as f:
+            f.seek(offsets[0])
+            data = f.read() if stop is None else f.read(stop - offsets[0])
+        base = offsets[0]
+        for offset in offsets:
+            timestamp, kind, length = _RECORD.unpack_from(data, offset - base)
+            body = data[offset - base + _RECORD.size:offset - base + _RECORD.size + length].decode('utf-8', 'replace')
+            text, _, caption = body.partition('\0')
+            messages.append({'ts': timestamp, 'kind': kind, 'text': text, 'caption': caption})
+        return messages
+    
+    def conversation(self, user_a: int, user_b: int, count: int, before: Optional[float] = None) -> List[Dict]:
+        """Last `count` messages between two users in both directions, oldest first"""
+        messages = self.tail(user_a, user_b, count, before) + self.tail(user_b, user_a, count, before)
+        messages.sort(key=lambda message: message['ts'])
+        return messages[-count:]
+    
+    def find_expired(self, cutoff: float) -> List[Tuple[int, int, int]]:
+        """(sender, recipient, segment start) of segments whose last record is older than
+        `cutoff`; only reads the filesystem, so it may run in a thread.
+        
+        In worker mode only logs whose sender this process owns are considered: the owner
+        is the only process appending to them and holds their cached state.
+        """
+        expired = []
+        if not os.path.isdir(self.root):
+            return expired
+        router = storage_module.get_router()
+        for name in os.listdir(self.root):
+            try:
+                sender_id, recipient_id = (int(part) for part in name.split('-'))
+            except ValueError:
+                continue
+            if router is not None and not router.owns_user(sender_id):
+                continue
+            path = os.path.join(self.root, name)
+            for start in _segment_starts(path):
+                if _last_timestamp(os.path.join(path, f"{start:012d}.idx")) >= cutoff:
+                    # Later segments are newer still
+                    break
+                expired.append((sender_id, recipient_id, start))
+        return expired
+    
+    def remove_expired(self, expired: List[Tuple[int, int, int]], cutoff: float) -> Tuple[int, int]:
+        """Delete segments found by find_expired that are still expired; returns (segments, bytes)"""
+        removed, freed = 0, 0
+        for sender_id, recipient_id, start in expired:
+            log = self._log(sender_id, recipient_id)
+            if start not in log.starts:
+                continue
+            if start == log.starts[-1]:
+                # The segment being appended to: only if nothing arrived since the scan
+                if _last_timestamp(self._segment(log, start, '.idx')) >= cutoff:
+                    continue
+            freed += _size(self._segment(log, start, '.log'))
+            for suffix in ('.log', '.idx'):
+                _remove(self._segment(log, start, suffix))
+            log.starts.remove(start)
+            removed += 1
+            if not log.starts:
+                shutil.rmtree(log.path, ignore_errors=True)
+                del self.logs[(sender_id, recipient_id)]
+        return removed, freed
+    
+    def prune(self, now: Optional[float] = None) -> Tuple[int, int]:
+        """Drop segments older than the retention period; returns (segments, bytes) removed"""
+        cutoff = (time.time() if now is None else now) - self.retention
+        return self.remove_expired(self.find_expired(cutoff), cutoff)
+
+def _segment_starts(path: str) -> List[int]:
+    try:
+        return sorted(int(name[:-4]) for name in os.listdir(path) if name.endswith('.idx'))
+    except FileNotFoundError:
+        return []
+
+def _size(path: str) -> int:
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+def _remove(path: str):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+def _chunks(raw: bytes):
+    for i in range(0, len(raw) - _INDEX.size + 1, _INDEX.size):
+        yield raw[i:i + _INDEX.size]
+
+def _timestamp_at(index, position: int) -> float:
+    index.seek(position * _INDEX.size)
+    return _INDEX.unpack(index.read(_INDEX.size))[1]
+
+def _bisect_before(index, entries: int, before: float) -> int:
+    """Number of index entries with a timestamp before `before` (timestamps only grow)"""
+    low, high = 0, entries
+    while low < high:
+        middle = (low + high) // 2
+        if _timestamp_at(index, middle) < before:
+            low = middle + 1
+        else:
+            high = middle
+    return low
+
+def _last_timestamp(index_path: str) -> float:
+    try:
+        with open(index_path, 'rb') as index:
+            entries = os.fstat(index.fileno()).st_size // _INDEX.size
+            return _timestamp_at(index, entries - 1) if entries else 0.0
+    except FileNotFoundError:
+        return 0.0
+
+transcripts = TranscriptLog()
+
+async def run_retention(interval: float = 3600):
+    """Drop expired transcript segments every `interval` seconds (started from the post_init hook)"""
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            # Scanning every log's index happens in a thread; deleting is quick and stays
+            # on the event loop, where appends happen
+            cutoff = time.time() - transcripts.retention
+            expired = await asyncio.to_thread(transcripts.find_expired, cutoff)
+            removed, freed = transcripts.remove_expired(expired, cutoff)
+            if removed:
+                logger.info("Dropped %d expired transcript segments (%d bytes)", removed, freed)
+        except OSError as e:
+            logger.warning("Transcript retention failed: %s", e)
@@ -0,0 +1,118 @@
+import glob
+import logging
+import os
+import pickle
+import time
+from typing import Any, Callable, Dict, Optional, Tuple
+from utils import storage as storage_module
+from utils.storage import Storage
+from config import WARM_STATE_MAX_AGE
+
+logger = logging.getLogger(__name__)
+
+storage = Storage()
+
+# Bumped whenever a section's layout changes, so old snapshots are ignored
+SNAPSHOT_VERSION = 2
+
+# name -> (dump, restore, session); dump returns picklable state, restore takes it back
+_sections: Dict[str, Tuple[Callable[[], Any], Callable[[Any], None], bool]] = {}
+
+def register(name: str, dump: Callable[[], Any], restore: Callable[[Any], None], session: bool = False):
+    """Include a piece of in-memory state in the warm-state snapshot.
+    
+    A section built from the data files is only restored while they are unchanged. A
+    session section (state kept nowhere else, like registration drafts) is restored even
+    when the data changed since, as long as the worker layout is the same.
+    """
+    _sections[name] = (dump, restore, session)
+
+def _layout() -> int:
+    """Worker count; a session section only makes sense to the worker owning its users"""
+    router = storage_module.get_router()
+    return router.count if router is not None else 1
+
+def snapshot_path() -> str:
+    """Snapshot file of this process (each worker keeps its own)"""
+    router = storage_module.get_router()
+    suffix = f".shard{router.index}" if router is not None else ""
+    return os.path.join(storage.data_dir, f"warm_state{suffix}.pickle")
+
+def fingerprint() -> Tuple:
+    """Changes whenever a user record or the bot data is written.
+
+    Records are replaced by rename, which updates the users directory's mtime, so
+    this stays O(1) in the number of users.
+    """
+    paths = [storage.users_dir, storage.bot_data_file]
+    paths += sorted(glob.glob(os.path.join(storage.data_dir, "bot_data.shard*.json")))
+    return tuple((os.path.basename(path), os.stat(path).st_mtime_ns) for path in paths if os.path.exists(path))
+
+def save():
+    """Write the snapshot; call once the last update has been flushed"""
+    start = time.perf_counter()
+    snapshot = {
+        'version': SNAPSHOT_VERSION,
+        'created': time.time(),
+        'layout': _layout(),
+        'sections': {name: dump() for name, (dump, _, _) in _sections.items()}
+    }
+    # Taken after dumping so a write racing the dump makes the snapshot stale, not wrong
+    snapshot['fingerprint'] = fingerprint()
+    path = snapshot_path()
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(snapshot, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+        logger.info("Saved warm state (%s) in %.2fs", ', '.join(_sections), time.perf_counter() - start)
+    except (OSError, pickle.PicklingError) as e:
+        logger.warning("Could not save warm state: %s", e)
+
+def _load() -> Tuple[Optional[Dict], bool]:
+    """The snapshot (None if unusable) and whether its data sections are still fresh"""
+    path = snapshot_path()
+    if not os.path.exists(path):
+        return None, False
+    try:
+        with open(path, 'rb') as f:
+            snapshot = pickle.load(f)
+    except Exception as e:
+        logger.warning("Ignoring unreadable warm state: %s", e)
+        return None, False
+
+    if snapshot.get('version') != SNAPSHOT_VERSION:
+        logger.info("Ignoring warm state written by another version")
+        return None, False
+    if snapshot.get('layout') != _layout():
+        logger.info("Ignoring warm state written with another worker count")
+        return None, False
+    if time.time() - snapshot.get('created', 0) > WARM_STATE_MAX_AGE:
+        reason = "too old"
+    elif snapshot.get('fingerprint') != fingerprint():
+        reason = "data changed since it was written"
+    else:
+        return snapshot, True
+    logger.info("Warm state is stale (%s); rebuilding on demand", reason)
+    return snapshot, False
+
+def restore() -> bool:
+    """Restore the session sections, and the data sections if the snapshot is fresh (stale
+    or missing state is rebuilt lazily); True if every section was restored"""
+    start = time.perf_counter()
+    snapshot, fresh = _load()
+    # A snapshot is only valid once; the next boot needs a new one from a clean shutdown
+    try:
+        os.remove(snapshot_path())
+    except OSError:
+        pass
+    if snapshot is None:
+        return False
+
+    restored = []
+    for name, (_, restore_section, session) in _sections.items():
+        if name in snapshot['sections'] and (fresh or session):
+            restore_section(snapshot['sections'][name])
+            restored.append(name)
+    logger.info("Restored warm state (%s) in %.2fs", ', '.join(restored), time.perf_counter() - start)
+    return fresh
@@ -0,0 +1,116 @@
+import asyncio
+import hmac
+import logging
+import signal
+from typing import Awaitable, Callable, Dict, List
+from telegram import Update
+from telegram.ext import Application
+from utils.http_server import HttpServer, Request, Response, json_response
+
+logger = logging.getLogger(__name__)
+
+SECRET_HEADER = 'x-telegram-bot-api-secret-token'
+
+class WebhookServer:
+    """Receives Telegram updates over HTTP and hands the raw JSON to a sink"""
+    
+    def __init__(self, host: str, port: int, path: str, secret: str,
+                 on_update: Callable[[Dict], Awaitable[None]], status: Callable[[], Dict]):
+        self.path = path
+        self.secret = secret
+        self.on_update = on_update
+        self.status = status
+        self.draining = False
+        self.http = HttpServer(host, port)
+        self.http.add_route('POST', path, self.handle_update)
+        self.http.add_route('GET', '/health', self.handle_health)
+    
+    async def handle_update(self, request: Request) -> Response:
+        """Validate and enqueue one update"""
+        token = request.headers.get(SECRET_HEADER, '')
+        if not hmac.compare_digest(token.encode(), self.secret.encode()):
+            return json_response(403, {'ok': False, 'error': 'invalid secret token'})
+        
+        if self.draining:
+            # Telegram retries non-2xx deliveries, so nothing is lost while we shut down
+            return json_response(503, {'ok': False, 'error': 'draining'})
+        
+        try:
+            data = request.json()
+            if not isinstance(data, dict) or 'update_id' not in data:
+                raise ValueError("missing update_id")
+            await self.on_update(data)
+        except (ValueError, TypeError, KeyError) as e:
+            return json_response(400, {'ok': False, 'error': f'invalid update: {e}'})
+        return json_response(200, {'ok': True})
+    
+    async def handle_health(self, request: Request) -> Response:
+        """Report readiness; fails while draining so load balancers stop routing here"""
+        body = {'status': 'draining' if self.draining else 'ok'}
+        body.update(self.status())
+        return json_response(503 if self.draining else 200, body)
+    
+    async def start(self):
+        await self.http.start()
+    
+    def drain(self):
+        """Refuse new updates with 503 (and fail /health) while the listener stays up"""
+        self.draining = True
+    
+    async def close(self, timeout: float):
+        """Stop the listener and finish in-flight requests"""
+        self.draining = True
+        await self.http.stop(timeout)
+
+def stop_on_signals() -> asyncio.Event:
+    """Event set on SIGINT/SIGTERM"""
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop_event.set)
+    return stop_event
+
+async def serve(application: Application, allowed_updates: List[str], url: str, host: str,
+                port: int, path: str, secret: str, drain_timeout: float):
+    """Run the application in webhook mode until SIGINT/SIGTERM"""
+    if not secret:
+        raise RuntimeError("WEBHOOK_SECRET must be set in webhook mode")
+    
+    stop_event = stop_on_signals()
+    
+    async def enqueue(data: Dict):
+        await application.update_queue.put(Update.de_json(data, application.bot))
+    
+    async with application:
+        if application.post_init:
+            await application.post_init(application)
+        await application.start()
+        
+        if url:
+            await application.bot.set_webhook(
+                url=url.rstrip('/') + path,
+                secret_token=secret,
+                allowed_updates=allowed_updates
+            )
+        
+        server = WebhookServer(
+            host, port, path, secret, enqueue,
+            lambda: {'pending_updates': application.update_queue.qsize()}
+        )
+        await server.start()
+        logger.info("Serving webhook on %s:%s%s", host, server.http.port, path)
+        
+        await stop_event.wait()
+        
+        # The listener stays up while queued updates finish, answering 503 so load
+        # balancers route elsewhere and Telegram retries, and only then stops
+        logger.info("Draining webhook listener")
+        server.drain()
+        try:
+            await asyncio.wait_for(application.update_queue.join(), drain_timeout)
+        except asyncio.TimeoutError:
+            logger.warning("Drain timed out with %s updates pending", application.update_queue.qsize())
+        await server.close(drain_timeout)
+        await application.stop()
+        if application.post_stop:
+            await application.post_stop(application)